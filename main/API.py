@@ -1,244 +1,202 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
-import json
+from http.server import BaseHTTPRequestHandler
+import os
 import sys
 from config import Config
-from utils import is_valid_email, get_current_time, validate_password_strength
+from routes import dispatch, parse_body, response_headers, route_label, render_metrics
+import logs
+import metrics
 import database as db
+import codec
+import compression
+import hash_executor
+import ids
+import sweeper
+from server import make_server, serve, serve_prefork
+from async_server import serve_async
+
+log = logs.get_logger('api')
 
 class APIHandler(BaseHTTPRequestHandler):
+    # Persistent connections; BaseHTTPRequestHandler defaults to HTTP/1.0
+    protocol_version = 'HTTP/1.1'
+    # Socket timeout, so an idle keep-alive connection gives its thread back
+    timeout = Config.SERVER_KEEPALIVE_TIMEOUT
+    # Headers and body are separate writes; don't let Nagle hold the body
+    # back waiting for the client's delayed ACK
+    disable_nagle_algorithm = True
+    
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
     
     def _get_post_data(self):
+        """Decoded request body, or None after an error response has been sent"""
+        if 'Transfer-Encoding' in self.headers:
+            return self._reject_body(501, "Transfer-Encoding is not supported")
         try:
             content_length = int(self.headers.get('Content-Length', 0))
-            if content_length == 0:
-                return {}
-            
-            post_data = self.rfile.read(content_length).decode('utf-8')
-            
-            try:
-                return json.loads(post_data)
-            except json.JSONDecodeError:
-                parsed_data = parse_qs(post_data)
-                return {key: value[0] for key, value in parsed_data.items()}
+        except ValueError:
+            return self._reject_body(400, "Invalid Content-Length")
+        if content_length < 0:
+            return self._reject_body(400, "Invalid Content-Length")
+        if content_length > Config.SERVER_MAX_BODY_BYTES:
+            return self._reject_body(413, "Request body too large")
+        if content_length == 0:
+            return {}
+        
+        raw = self.rfile.read(content_length)
+        if len(raw) < content_length:
+            # Client went away mid-body; nothing to answer, but no longer in flight
+            self.close_connection = True
+            metrics.request_finished(route_label(self.path), 400, self._started)
+            return None
+        try:
+            with metrics.stage('parse'):
+                return parse_body(raw)
         except Exception as e:
-            print(f"Error reading POST data: {e}")
+            log.warning("Error reading POST data", extra={'fields': {'route': route_label(self.path), 'error': str(e)}})
             return {}
     
-    def _send_response(self, status_code, data):
+    def _reject_body(self, status_code, message):
+        # The unread body would be taken for the next request, so hang up after
+        self.close_connection = True
+        self._send_response(status_code, {"error": message})
+        return None
+    
+    def _send_response(self, status_code, data, content_type='application/json'):
         """Send JSON response"""
-        response_data = json.dumps(data).encode('utf-8') 
+        recorded_status = 500
+        try:
+            with metrics.stage('serialize'):
+                if content_type == 'application/json':
+                    response_data = codec.dumps(data)
+                else:
+                    response_data = data.encode('utf-8')
+                response_data, encoding_headers = compression.encode(
+                    response_data, self.headers.get('Accept-Encoding'))
+            recorded_status = status_code
+        finally:
+            # Record before writing so a client that hangs up can't leak in-flight
+            elapsed = metrics.request_finished(route_label(self.path), recorded_status, self._started)
+        self.requests_served += 1
+        if self.requests_served >= getattr(self.server, 'max_keepalive_requests', 1):
+            self.close_connection = True
         self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Type', content_type)
         self.send_header('Content-Length', str(len(response_data)))
+        self.send_header('Connection', 'close' if self.close_connection else 'keep-alive')
+        for name, value in encoding_headers.items():
+            self.send_header(name, value)
+        for name, value in (response_headers(status_code, data) or {}).items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(response_data)
         
-        print(f"[{get_current_time()}] {self.command} {self.path} -> {status_code}")
-    
-    def do_POST(self):
-        """Handle POST requests"""
-        data = self._get_post_data()
-        
-        # Log request (hiding password)
-        log_data = data.copy()
-        if 'password' in log_data:
-            log_data['password'] = '***'
-        if 'new_password' in log_data:
-            log_data['new_password'] = '***'
-        print(f"[{get_current_time()}] {self.client_address[0]} {self.command} {self.path} - {log_data}")
-        
-        if self.path == '/register':
-            self._handle_register(data)
-        elif self.path == '/login':
-            self._handle_login(data)
-        elif self.path == '/forgot-password':
-            self._handle_forgot_password(data)
-        elif self.path == '/reset-password':
-            self._handle_reset_password(data)
-        elif self.path == '/verify-token':
-            self._handle_verify_token(data)
-        else:
-            self._send_response(404, {"error": "Endpoint not found"})
-    
-    def _handle_register(self, data):
-        name = data.get('name', '').strip()
-        email = data.get('email', '').strip()
-        password = data.get('password', '')
-        age = data.get('age')
-        dob = data.get('dob')
-        
-        # Validate required fields for registration
-        if not name or not email or not password:
-            self._send_response(400, {"error": "Name, email and password are required"})
-            return
-        
-        # Validate email format for registration
-        if not is_valid_email(email):
-            self._send_response(400, {"error": "Invalid email format"})
-            return
-        
-        # Validate password strength
-        is_strong, password_error = validate_password_strength(password)
-        if not is_strong:
-            self._send_response(400, {"error": password_error})
-            return
-        
-        # Register user in database
-        result = db.register_user(name, email, password, age, dob)
-        
-        if 'error' in result:
-            error_msg = result['error']
-            print(f"Registration error: {error_msg}")
-            
-            if 'already registered' in error_msg.lower():
-                self._send_response(409, {"error": "Email already registered"})
-            elif 'database' in error_msg.lower():
-                self._send_response(500, {"error": error_msg})
-            else:
-                self._send_response(500, {"error": error_msg})
-        else:
-            self._send_response(201, {
-                "message": "User registered successfully",
-                "user_id": result["user_id"],
-                "name": result["name"],
-                "email": result["email"]
-            })
-    
-    def _handle_login(self, data):
-        email = data.get('email', '').strip()
-        user_id = data.get('user_id', '').strip()
-        password = data.get('password', '')
-        
-        # Validate required fields for login
-        if not password:
-            self._send_response(400, {"error": "Password is required"})
-            return
-        
-        # Checking if both email and user_id are provided 
-        if email and user_id:
-            self._send_response(400, {"error": "Provide either email or user_id, not both"})
-            return
-        
-        # Checking if neither email nor user_id is provided
-        if not email and not user_id:
-            self._send_response(400, {"error": "Email or user_id is required"})
-            return
-        
-        # Validateing email format if email is provided
-        if email and not is_valid_email(email):
-            self._send_response(400, {"error": "Invalid email format"})
-            return
-        
-        # Login user - pass both email and user_id to the database function
-        result = db.login_user(email=email, password=password, user_id=user_id)
-        
-        if 'error' in result:
-            error_msg = result['error']
-            print(f"Login error: {error_msg}")
-            
-            if 'not found' in error_msg.lower():
-                self._send_response(404, {"error": "User not found"})
-            elif 'invalid password' in error_msg.lower():
-                self._send_response(401, {"error": "Invalid password"})
-            elif 'database' in error_msg.lower():
-                self._send_response(500, {"error": error_msg})
-            else:
-                self._send_response(500, {"error": error_msg})
-        else:
-            self._send_response(200, {
-                "message": "Login successful",
-                "user_id": result["user_id"],
-                "name": result["name"],
-                "email": result["email"]
-            })
+        log.info("Response", extra={'fields': {
+            'route': route_label(self.path), 'client': self.client_address[0],
+            'method': self.command, 'path': self.path, 'status': status_code,
+            'duration_ms': round(elapsed * 1000, 3)
+        }})
     
-    def _handle_forgot_password(self, data):
-        """Handle forgot password request"""
-        email = data.get('email', '').strip()
-        
-        if not email:
-            self._send_response(400, {"error": "Email is required"})
-            return
-        
-        if not is_valid_email(email):
-            self._send_response(400, {"error": "Invalid email format"})
-            return
-        
-        # Generate reset token
-        result = db.forgot_password(email)
-        
-        if 'error' in result:
-            # For security, don't reveal if email exists
-            self._send_response(200, {
-                "message": "If your email is registered, you will receive a reset token"
-            })
-        else:
-            self._send_response(200, {
-                "message": "Reset token generated successfully",
-                "reset_token": result["reset_token"],
-                "next_step": "Use this token with /reset-password endpoint to set new password"
-            })
+    def log_message(self, format, *args):
+        # BaseHTTPRequestHandler writes its access log straight to stderr
+        # No path yet when a kept-alive connection idles out before a request line
+        log.debug(format % args, extra={'fields': {'route': route_label(getattr(self, 'path', ''))}})
     
-    def _handle_verify_token(self, data):
-        """Verify if reset token is valid"""
-        token = data.get('token', '').strip()
-        
-        if not token:
-            self._send_response(400, {"error": "Token is required"})
-            return
-        
-        result = db.verify_reset_token(token)
-        
-        if 'error' in result:
-            self._send_response(400, {"error": result['error']})
+    def do_GET(self):
+        """Serve /metrics and /me"""
+        self._started = metrics.request_started(route_label(self.path))
+        if self.path == '/metrics':
+            self._send_response(200, render_metrics(), 'text/plain; version=0.0.4')
+        elif self.path == '/me':
+            self._send_response(*dispatch(self.path, {}, self.client_address[0],
+                                          self.headers.get('Authorization')))
         else:
-            self._send_response(200, {
-                "valid": True,
-                "message": "Token is valid",
-                "email": result['email'],
-                "name": result['name']
-            })
+            self._send_response(404, {"error": "Endpoint not found"})
     
-    def _handle_reset_password(self, data):
-        """Reset password with token"""
-        token = data.get('token', '').strip()
-        new_password = data.get('new_password', '')
-        
-        if not token or not new_password:
-            self._send_response(400, {"error": "Token and new password are required"})
+    def do_POST(self):
+        """Handle POST requests"""
+        self._started = metrics.request_started(route_label(self.path))
+        data = self._get_post_data()
+        if data is None:
             return
         
-        # Reset the password
-        result = db.reset_password(token, new_password)
+        # Passwords and emails are redacted by the log formatter
+        log.debug("Request", extra={'fields': {
+            'route': route_label(self.path), 'client': self.client_address[0],
+            'method': self.command, 'path': self.path, 'data': data
+        }})
         
-        if 'error' in result:
-            self._send_response(400, {"error": result['error']})
-        else:
-            self._send_response(200, {
-                "message": "Password reset successfully! You can now login with your new password."
-            })
+        status_code, payload = dispatch(self.path, data, self.client_address[0],
+                                        self.headers.get('Authorization'))
+        self._send_response(status_code, payload)
 
-def run_server():
-    if not db.init_db():
-        print("Failed to initialize database. Exiting.")
-        return
-    
-    # Create and start server
-    server = HTTPServer((Config.SERVER_HOST, Config.SERVER_PORT), APIHandler)
-    print(f"Server running on http://{Config.SERVER_HOST}:{Config.SERVER_PORT}")
+def _print_endpoints():
     print("Endpoints:")
     print("  POST /register        - Register new user")
     print("  POST /login           - Login user (with email or user_id)")
     print("  POST /forgot-password - Request password reset")
     print("  POST /verify-token    - Check if reset token is valid")
     print("  POST /reset-password  - Reset password with token")
+    print("  POST /register/batch     - Register a JSON array of users")
+    print("  POST /verify-token/batch - Check a JSON array of reset tokens")
+    print("  GET  /me              - Current user from a Bearer access token")
+    print("  POST /refresh         - New access/refresh tokens for a refresh token")
+    print("  POST /logout          - End the session")
+    print("  GET  /metrics         - Prometheus metrics")
+
+def _after_fork(number):
+    # Each worker issues user ids under its own node number
+    ids.set_worker(number)
+    # and runs its share of the host's hashing processes
+    hash_executor.share_host(Config.SERVER_WORKERS)
+    # One sweeper, in worker 1. Not in the supervisor: a fork while its
+    # thread is inside the database driver copies the driver's locks held,
+    # and the new worker hangs on its first query
+    if number == 1:
+        sweeper.start()
+
+def run_server():
+    logs.setup()
+    if not db.init_db():
+        print("Failed to initialize database. Exiting.")
+        return
+    
+    # Create and start server
+    server = make_server(APIHandler)
+    print(f"Server running on http://{Config.SERVER_HOST}:{Config.SERVER_PORT} ({Config.SERVER_MODE} mode)")
+    _print_endpoints()
+    
+    if Config.SERVER_MODE == 'prefork' and hasattr(os, 'fork'):
+        if Config.SERVER_WORKERS > ids.MAX_SERVER_WORKER:
+            print(f"SERVER_WORKERS can be at most {ids.MAX_SERVER_WORKER}. Exiting.")
+            return
+        # Workers open their own connections after the fork
+        db.close_pool()
+        serve_prefork(server, Config.SERVER_WORKERS, Config.SERVER_SHUTDOWN_TIMEOUT,
+                      after_fork=_after_fork)
+    else:
+        sweeper.start()
+        serve(server, Config.SERVER_SHUTDOWN_TIMEOUT)
+    sweeper.stop()
+    hash_executor.shutdown()
+
+def run_async_server():
+    """Serve the same routes on an asyncio event loop"""
+    logs.setup()
+    if not db.init_db():
+        print("Failed to initialize database. Exiting.")
+        return
     
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print("\n Shutting down server...")
-        server.server_close()
+    print(f"Server running on http://{Config.SERVER_HOST}:{Config.SERVER_PORT} (async mode)")
+    _print_endpoints()
+    sweeper.start()
+    serve_async(Config.SERVER_SHUTDOWN_TIMEOUT)
+    sweeper.stop()
+    hash_executor.shutdown()
 
 if __name__ == '__main__':
-    run_server()
+    if Config.SERVER_MODE == 'async' or '--async' in sys.argv[1:]:
+        run_async_server()
+    else:
+        run_server()
@@ -0,0 +1,306 @@
+"""asyncio HTTP/1.1 server for the API routes.
+
+One coroutine per connection instead of one thread, so idle keep-alive
+clients cost a few KB each. Route handlers in routes.py are blocking
+(database.py uses mysql-connector), so they run on a dedicated thread pool
+sized to the database pool; the event loop itself never touches MySQL.
+"""
+import asyncio
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from config import Config
+from routes import dispatch, parse_body, response_headers, route_label, render_metrics
+import codec
+import compression
+import logs
+import metrics
+
+log = logs.get_logger('async_server')
+
+MAX_HEADER_BYTES = 16 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class AsyncAPIServer:
+    """Serve the routes in routes.py on an asyncio event loop"""
+
+    def __init__(self, host, port, db_threads=10, max_connections=10000,
+                 keepalive_timeout=15, backlog=128, max_keepalive_requests=100):
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max(max_keepalive_requests, 1)
+        self.backlog = backlog
+        self.max_connections = max(max_connections, 1)
+        self.connections = 0
+        self.inflight = 0
+        self._executor = ThreadPoolExecutor(max_workers=max(db_threads, 1),
+                                            thread_name_prefix='api-db')
+        self._slots = None
+        self._server = None
+        self._writers = set()
+        self._busy = set()     # writers of connections with a request in progress
+        self._closing = False
+
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.max_connections)
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port,
+            backlog=self.backlog, limit=MAX_HEADER_BYTES
+        )
+
+    async def stop(self, timeout):
+        """Stop accepting, wait up to `timeout` seconds for in-flight requests"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._closing = True
+        self._server.close()
+
+        # Idle keep-alive connections are just waiting for the next request;
+        # busy ones answer with Connection: close and then end
+        for writer in list(self._writers - self._busy):
+            writer.close()
+        while self.inflight and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.inflight:
+            print(f"Shutdown timeout: {self.inflight} request(s) still running")
+        for writer in list(self._writers):
+            writer.close()
+
+        # Only now: since Python 3.12 wait_closed() also waits for every
+        # connection, and an idle keep-alive one never ends by itself
+        try:
+            await asyncio.wait_for(self._server.wait_closed(), max(deadline - loop.time(), 1))
+        except asyncio.TimeoutError:
+            pass
+        self._executor.shutdown(wait=False)
+
+    async def _handle_connection(self, reader, writer):
+        async with self._slots:
+            self.connections += 1
+            self._writers.add(writer)
+            try:
+                served = 1
+                while await self._handle_request(reader, writer,
+                                                 served >= self.max_keepalive_requests):
+                    served += 1
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except Exception as e:
+                log.error("Error handling connection", extra={'fields': {'error': str(e)}})
+            finally:
+                self.connections -= 1
+                self._writers.discard(writer)
+                writer.close()
+
+    async def _handle_request(self, reader, writer, last=False):
+        """Serve one request; returns True if the connection stays open.
+        `last` closes it after this one regardless of what the client asked"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                          self.keepalive_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False
+        except asyncio.LimitOverrunError:
+            await self._write(writer, 'HTTP/1.1', 'POST', '-', 431,
+                              {"error": "Request headers too large"}, False)
+            return False
+
+        self.inflight += 1
+        self._busy.add(writer)
+        try:
+            try:
+                method, path, version, headers = _parse_head(head)
+                body = await self._read_body(reader, headers)
+            except HTTPError as e:
+                await self._write(writer, 'HTTP/1.1', '-', '-', e.status_code,
+                                  {"error": e.message}, False)
+                return False
+
+            keep_alive = _keep_alive(version, headers) and not last and not self._closing
+            accept_encoding = headers.get('accept-encoding')
+            peer = writer.get_extra_info('peername') or ('-',)
+            label = route_label(path)
+            started = metrics.request_started(label)
+
+            if method == 'GET' and path == '/metrics':
+                await self._write(writer, version, method, path, 200, render_metrics(),
+                                  keep_alive, started, 'text/plain; version=0.0.4', accept_encoding)
+                return keep_alive
+
+            if method == 'GET' and path == '/me':
+                # Signature check only, no database: cheap enough for the loop
+                status_code, payload = dispatch(path, {}, peer[0], headers.get('authorization'))
+                await self._write(writer, version, method, path, status_code,
+                                  payload, keep_alive, started, accept_encoding=accept_encoding)
+                return keep_alive
+
+            if method == 'GET':
+                # As the threaded server answers a GET it has no route for
+                await self._write(writer, version, method, path, 404,
+                                  {"error": "Endpoint not found"}, keep_alive, started)
+                return keep_alive
+
+            if method != 'POST':
+                await self._write(writer, version, method, path, 501,
+                                  {"error": f"Unsupported method ({method})"},
+                                  keep_alive, started)
+                return keep_alive
+
+            try:
+                with metrics.stage('parse', label):
+                    data = parse_body(body)
+            except Exception as e:
+                log.warning("Error reading POST data", extra={'fields': {'route': label, 'error': str(e)}})
+                data = {}
+
+            # Passwords and emails are redacted by the log formatter
+            log.debug("Request", extra={'fields': {
+                'route': label, 'client': peer[0], 'method': method, 'path': path, 'data': data
+            }})
+
+            loop = asyncio.get_running_loop()
+            status_code, payload = await loop.run_in_executor(
+                self._executor, dispatch, path, data, peer[0], headers.get('authorization')
+            )
+            await self._write(writer, version, method, path, status_code,
+                              payload, keep_alive, started, accept_encoding=accept_encoding)
+            return keep_alive
+        finally:
+            self.inflight -= 1
+            self._busy.discard(writer)
+
+    async def _read_body(self, reader, headers):
+        try:
+            content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if content_length < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        if content_length > Config.SERVER_MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+        if content_length == 0:
+            return b''
+        return await asyncio.wait_for(reader.readexactly(content_length),
+                                      self.keepalive_timeout)
+
+    async def _write(self, writer, version, method, path, status_code, data,
+                     keep_alive, started=None, content_type='application/json',
+                     accept_encoding=None):
+        """Send JSON response"""
+        label = route_label(path)
+        recorded_status = 500
+        elapsed = None
+        try:
+            with metrics.stage('serialize', label):
+                if content_type == 'application/json':
+                    response_data = codec.dumps(data)
+                else:
+                    response_data = data.encode('utf-8')
+                response_data, encoding_headers = compression.encode(response_data, accept_encoding)
+            recorded_status = status_code
+        finally:
+            # Record before drain() so a client that hangs up can't leak in-flight
+            if started is not None:
+                elapsed = metrics.request_finished(label, recorded_status, started)
+        reason = _reason(status_code)
+        extra = ''.join(f"{name}: {value}\r\n"
+                        for name, value in {**encoding_headers,
+                                            **(response_headers(status_code, data) or {})}.items())
+        head = (
+            f"HTTP/1.1 {status_code} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(response_data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"{extra}"
+            f"\r\n"
+        ).encode('latin-1')
+        writer.write(head + response_data)
+        await writer.drain()
+
+        log.info("Response", extra={'fields': {
+            'route': label, 'client': (writer.get_extra_info('peername') or ('-',))[0],
+            'method': method, 'path': path, 'status': status_code,
+            'duration_ms': None if elapsed is None else round(elapsed * 1000, 3)
+        }})
+
+
+def _parse_head(head):
+    try:
+        lines = head.decode('latin-1').split('\r\n')
+        method, path, version = lines[0].split(' ')
+    except ValueError:
+        raise HTTPError(400, "Bad request line")
+    if not version.startswith('HTTP/1.'):
+        raise HTTPError(505, "HTTP version not supported")
+
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HTTPError(400, "Bad header line")
+        headers[name.strip().lower()] = value.strip()
+    if 'transfer-encoding' in headers:
+        raise HTTPError(501, "Transfer-Encoding is not supported")
+    return method, path, version, headers
+
+
+def _keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def _reason(status_code):
+    try:
+        return HTTPStatus(status_code).phrase
+    except ValueError:
+        return ''
+
+
+def serve_async(shutdown_timeout=None):
+    """Run the asyncio server until SIGINT/SIGTERM"""
+    if shutdown_timeout is None:
+        shutdown_timeout = Config.SERVER_SHUTDOWN_TIMEOUT
+    server = AsyncAPIServer(
+        Config.SERVER_HOST,
+        Config.SERVER_PORT,
+        db_threads=Config.ASYNC_DB_THREADS,
+        max_connections=Config.ASYNC_MAX_CONNECTIONS,
+        keepalive_timeout=Config.ASYNC_KEEPALIVE_TIMEOUT,
+        backlog=Config.SERVER_BACKLOG,
+        max_keepalive_requests=Config.SERVER_MAX_KEEPALIVE_REQUESTS
+    )
+
+    async def main():
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopping.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows: fall back to KeyboardInterrupt
+                pass
+
+        await server.start()
+        try:
+            await stopping.wait()
+        finally:
+            print(f"\n Shutting down server (pid {os.getpid()})...")
+            await server.stop(shutdown_timeout)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
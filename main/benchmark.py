@@ -0,0 +1,403 @@
+"""Load test and micro-benchmarks for the API.
+
+    python benchmark.py --clients 32 --duration 20 --json results.json
+    python benchmark.py --mode async --mix login=8,register=1,verify=1
+    python benchmark.py --keep-alive    # one persistent connection per client
+    python benchmark.py --skip-load --skip-micro --inserts 1000000
+
+Starts API.run_server (or run_async_server) in a child process with
+STORAGE_BACKEND=memory, so no MySQL server is needed. --mode prefork
+uses a temporary SQLite file instead: each forked worker would hold its
+own memory store, so a user registered through one worker would be
+unknown to the others. Password
+hashing still goes through hash_executor with the configured hasher, so
+hashing cost is measured for real. Results are printed as a table and can
+be written as JSON to diff between releases.
+
+--inserts N fills an empty users table with N rows twice, once with
+random ids and once with time-ordered ones (ids.py), and compares insert
+rates. It uses a temporary SQLite file, or with --insert-backend mysql the
+DB_* database, which should be a scratch one: the rows are deleted after.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import sys
+import threading
+import time
+import timeit
+import uuid
+from collections import deque
+from datetime import datetime
+
+ROUTES = {
+    'register': '/register',
+    'login': '/login',
+    'forgot': '/forgot-password',
+    'verify': '/verify-token',
+    'reset': '/reset-password',
+}
+DEFAULT_MIX = 'register=1,login=6,forgot=1,verify=1,reset=1'
+PASSWORD = 'Bench-Pass-123!'
+
+
+def _serve(host, port, mode, quiet, sqlite_path=None):
+    """Child process: run the real server against the memory backend, or SQLite if given a path"""
+    if quiet:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+    from config import Config
+    if sqlite_path:
+        Config.STORAGE_BACKEND = 'sqlite'
+        Config.SQLITE_PATH = sqlite_path
+    else:
+        Config.STORAGE_BACKEND = 'memory'
+    # Every client is 127.0.0.1; per-IP limits would measure the limiter
+    Config.RATE_LIMIT_ENABLED = False
+    Config.SERVER_HOST = host
+    Config.SERVER_PORT = port
+    Config.SERVER_MODE = mode
+    import API
+    if mode == 'async':
+        API.run_async_server()
+    else:
+        API.run_server()
+
+
+class Workload:
+    """Shared state for the client threads: known users and live reset tokens"""
+
+    def __init__(self, host, port, mix, keep_alive=False):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self._local = threading.local()
+        self.routes = list(mix)
+        self.weights = [mix[r] for r in self.routes]
+        self.users = []
+        self.tokens = deque(maxlen=10000)
+        self.latencies = {r: [] for r in ROUTES}
+        self.statuses = {r: {} for r in ROUTES}
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if not self.keep_alive:
+            return http.client.HTTPConnection(self.host, self.port, timeout=30)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Reconnects by itself after the server closes the connection
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return conn
+
+    def request(self, route, body):
+        conn = self._connection()
+        failed = False
+        try:
+            start = time.perf_counter()
+            conn.request('POST', ROUTES[route], json.dumps(body),
+                         {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            payload = response.read()
+            elapsed = time.perf_counter() - start
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            elapsed, status, payload = None, 'conn_error', b'{}'
+            failed = True
+        finally:
+            if failed or not self.keep_alive:
+                conn.close()
+        with self._lock:
+            if elapsed is not None:
+                self.latencies[route].append(elapsed)
+            self.statuses[route][status] = self.statuses[route].get(status, 0) + 1
+        try:
+            return status, json.loads(payload)
+        except ValueError:
+            return status, {}
+
+    def register(self):
+        email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+        status, _ = self.request('register', {"name": "Bench User", "email": email,
+                                              "password": PASSWORD})
+        if status == 201:
+            with self._lock:
+                self.users.append(email)
+
+    def run_one(self, rng):
+        route = rng.choices(self.routes, self.weights)[0]
+        if route == 'register' or not self.users:
+            return self.register()
+        email = rng.choice(self.users)
+        if route == 'login':
+            # One in ten logins uses a wrong password, like real traffic
+            password = PASSWORD if rng.random() > 0.1 else 'Wrong-Pass-123!'
+            self.request('login', {"email": email, "password": password})
+        elif route == 'forgot':
+            status, body = self.request('forgot', {"email": email})
+            if 'reset_token' in body:
+                self.tokens.append(body['reset_token'])
+        elif route == 'verify':
+            token = self.tokens[-1] if self.tokens else 'RESET-UNKNOWN'
+            self.request('verify', {"token": token})
+        elif route == 'reset':
+            try:
+                token = self.tokens.popleft()
+            except IndexError:
+                token = 'RESET-UNKNOWN'
+            # Same password again so logins keep working
+            self.request('reset', {"token": token, "new_password": PASSWORD})
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def _summarize(values, elapsed):
+    values = sorted(values)
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        "requests": len(values),
+        "throughput_rps": round(len(values) / elapsed, 1) if elapsed else 0,
+        "p50_ms": ms(_percentile(values, 50)),
+        "p95_ms": ms(_percentile(values, 95)),
+        "p99_ms": ms(_percentile(values, 99)),
+        "max_ms": ms(values[-1] if values else None),
+    }
+
+
+def run_load(host, port, mix, clients, duration, seed_users, keep_alive=False):
+    workload = Workload(host, port, mix, keep_alive)
+    for _ in range(seed_users):
+        workload.register()
+    # Seeding is setup, not part of the measurement
+    workload.latencies = {r: [] for r in ROUTES}
+    workload.statuses = {r: {} for r in ROUTES}
+
+    deadline = time.perf_counter() + duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            workload.run_one(rng)
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for route in ROUTES:
+        summary = _summarize(workload.latencies[route], elapsed)
+        summary["status_codes"] = {str(k): v for k, v in sorted(workload.statuses[route].items(), key=str)}
+        routes[route] = summary
+    total = [v for values in workload.latencies.values() for v in values]
+    return {"elapsed_s": round(elapsed, 2), "total": _summarize(total, elapsed), "routes": routes}
+
+
+def run_micro(number):
+    """Per-call cost of the CPU-bound helpers, without the server"""
+    import codec
+    import utils
+    stored = utils.hash_password(PASSWORD)
+    body = json.dumps({"name": "Bench User", "email": "bench@example.com", "password": PASSWORD}).encode()
+    form = b"name=Bench+User&email=bench%40example.com&password=Bench-Pass-123%21"
+    response = {"message": "Login successful", "user_id": "USR-01A14B210E3C00400000-2A1",
+                "name": "Bench User", "email": "bench@example.com", "token_type": "Bearer",
+                "expires_in": 900}
+    cases = {
+        "hash_password": (lambda: utils.hash_password(PASSWORD), max(number // 100, 3)),
+        "verify_password": (lambda: utils.verify_password(stored, PASSWORD), max(number // 100, 3)),
+        "is_valid_email": (lambda: utils.is_valid_email('someone.name+tag@example.co.uk'), number),
+        "validate_password_strength": (lambda: utils.validate_password_strength(PASSWORD), number),
+        # codec uses orjson when installed; the stdlib rows are the baseline it replaces
+        f"parse_body_json[{codec.NAME}]": (lambda: codec.parse_body(body), number),
+        "parse_body_json[stdlib]": (lambda: json.loads(body.decode('utf-8')), number),
+        "parse_body_form": (lambda: codec.parse_body(form), number),
+        f"dumps[{codec.NAME}]": (lambda: codec.dumps(response), number),
+        "dumps[stdlib]": (lambda: json.dumps(response).encode('utf-8'), number),
+    }
+    results = {}
+    for name, (fn, n) in cases.items():
+        best = min(timeit.repeat(fn, number=n, repeat=3)) / n
+        results[name] = {"calls": n, "us_per_call": round(best * 1e6, 3),
+                         "ops_per_s": round(1 / best, 1) if best else None}
+    return results
+
+
+def _random_user_id(email):
+    """The old random scheme, padded to the length of the new ids"""
+    import utils
+    return f"USR-{uuid.uuid4().hex[:20].upper()}-{utils.email_bucket(email):03X}"
+
+def run_inserts(rows, batch_size, backend):
+    """Insert rate into a growing users table, random ids against ordered ones.
+
+    Random keys land all over the primary key's B-tree, so once it outgrows
+    the cache most inserts read and dirty a different page; ordered keys
+    append at the right-hand edge.
+    """
+    import tempfile
+    import storage
+    import utils
+    stored = utils.hash_password(PASSWORD)
+    results = {}
+    for kind, make_id in (("random", _random_user_id), ("ordered", utils.generate_user_id)):
+        with tempfile.TemporaryDirectory() as tmp:
+            if backend == 'sqlite':
+                store = storage.SQLiteStorage(os.path.join(tmp, 'users.db'))
+            else:
+                store = storage.MySQLStorage()
+            store.initialize()
+            ids = []
+            batch_rates = []
+            started = time.perf_counter()
+            try:
+                for first in range(0, rows, batch_size):
+                    users = []
+                    for i in range(first, min(first + batch_size, rows)):
+                        email = f"bench-{kind}-{i}@example.com"
+                        users.append({"id": make_id(email), "name": "Bench User", "email": email,
+                                      "password_hash": stored, "hash_algorithm": "bench"})
+                    batch_started = time.perf_counter()
+                    store.insert_users(users)
+                    batch_rates.append(len(users) / (time.perf_counter() - batch_started))
+                    ids.extend(u['id'] for u in users)
+                elapsed = time.perf_counter() - started
+            finally:
+                if backend != 'sqlite':
+                    for first in range(0, len(ids), batch_size):
+                        store.delete_users(ids[first:first + batch_size])
+                store.close()
+        # The last tenth shows the rate once the table is large
+        tail = batch_rates[-max(len(batch_rates) // 10, 1):]
+        results[kind] = {"rows": rows, "elapsed_s": round(elapsed, 2),
+                         "rows_per_s": round(rows / elapsed, 1),
+                         "last_10pct_rows_per_s": round(sum(tail) / len(tail), 1)}
+    return {"backend": backend, "batch_size": batch_size, "ids": results}
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route '{name}' (choose from {', '.join(ROUTES)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+def _wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=1)
+            conn.connect()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def _print_table(results):
+    load = results.get("load")
+    if load:
+        print(f"\n{'route':<10}{'requests':>10}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  status codes")
+        for route, s in list(load["routes"].items()) + [("total", load["total"])]:
+            codes = ' '.join(f"{k}:{v}" for k, v in s.get("status_codes", {}).items())
+            fmt = lambda v: '-' if v is None else f"{v:.2f}"
+            print(f"{route:<10}{s['requests']:>10}{s['throughput_rps']:>10}"
+                  f"{fmt(s['p50_ms']):>10}{fmt(s['p95_ms']):>10}{fmt(s['p99_ms']):>10}  {codes}")
+    micro = results.get("micro")
+    if micro:
+        print(f"\n{'function':<28}{'us/call':>12}{'ops/s':>14}")
+        for name, m in micro.items():
+            print(f"{name:<28}{m['us_per_call']:>12.2f}{m['ops_per_s']:>14.1f}")
+    inserts = results.get("inserts")
+    if inserts:
+        print(f"\n{'ids (' + inserts['backend'] + ')':<14}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'last 10%':>12}")
+        for kind, r in inserts["ids"].items():
+            print(f"{kind:<14}{r['rows']:>10}{r['elapsed_s']:>10.2f}{r['rows_per_s']:>12.1f}"
+                  f"{r['last_10pct_rows_per_s']:>12.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API load test and micro-benchmarks")
+    parser.add_argument('--mode', default='threaded', choices=['single', 'threaded', 'prefork', 'async'])
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--clients', type=int, default=16, help="Concurrent client threads")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of load")
+    parser.add_argument('--mix', type=_parse_mix, default=_parse_mix(DEFAULT_MIX),
+                        help=f"Route weights (default {DEFAULT_MIX})")
+    parser.add_argument('--keep-alive', action='store_true',
+                        help="Reuse one connection per client instead of one per request")
+    parser.add_argument('--seed-users', type=int, default=50, help="Users registered before measuring")
+    parser.add_argument('--micro-calls', type=int, default=10000)
+    parser.add_argument('--skip-load', action='store_true')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--inserts', type=int, default=0,
+                        help="Rows for the random vs time-ordered id insert benchmark (0 skips it)")
+    parser.add_argument('--insert-batch', type=int, default=1000, help="Rows per INSERT")
+    parser.add_argument('--insert-backend', default='sqlite', choices=['sqlite', 'mysql'])
+    parser.add_argument('--verbose', action='store_true', help="Show the server's request log")
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args(argv)
+
+    from config import Config
+    results = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "mode": args.mode, "clients": args.clients, "duration_s": args.duration,
+            "keep_alive": args.keep_alive,
+            "mix": args.mix, "password_hasher": Config.PASSWORD_HASHER,
+            "hash_workers": Config.HASH_WORKERS,
+            "storage": 'sqlite' if args.mode == 'prefork' else 'memory',
+        },
+    }
+
+    if not args.skip_micro:
+        results["micro"] = run_micro(args.micro_calls)
+
+    if args.inserts:
+        results["inserts"] = run_inserts(args.inserts, args.insert_batch, args.insert_backend)
+
+    if not args.skip_load:
+        import tempfile
+        host = '127.0.0.1'
+        with tempfile.TemporaryDirectory() as tmp:
+            # Prefork workers share nothing in memory, so they need a shared file
+            sqlite_path = os.path.join(tmp, 'users.db') if args.mode == 'prefork' else None
+            server = multiprocessing.get_context('spawn').Process(
+                target=_serve, args=(host, args.port, args.mode, not args.verbose, sqlite_path))
+            server.start()
+            try:
+                if not _wait_for_port(host, args.port, 30):
+                    sys.exit("Server did not start")
+                results["load"] = run_load(host, args.port, args.mix, args.clients,
+                                           args.duration, args.seed_users, args.keep_alive)
+            finally:
+                os.kill(server.pid, signal.SIGTERM)
+                server.join(Config.SERVER_SHUTDOWN_TIMEOUT + 5)
+
+    _print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""Breached-password blocklist: a sorted file of SHA-1 prefixes, memory-mapped.
+
+    python blocklist.py build pwned-passwords-sha1.txt rockyou.txt -o breached.bin
+    python blocklist.py bench breached.bin
+
+File layout: a 16-byte header (magic, version, width, entry count)
+followed by the first 8 bytes of SHA1(password) for every entry, sorted
+and unique. 100 million passwords are 800 MB on disk and a chance false
+match is about one in 10**11; nothing is loaded into the Python heap.
+Lookups search the mapping, so only the pages a search touches are read,
+and because the mapping is shared and read-only every pre-forked worker
+uses the same page-cache copy.
+
+Inputs to `build` are text files with either a password per line or
+Have I Been Pwned style 'SHA1HEX[:count]' lines. Matching is exact (the
+password as typed, UTF-8), like the breach corpora themselves.
+"""
+import argparse
+import hashlib
+import heapq
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import time
+
+MAGIC = b'PWBL'
+VERSION = 1
+HEADER = struct.Struct('>4sBB2xQ')  # magic, version, width, padding, count
+WIDTH = 8
+ENTRY = struct.Struct('>Q')
+INTERPOLATION_PROBES = 8
+
+_SHA1_LINE = re.compile(rb'^([0-9A-Fa-f]{40})(?::\d+)?$')
+
+
+class BlocklistError(Exception):
+    pass
+
+
+def digest(password):
+    return hashlib.sha1(password.encode('utf-8')).digest()[:WIDTH]
+
+
+class Blocklist:
+    """Read-only view of a compiled blocklist file"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise BlocklistError(f"{path}: empty file")
+        if len(self._map) < HEADER.size:
+            raise BlocklistError(f"{path}: truncated header")
+        magic, version, width, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or width != WIDTH:
+            raise BlocklistError(f"{path}: not a version {VERSION} blocklist")
+        if len(self._map) != HEADER.size + WIDTH * self.count:
+            raise BlocklistError(f"{path}: size does not match {self.count} entries")
+        if hasattr(mmap, 'MADV_RANDOM'):
+            # Searches jump around; readahead would only pull in unused pages
+            self._map.madvise(mmap.MADV_RANDOM)
+
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_seconds = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, password):
+        started = time.perf_counter()
+        found = self._search(digest(password))
+        self.lookups += 1
+        self.hits += found
+        self.lookup_seconds += time.perf_counter() - started
+        return found
+
+    def _search(self, key):
+        # SHA-1 prefixes are uniform, so interpolating where the key should
+        # sit takes about five probes where bisection takes log2(count).
+        # Bisection takes over if interpolation hasn't converged.
+        data, base, unpack = self._map, HEADER.size, ENTRY.unpack_from
+        target = ENTRY.unpack(key)[0]
+        lo, hi = 0, self.count
+        # Every entry in [lo, hi) is in [lo_key, hi_key)
+        lo_key, hi_key = 0, 1 << (8 * WIDTH)
+        probes = 0
+        while lo < hi:
+            if probes < INTERPOLATION_PROBES:
+                mid = lo + (target - lo_key) * (hi - lo) // (hi_key - lo_key)
+            else:
+                mid = (lo + hi) // 2
+            probes += 1
+            value = unpack(data, base + mid * WIDTH)[0]
+            if value < target:
+                lo, lo_key = mid + 1, value + 1
+            elif value > target:
+                hi, hi_key = mid, value
+            else:
+                return True
+        return False
+
+    def resident_bytes(self):
+        """Bytes of the mapping in this process's RSS (Linux), else None.
+        Shared pages are counted in every process that has touched them"""
+        try:
+            with open('/proc/self/smaps', 'rb') as f:
+                in_mapping = False
+                target = self.path.encode()
+                for line in f:
+                    if b'-' in line.split(b' ', 1)[0]:
+                        in_mapping = line.rstrip().endswith(target)
+                    elif in_mapping and line.startswith(b'Rss:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stats(self):
+        return {
+            "entries": self.count,
+            "file_bytes": len(self._map),
+            "resident_bytes": self.resident_bytes(),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "lookup_us_avg": round(self.lookup_seconds / self.lookups * 1e6, 3) if self.lookups else 0.0,
+        }
+
+    def close(self):
+        self._map.close()
+
+
+# --- Building ---
+
+def _entries(paths):
+    """Digest prefix for every line of every input file"""
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    continue
+                match = _SHA1_LINE.match(line)
+                if match:
+                    yield bytes.fromhex(match.group(1).decode('ascii'))[:WIDTH]
+                else:
+                    yield hashlib.sha1(line).digest()[:WIDTH]
+
+def _read_run(f):
+    while True:
+        entry = f.read(WIDTH)
+        if len(entry) < WIDTH:
+            return
+        yield entry
+
+def build(paths, output, chunk_size=5_000_000):
+    """Compile `paths` into `output`; returns the number of unique entries.
+
+    Sorts `chunk_size` entries at a time into temporary runs and merges
+    them, so memory stays bounded however large the corpus is.
+    """
+    runs = []
+    try:
+        chunk = []
+        for entry in _entries(paths):
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                runs.append(_write_run(chunk))
+                chunk = []
+        if chunk or not runs:
+            runs.append(_write_run(chunk))
+
+        count = 0
+        tmp_output = output + '.tmp'
+        with open(tmp_output, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, VERSION, WIDTH, 0))
+            previous = None
+            for entry in heapq.merge(*(_read_run(run) for run in runs)):
+                if entry != previous:
+                    out.write(entry)
+                    count += 1
+                    previous = entry
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, WIDTH, count))
+        os.replace(tmp_output, output)
+        return count
+    finally:
+        for run in runs:
+            run.close()
+
+def _write_run(chunk):
+    chunk.sort()
+    run = tempfile.TemporaryFile()
+    run.write(b''.join(chunk))
+    run.seek(0)
+    return run
+
+
+def _bench(blocklist, lookups):
+    """Time misses (random passwords) and report the mapping's resident size"""
+    rng = random.Random(0)
+    passwords = [f"bench-{rng.getrandbits(64):016x}" for _ in range(lookups)]
+    started = time.perf_counter()
+    for password in passwords:
+        password in blocklist
+    elapsed = time.perf_counter() - started
+    stats = blocklist.stats()
+    resident = stats['resident_bytes']
+    print(f"{stats['entries']} entries, {stats['file_bytes'] / 1e6:.1f} MB file")
+    print(f"{elapsed / lookups * 1e6:.2f} us per lookup over {lookups} lookups")
+    print("resident: " + ("unknown" if resident is None else f"{resident / 1e6:.1f} MB"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Breached-password blocklist tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    make = commands.add_parser('build', help="Compile password or SHA-1 lists into a blocklist file")
+    make.add_argument('inputs', nargs='+', help="Text files: a password or SHA1[:count] per line")
+    make.add_argument('-o', '--output', required=True)
+    make.add_argument('--chunk-size', type=int, default=5_000_000, help="Entries sorted in memory at once")
+    check = commands.add_parser('check', help="Look up passwords given on stdin, one per line")
+    check.add_argument('path')
+    bench = commands.add_parser('bench', help="Time lookups and show resident memory")
+    bench.add_argument('path')
+    bench.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        started = time.perf_counter()
+        count = build(args.inputs, args.output, args.chunk_size)
+        print(f"Wrote {count} entries to {args.output} in {time.perf_counter() - started:.1f}s")
+    elif args.command == 'check':
+        blocklist = Blocklist(args.path)
+        for line in sys.stdin:
+            password = line.rstrip('\r\n')
+            print(f"{'breached' if password in blocklist else 'ok':8} {password}")
+    else:
+        _bench(Blocklist(args.path), args.lookups)
+
+
+if __name__ == '__main__':
+    main()
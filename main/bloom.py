@@ -0,0 +1,55 @@
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    """Bloom filter sized for `capacity` keys at `error_rate` false positives.
+
+    might_contain() never returns False for a key that was added, so a miss
+    is a definite "not present". Keys cannot be removed.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        bits = -self.capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = max(int(math.ceil(bits)), 8)
+        self.num_hashes = max(int(round(self.num_bits / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        # Setting a bit is a read-modify-write; a lost update would be a false negative
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for pos in positions:
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+
+    def might_contain(self, key):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    __contains__ = might_contain
+
+    def stats(self):
+        # Expected false-positive rate at the current fill
+        fill = 1 - math.exp(-self.num_hashes * self.count / self.num_bits)
+        return {
+            "count": self.count,
+            "capacity": self.capacity,
+            "num_bits": self.num_bits,
+            "num_hashes": self.num_hashes,
+            "memory_bytes": len(self._bits),
+            "target_error_rate": self.error_rate,
+            "estimated_error_rate": fill ** self.num_hashes,
+        }
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
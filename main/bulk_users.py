@@ -0,0 +1,347 @@
+"""Bulk import and export of the users table.
+
+    python bulk_users.py import users.csv --batch-size 1000 --report dupes.csv
+    python bulk_users.py export users.jsonl
+
+Input rows need name and email, plus either password (validated and hashed)
+or password_hash (an existing hash in a format hashers.py understands).
+age and dob are optional. Format is picked from the file extension unless
+--format is given.
+
+With DB_SHARDS set, each user goes to the shard owning their email's
+bucket, and export reads every shard in turn.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from utils import is_valid_email, normalize_email, validate_password_strength, generate_user_id
+from config import Config
+import hashers
+import ids
+import database as db
+import logs
+from mysql.connector import Error, IntegrityError
+
+log = logs.get_logger('bulk_users')
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+EXPORT_FIELDS = ['id', 'name', 'email', 'password_hash', 'age', 'dob', 'created_at']
+
+
+def _format(path, fmt):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def read_rows(path, fmt=None):
+    """Stream input rows as dicts"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if _format(path, fmt) == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def prepare_row(row):
+    """Validate and hash one input row; returns (record, None) or (None, error).
+
+    Runs in a worker process.
+    """
+    name = (row.get('name') or '').strip()
+    email = (row.get('email') or '').strip()
+    password = row.get('password') or ''
+    password_hash = row.get('password_hash') or ''
+
+    if not name or not email:
+        return None, "Name and email are required"
+    if not is_valid_email(email):
+        return None, "Invalid email format"
+
+    if password_hash:
+        # Pre-hashed input must be in a format we can verify at login:
+        # a registered prefix, or the legacy unprefixed salt$hash
+        prefix = password_hash.split('$', 1)[0]
+        if prefix not in hashers.HASHERS and password_hash.count('$') != 1:
+            return None, "Unrecognized password_hash format"
+    elif password:
+        is_strong, password_error = validate_password_strength(password)
+        if not is_strong:
+            return None, password_error
+        password_hash = hashers.make_password(password)
+    else:
+        return None, "Password or password_hash is required"
+
+    return {
+        "name": name,
+        "email": normalize_email(email),
+        "password_hash": password_hash,
+        "age": row.get('age') or None,
+        "dob": row.get('dob') or None,
+    }, None
+
+
+def _existing_emails(cursor, emails):
+    if not emails:
+        return set()
+    placeholders = ', '.join(['%s'] * len(emails))
+    cursor.execute(f"SELECT email FROM users WHERE email IN ({placeholders})", list(emails))
+    return {row[0] for row in cursor.fetchall()}
+
+def _insert_users(cursor, records):
+    """One multi-row INSERT for the whole batch, with new ids if one is taken"""
+    for attempt in range(1, db.ID_ATTEMPTS + 1):
+        try:
+            return _insert_batch(cursor, records)
+        except IntegrityError as e:
+            # Only the statement is rolled back; earlier batches stay pending
+            if e.errno != 1062 or 'PRIMARY' not in str(e) or attempt == db.ID_ATTEMPTS:
+                raise
+            log.warning("User id taken, retrying", extra={'fields': {'attempt': attempt, 'error': str(e)}})
+            for record in records:
+                record['id'] = generate_user_id(record['email'])
+
+def _insert_batch(cursor, records):
+    placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(records))
+    params = []
+    for r in records:
+        params.extend((r['id'], r['name'], r['email'], r['password_hash'],
+                       hashers.identify_hasher(r['password_hash']).algorithm, r['age'], r['dob']))
+    cursor.execute(f"""
+        INSERT INTO users (id, name, email, password_hash, hash_algorithm, age, dob)
+        VALUES {placeholders}
+    """, params)
+
+
+class _ShardConnections:
+    """A connection and cursor per shard (one, named None, when not sharded),
+    opened on first use and committed together"""
+
+    def __init__(self):
+        self._open = {}  # shard -> (conn, cursor)
+
+    def cursor(self, shard):
+        if shard not in self._open:
+            conn = db.get_connection(shard)
+            if not conn:
+                raise RuntimeError(f"Database connection failed{f' (shard {shard})' if shard else ''}")
+            self._open[shard] = (conn, conn.cursor())
+        return self._open[shard][1]
+
+    def commit(self):
+        for conn, _ in self._open.values():
+            conn.commit()
+
+    def close(self):
+        for conn, cursor in self._open.values():
+            cursor.close()
+            conn.close()
+
+
+def _group(items, key):
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
+
+
+def import_users(path, fmt=None, batch_size=1000, commit_every=10, workers=None,
+                 report_path=None):
+    """Import users from CSV/JSONL; returns a summary dict"""
+    stats = {"read": 0, "inserted": 0, "invalid": 0, "duplicates": 0}
+    report = None
+    report_file = None
+    if report_path:
+        report_file = open(report_path, 'w', newline='', encoding='utf-8')
+        report = csv.writer(report_file)
+        report.writerow(['line', 'email', 'reason'])
+
+    shards = _ShardConnections()
+    executor = ProcessPoolExecutor(max_workers=workers or None,
+                                   mp_context=multiprocessing.get_context('spawn'))
+    seen = set()  # emails earlier in this file
+    pending = 0   # batches since the last commit
+    opened = None  # when the oldest uncommitted batch was inserted
+    line = 0
+    try:
+        chunksize = max(batch_size // ((workers or 1) * 4), 1)
+        for batch in batches(read_rows(path, fmt), batch_size):
+            prepared = executor.map(prepare_row, batch, chunksize=chunksize)
+            records = []
+            for row, (record, error) in zip(batch, prepared):
+                line += 1
+                stats["read"] += 1
+                if error:
+                    stats["invalid"] += 1
+                    if report:
+                        report.writerow([line, row.get('email') or '', error])
+                    continue
+                if record['email'] in seen:
+                    stats["duplicates"] += 1
+                    if report:
+                        report.writerow([line, record['email'], "Duplicate email in file"])
+                    continue
+                seen.add(record['email'])
+                # Here rather than in prepare_row: ids are only unique per process (ids.py)
+                record['id'] = generate_user_id(record['email'])
+                records.append((line, record))
+
+            # While resharding an email may still be on its bucket's previous shard
+            owners = {r['email']: db.email_shards(r['email']) for _, r in records}
+            lookups = {}
+            for email, names in owners.items():
+                for shard in names:
+                    lookups.setdefault(shard, []).append(email)
+            existing = set()
+            for shard, emails in lookups.items():
+                existing |= _existing_emails(shards.cursor(shard), emails)
+            new_records = []
+            for row_line, record in records:
+                if record['email'] in existing:
+                    stats["duplicates"] += 1
+                    if report:
+                        report.writerow([row_line, record['email'], "Email already registered"])
+                else:
+                    new_records.append(record)
+
+            if new_records:
+                for shard, group in _group(new_records, lambda r: owners[r['email']][0]).items():
+                    _insert_users(shards.cursor(shard), group)
+                stats["inserted"] += len(new_records)
+                opened = opened or time.monotonic()
+            pending += 1
+            # Servers' user filters only look USER_FILTER_REFRESH_OVERLAP back
+            # for rows that commit after their created_at
+            overdue = opened is not None and time.monotonic() - opened >= Config.USER_FILTER_REFRESH_OVERLAP / 2
+            if pending >= commit_every or overdue:
+                shards.commit()
+                pending = 0
+                opened = None
+        shards.commit()
+    except Error:
+        print(f"Import stopped after {stats['read']} rows; uncommitted batches were rolled back")
+        raise
+    finally:
+        executor.shutdown()
+        shards.close()
+        if report_file:
+            report_file.close()
+    return stats
+
+
+def _export_shard(shard, write, batch_size):
+    conn = db.get_connection(shard)
+    if not conn:
+        raise RuntimeError(f"Database connection failed{f' (shard {shard})' if shard else ''}")
+    count = 0
+    cursor = None
+    try:
+        # Unbuffered cursor: rows stream from the server instead of fetchall().
+        # Primary key order streams without a sort, and ids are time-ordered
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        cursor.execute(f"SELECT {', '.join(EXPORT_FIELDS)} FROM users ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                write(row)
+            count += len(rows)
+    finally:
+        if cursor is not None:
+            cursor.close()
+        conn.close()
+    return count
+
+def export_users(path, fmt=None, batch_size=1000):
+    """Stream the users table to CSV/JSONL, shard by shard; returns the row count.
+
+    During a reshard (DB_SHARDS_PREVIOUS set) a moving user is on two shards
+    and is written twice.
+    """
+    fmt = _format(path, fmt)
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda row: f.write(json.dumps(row, default=str) + '\n')
+        for shard in db.shard_names():
+            count += _export_shard(shard, write, batch_size)
+    return count
+
+
+def _peak_memory_mb(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _report(rows, started):
+    elapsed = time.perf_counter() - started
+    rate = rows / elapsed if elapsed else 0
+    print(f"{rows} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+    if resource is not None:
+        # For children, the largest single hashing process, not their sum
+        print(f"Peak memory: {_peak_memory_mb(resource.RUSAGE_SELF):.1f} MB, "
+              f"largest worker {_peak_memory_mb(resource.RUSAGE_CHILDREN):.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk user import/export")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    imp = commands.add_parser('import', help="Import users from CSV/JSONL")
+    imp.add_argument('path')
+    imp.add_argument('--format', choices=['csv', 'jsonl'])
+    imp.add_argument('--batch-size', type=int, default=1000, help="Rows per INSERT")
+    imp.add_argument('--commit-every', type=int, default=10, help="Batches per commit")
+    imp.add_argument('--workers', type=int, default=None, help="Hashing processes (default: one per core)")
+    imp.add_argument('--report', help="Write skipped rows (duplicates, invalid) to this CSV")
+
+    exp = commands.add_parser('export', help="Export users to CSV/JSONL")
+    exp.add_argument('path')
+    exp.add_argument('--format', choices=['csv', 'jsonl'])
+    exp.add_argument('--batch-size', type=int, default=1000, help="Rows fetched per round trip")
+
+    args = parser.parse_args(argv)
+    logs.setup()
+    if not db.initialize_db():
+        sys.exit(1)
+
+    started = time.perf_counter()
+    if args.command == 'import':
+        # Not worker 0, which a single-process server on this host is using
+        ids.set_worker(ids.TOOL_WORKER)
+        stats = import_users(args.path, args.format, args.batch_size, args.commit_every,
+                             args.workers, args.report)
+        print(f"Inserted {stats['inserted']}, duplicates {stats['duplicates']}, invalid {stats['invalid']}")
+        _report(stats['read'], started)
+    else:
+        count = export_users(args.path, args.format, args.batch_size)
+        print(f"Exported to {args.path}")
+        _report(count, started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""JSON encoding and request body decoding for both servers.
+
+Uses orjson when it is installed (pip install orjson) and the standard
+library json module otherwise; NAME says which. Either way loads() takes
+bytes and dumps() returns UTF-8 bytes, so callers never re-encode.
+"""
+import json
+from urllib.parse import parse_qs
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+if orjson is not None:
+    NAME = 'orjson'
+    loads = orjson.loads
+    dumps = orjson.dumps
+else:
+    NAME = 'json'
+    loads = json.loads
+    _encoder = json.JSONEncoder()
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+# Both libraries raise a ValueError subclass on bad input
+DecodeError = ValueError
+
+# Bytes a JSON document can start with; nothing else can decode
+_JSON_STARTS = frozenset(b'{["-0123456789tfn')
+
+
+def parse_body(raw):
+    """Decode a request body as JSON, falling back to form data"""
+    if not raw:
+        return {}
+    # Only try JSON when it could be JSON; most form posts skip the failed decode
+    head = raw.lstrip()[:1]
+    if head and head[0] in _JSON_STARTS:
+        try:
+            return loads(raw)
+        except DecodeError:
+            pass
+    parsed_data = parse_qs(raw.decode('utf-8'))
+    return {key: value[0] for key, value in parsed_data.items()}
@@ -0,0 +1,39 @@
+"""gzip response bodies for clients that send Accept-Encoding: gzip.
+
+Shared by the threaded (API.py) and asyncio (async_server.py) servers.
+Bodies under GZIP_MIN_BYTES go out as-is: most API responses are a few
+hundred bytes, where compressing costs more CPU than it saves on the wire.
+"""
+import gzip
+from config import Config
+
+
+def accepts_gzip(accept_encoding):
+    """True if an Accept-Encoding header value allows gzip"""
+    wildcard = False
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if coding not in ('gzip', 'x-gzip', '*'):
+            continue
+        allowed = True
+        name, _, value = params.strip().partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                allowed = float(value) > 0
+            except ValueError:
+                allowed = False
+        if coding != '*':
+            return allowed
+        wildcard = allowed
+    return wildcard
+
+def encode(body, accept_encoding):
+    """(body, extra headers) for a response; gzipped if allowed and worth it"""
+    if not Config.GZIP_MIN_BYTES or len(body) < Config.GZIP_MIN_BYTES:
+        return body, {}
+    if not accepts_gzip(accept_encoding):
+        return body, {'Vary': 'Accept-Encoding'}
+    # mtime=0 keeps the output identical for identical bodies
+    compressed = gzip.compress(body, compresslevel=Config.GZIP_LEVEL, mtime=0)
+    return compressed, {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
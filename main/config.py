@@ -2,6 +2,12 @@
 import os
 
 class Config:
+    # Where users and reset tokens live: 'mysql', 'sqlite' or 'memory'
+    # (per process, lost on exit; for tests and benchmarks)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mysql')
+    SQLITE_PATH = os.getenv('SQLITE_PATH', 'user_system.db')
+    SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+
     DB_HOST = os.getenv('DB_HOST', 'localhost')
     DB_USER = os.getenv('DB_USER', 'your name')
     DB_PASSWORD = os.getenv('DB_PASSWORD', 'your password')
@@ -9,3 +15,164 @@ class Config:
     SERVER_HOST = os.getenv('SERVER_HOST', 'localhost')
 
     SERVER_PORT = int(os.getenv('SERVER_PORT', '8080'))
+
+    # Largest JSON array accepted by /register/batch and /verify-token/batch
+    MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '100'))
+
+    # Extra passwords to reject at registration and reset, one per line
+    # (case-insensitive); held in memory as a set by every process, so keep
+    # it short and put breach corpora in BREACHED_PASSWORDS_FILE instead
+    COMMON_PASSWORDS_FILE = os.getenv('COMMON_PASSWORDS_FILE', '')
+    # Compiled blocklist (`python blocklist.py build ...`), memory-mapped
+    BREACHED_PASSWORDS_FILE = os.getenv('BREACHED_PASSWORDS_FILE', '')
+
+    # Password hashing: 'scrypt' or 'pbkdf2_sha256' for new hashes.
+    # Tune with `python hashers.py calibrate --target-ms 250`
+    PASSWORD_HASHER = os.getenv('PASSWORD_HASHER', 'scrypt')
+    SCRYPT_N = int(os.getenv('SCRYPT_N', '16384'))
+    SCRYPT_R = int(os.getenv('SCRYPT_R', '8'))
+    SCRYPT_P = int(os.getenv('SCRYPT_P', '1'))
+    PBKDF2_ITERATIONS = int(os.getenv('PBKDF2_ITERATIONS', '600000'))
+    PASSWORD_HASH_TARGET_MS = float(os.getenv('PASSWORD_HASH_TARGET_MS', '250'))
+
+    # Hashing process pool; HASH_WORKERS=0 hashes on the request thread.
+    # HASH_WORKERS is for the whole host: pre-forked workers split it. A
+    # request waits up to HASH_QUEUE_WAIT seconds for one of HASH_MAX_QUEUE
+    # slots (default 4 per hashing process), then gets a 503
+    HASH_WORKERS = int(os.getenv('HASH_WORKERS', str(os.cpu_count() or 1)))
+    HASH_MAX_QUEUE = int(os.getenv('HASH_MAX_QUEUE', '0'))
+    HASH_QUEUE_WAIT = float(os.getenv('HASH_QUEUE_WAIT', '5'))
+    HASH_TIMEOUT = float(os.getenv('HASH_TIMEOUT', '30'))
+
+    # Connection pool shared by every request handler in the process
+    DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+    DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+    DB_POOL_IDLE_TIMEOUT = float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300'))
+    DB_POOL_HEALTH_CHECK = os.getenv('DB_POOL_HEALTH_CHECK', 'true').lower() in ('1', 'true', 'yes')
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+
+    # Read replicas, 'host[:port],...' with the primary's user, password and
+    # database. Login and reset-token lookups go to a healthy replica
+    # (round_robin or least_outstanding); keys this process wrote within
+    # DB_READ_YOUR_WRITES_WINDOW seconds are read from the primary.
+    # DB_REPLICA_MAX_LAG > 0 also takes replicas that far behind out of rotation
+    DB_REPLICAS = os.getenv('DB_REPLICAS', '')
+    DB_REPLICA_SELECTION = os.getenv('DB_REPLICA_SELECTION', 'round_robin')
+    DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '5'))
+    DB_REPLICA_MAX_LAG = int(os.getenv('DB_REPLICA_MAX_LAG', '0'))
+    DB_REPLICA_CONNECT_TIMEOUT = int(os.getenv('DB_REPLICA_CONNECT_TIMEOUT', '2'))
+    DB_READ_YOUR_WRITES_WINDOW = float(os.getenv('DB_READ_YOUR_WRITES_WINDOW', '5'))
+
+    # Shards, 'name=host[:port],...': users are spread over these servers by
+    # email hash (same credentials as above; DB_HOST and DB_REPLICAS are then
+    # unused). Names place shards on the hash ring, so keep them when a host
+    # changes. DB_SHARDS_PREVIOUS is the old list while reshard.py moves users
+    DB_SHARDS = os.getenv('DB_SHARDS', '')
+    DB_SHARDS_PREVIOUS = os.getenv('DB_SHARDS_PREVIOUS', '')
+
+    # New user ids are time-ordered (see ids.py). Hosts that register users
+    # at the same time need different ID_NODE values, 0-255
+    ID_NODE = int(os.getenv('ID_NODE', '0'))
+
+    # Login-path user cache; USER_CACHE_SIZE=0 disables it. Each process has its
+    # own; pre-forked workers share invalidations (user_cache.SharedStamps).
+    # Other hosts don't, so with several servers the TTL bounds staleness
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))
+
+    # Bloom filter of registered emails/ids, built at startup; misses skip MySQL.
+    # A miss first syncs rows added since the last sync, at most once per
+    # refresh interval; when it can't, the database is asked instead
+    USER_FILTER_ENABLED = os.getenv('USER_FILTER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    USER_FILTER_CAPACITY = int(os.getenv('USER_FILTER_CAPACITY', '1000000'))
+    USER_FILTER_ERROR_RATE = float(os.getenv('USER_FILTER_ERROR_RATE', '0.001'))
+    USER_FILTER_BATCH_SIZE = int(os.getenv('USER_FILTER_BATCH_SIZE', '10000'))
+    USER_FILTER_REFRESH_INTERVAL = float(os.getenv('USER_FILTER_REFRESH_INTERVAL', '1'))
+    # Every rescan interval a background thread rescans rows created up to
+    # USER_FILTER_REFRESH_OVERLAP seconds before its last run, catching rows
+    # whose insert committed later than its created_at
+    USER_FILTER_RESCAN_INTERVAL = float(os.getenv('USER_FILTER_RESCAN_INTERVAL', '10'))
+    USER_FILTER_REFRESH_OVERLAP = float(os.getenv('USER_FILTER_REFRESH_OVERLAP', '300'))
+
+    # Serving mode: 'single' (one request at a time), 'threaded', 'prefork' or 'async'
+    SERVER_MODE = os.getenv('SERVER_MODE', 'threaded')
+    SERVER_THREADS = int(os.getenv('SERVER_THREADS', '16'))
+    SERVER_MAX_INFLIGHT = int(os.getenv('SERVER_MAX_INFLIGHT', '64'))
+    SERVER_BACKLOG = int(os.getenv('SERVER_BACKLOG', '128'))
+    SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', str(os.cpu_count() or 1)))
+    SERVER_SHUTDOWN_TIMEOUT = float(os.getenv('SERVER_SHUTDOWN_TIMEOUT', '30'))
+
+    # HTTP/1.1 persistent connections. An idle connection is closed after
+    # SERVER_KEEPALIVE_TIMEOUT seconds and any connection after
+    # SERVER_MAX_KEEPALIVE_REQUESTS requests. In the threaded and prefork modes
+    # an open connection holds a worker thread, so keep the timeout short
+    SERVER_KEEPALIVE_TIMEOUT = float(os.getenv('SERVER_KEEPALIVE_TIMEOUT', '5'))
+    SERVER_MAX_KEEPALIVE_REQUESTS = int(os.getenv('SERVER_MAX_KEEPALIVE_REQUESTS', '100'))
+    # Larger request bodies get a 413
+    SERVER_MAX_BODY_BYTES = int(os.getenv('SERVER_MAX_BODY_BYTES', str(1024 * 1024)))
+
+    # gzip responses of at least GZIP_MIN_BYTES for clients that accept it; 0 disables
+    GZIP_MIN_BYTES = int(os.getenv('GZIP_MIN_BYTES', '1024'))
+    GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+
+    # asyncio server (SERVER_MODE=async); database calls run on their own threads
+    ASYNC_DB_THREADS = int(os.getenv('ASYNC_DB_THREADS', str(DB_POOL_MAX_SIZE)))
+    ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', '10000'))
+    ASYNC_KEEPALIVE_TIMEOUT = float(os.getenv('ASYNC_KEEPALIVE_TIMEOUT', '15'))
+
+    # Schema migrations (see migrations.py). Backfills update MIGRATION_BATCH_SIZE
+    # rows per statement and sleep MIGRATION_BATCH_PAUSE seconds between them
+    MIGRATE_ON_STARTUP = os.getenv('MIGRATE_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+    MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '1000'))
+    MIGRATION_BATCH_PAUSE = float(os.getenv('MIGRATION_BATCH_PAUSE', '0.05'))
+
+    # Per-process rate limits as 'requests/seconds' ('' disables one): every
+    # request per client IP (batch items count individually), and /login and
+    # /forgot-password per target account. Over the limit gets a 429
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    RATE_LIMIT_IP = os.getenv('RATE_LIMIT_IP', '50/1')
+    RATE_LIMIT_LOGIN = os.getenv('RATE_LIMIT_LOGIN', '10/60')
+    RATE_LIMIT_FORGOT = os.getenv('RATE_LIMIT_FORGOT', '3/3600')
+    RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+
+    # After LOGIN_LOCKOUT_THRESHOLD failed logins in a row an account is locked
+    # for LOGIN_LOCKOUT_BASE seconds, doubling per further failure up to
+    # LOGIN_LOCKOUT_MAX. The failure count is forgotten after LOGIN_LOCKOUT_RESET
+    # seconds without one, which must be well above LOGIN_LOCKOUT_MAX. Tracked
+    # in memory; a threshold of 0 disables it
+    LOGIN_LOCKOUT_THRESHOLD = int(os.getenv('LOGIN_LOCKOUT_THRESHOLD', '5'))
+    LOGIN_LOCKOUT_BASE = float(os.getenv('LOGIN_LOCKOUT_BASE', '1'))
+    LOGIN_LOCKOUT_MAX = float(os.getenv('LOGIN_LOCKOUT_MAX', '900'))
+    LOGIN_LOCKOUT_RESET = float(os.getenv('LOGIN_LOCKOUT_RESET', '86400'))
+
+    # Password reset tokens: 'table' stores them in password_reset_tokens,
+    # 'signed' issues HMAC-signed tokens that verify without the database.
+    # RESET_TOKEN_KEYS is 'id:secret,...'; the first key signs, all verify.
+    # RESET_TOKEN_MAX_PER_USER caps stored tokens per user (0 = no cap)
+    RESET_TOKEN_MODE = os.getenv('RESET_TOKEN_MODE', 'table')
+    RESET_TOKEN_KEYS = os.getenv('RESET_TOKEN_KEYS', '')
+    RESET_TOKEN_TTL = int(os.getenv('RESET_TOKEN_TTL', '3600'))
+    RESET_TOKEN_MAX_PER_USER = int(os.getenv('RESET_TOKEN_MAX_PER_USER', '3'))
+
+    # Login sessions: a signed access token checked without the database and
+    # a refresh token that rotates on every use. SESSION_KEYS works like
+    # RESET_TOKEN_KEYS; with none set a per-process key is used
+    SESSION_KEYS = os.getenv('SESSION_KEYS', '')
+    SESSION_ACCESS_TTL = int(os.getenv('SESSION_ACCESS_TTL', '900'))
+    SESSION_REFRESH_TTL = int(os.getenv('SESSION_REFRESH_TTL', '2592000'))
+
+    # Background deletion of expired reset tokens and sessions,
+    # RESET_TOKEN_SWEEP_BATCH rows per DELETE with a pause between batches;
+    # an interval of 0 disables it
+    RESET_TOKEN_SWEEP_INTERVAL = float(os.getenv('RESET_TOKEN_SWEEP_INTERVAL', '300'))
+    RESET_TOKEN_SWEEP_BATCH = int(os.getenv('RESET_TOKEN_SWEEP_BATCH', '500'))
+    RESET_TOKEN_SWEEP_PAUSE = float(os.getenv('RESET_TOKEN_SWEEP_PAUSE', '0.1'))
+
+    # Structured JSON logging. LOG_LEVELS overrides per module
+    # ('database=WARNING,routes=DEBUG'); LOG_SAMPLE_RATES keeps a fraction of
+    # below-WARNING records per route ('/login=0.1')
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+    LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1'))
+    LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
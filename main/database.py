@@ -1,104 +1,259 @@
-import mysql.connector
-from mysql.connector import Error
+import os
+import threading
+import time
 import uuid
 from datetime import datetime, timedelta
 from config import Config
-from utils import hash_password, verify_password, generate_user_id, normalize_email
+from utils import generate_user_id, normalize_email, email_bucket
+from utils import password_needs_rehash
 from utils import generate_reset_token, validate_password_strength
+import logs
+from hash_executor import hash_password, hash_passwords, verify_password, HashQueueFull
+from user_cache import UserCache
+from bloom import BloomFilter
+from hashers import identify_hasher
+import reset_tokens
+import sessions
+from storage import get_storage, StorageError, ConnectionFailed, DuplicateEmail, DuplicateId
 
-def create_connection():
+log = logs.get_logger('database')
+
+def get_connection(shard=None):
+    """Borrow a pooled MySQL connection (STORAGE_BACKEND=mysql only), for tools
+    such as bulk_users.py and migrations.py that run their own SQL. With
+    DB_SHARDS set, `shard` names the server"""
+    store = get_storage()
+    if store.name == 'sharded':
+        if shard is None:
+            raise RuntimeError("DB_SHARDS is set; name a shard")
+        store = store.shard(shard)
+    if store.name != 'mysql':
+        raise RuntimeError(f"Needs STORAGE_BACKEND=mysql, not {store.name}")
+    return store.get_connection()
+
+def pool_stats():
+    return get_storage().stats()
+
+def replica_stats():
+    """Read-replica health and routing counters, or None without DB_REPLICAS"""
+    return get_storage().replica_stats()
+
+def shard_stats():
+    """Shard routing counters, or None without DB_SHARDS"""
+    return get_storage().shard_stats()
+
+def shard_names():
+    """Shards to run per-server tools against, or [None] when not sharded"""
+    store = get_storage()
+    return list(store.shards) if store.name == 'sharded' else [None]
+
+def email_shards(email):
+    """Shards that may hold a normalized `email`, the one new users go to
+    first; [None] when not sharded"""
+    store = get_storage()
+    if store.name != 'sharded':
+        return [None]
+    return list(store.candidate_names(email_bucket(email)))
+
+def close_pool():
+    """Close pooled connections, e.g. before forking worker processes"""
+    get_storage().close()
+
+def _storage_error(e, message):
+    """Log a StorageError and turn it into the error response"""
+    if isinstance(e, ConnectionFailed):
+        log.error("Database connection failed")
+        return {"error": "Database connection failed"}
+    log.error(message, extra={'fields': {'error': str(e)}})
+    return {"error": f"Database error: {str(e)}"}
+
+user_cache = UserCache(max_entries=Config.USER_CACHE_SIZE, ttl=Config.USER_CACHE_TTL)
+
+def cache_stats():
+    return user_cache.stats()
+
+# Bloom filter of "email:<email>" and "id:<user id>" keys. A miss, once rows
+# added since the last sync are in, means the user does not exist, so the
+# SELECT can be skipped.
+_user_filter = None
+_filter_watermark = None   # DB time the filter is known complete up to (see user_watermark)
+_filter_refreshed_at = 0.0
+_filter_lock = threading.Lock()
+_rescan_watermark = None   # the same, USER_FILTER_REFRESH_OVERLAP earlier
+_rescanned_at = 0.0
+_rescan_lock = threading.Lock()
+
+def load_user_filter():
+    """Build the user filter by streaming the users table in batches"""
+    global _user_filter, _filter_watermark, _filter_refreshed_at, _rescan_watermark, _rescanned_at
+    if not Config.USER_FILTER_ENABLED:
+        return False
+    
+    store = get_storage()
     try:
-        conn = mysql.connector.connect(
-            host=Config.DB_HOST,
-            user=Config.DB_USER,
-            password=Config.DB_PASSWORD,
-            database=Config.DB_NAME,
-            auth_plugin='mysql_native_password'
-        )
-        return conn
-    except Error as e:
-        print(f"Database connection error: {e}")
-        return None
+        watermark, total = store.user_watermark()
+        rescan_watermark, _ = store.user_watermark(Config.USER_FILTER_REFRESH_OVERLAP)
+        
+        # Leave room for growth so the false-positive rate holds
+        user_filter = BloomFilter(max(Config.USER_FILTER_CAPACITY, total * 2),
+                                  Config.USER_FILTER_ERROR_RATE)
+        last_id = ''
+        while True:
+            rows = store.scan_users(last_id, Config.USER_FILTER_BATCH_SIZE)
+            if not rows:
+                break
+            for user_id, email in rows:
+                user_filter.add(f"email:{email}")
+                user_filter.add(f"id:{user_id}")
+            last_id = rows[-1][0]
+    except StorageError as e:
+        log.error("Database error loading user filter", extra={'fields': {'error': str(e)}})
+        return False
+    
+    with _filter_lock:
+        _user_filter = user_filter
+        _filter_watermark = watermark
+        _filter_refreshed_at = time.monotonic()
+        _rescan_watermark = rescan_watermark
+        _rescanned_at = _filter_refreshed_at
+    
+    stats = user_filter.stats()
+    log.info("User filter loaded", extra={'fields': {'users': stats['count'] // 2,
+                                                      'memory_bytes': stats['memory_bytes']}})
+    return True
 
-def initialize_db():
-    conn = create_connection()
-    if not conn:
-        print("Failed to connect to database")
+def _refresh_user_filter():
+    """Add users created since the last sync, e.g. by other workers or the import tool.
+
+    Runs at most once per USER_FILTER_REFRESH_INTERVAL; returns True if it ran.
+    """
+    global _filter_watermark, _filter_refreshed_at
+    if time.monotonic() - _filter_refreshed_at < Config.USER_FILTER_REFRESH_INTERVAL:
         return False
-        
+    if not _filter_lock.acquire(blocking=False):
+        return False
+    
     try:
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id VARCHAR(50) PRIMARY KEY,
-                name VARCHAR(100) NOT NULL,
-                email VARCHAR(100) UNIQUE NOT NULL,
-                password_hash VARCHAR(255) NOT NULL,
-                age INT,
-                dob DATE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Create password_reset_tokens table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS password_reset_tokens (
-                id VARCHAR(50) PRIMARY KEY,
-                user_id VARCHAR(50) NOT NULL,
-                token VARCHAR(100) UNIQUE NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                expires_at DATETIME NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            )
-        """)
-        
-        conn.commit()
-        print("Database tables created successfully")
+        _filter_refreshed_at = time.monotonic()
+        store = get_storage()
+        watermark, _ = store.user_watermark()
+        for user_id, email in store.users_since(_filter_watermark):
+            _user_filter.add(f"email:{email}")
+            _user_filter.add(f"id:{user_id}")
+        _filter_watermark = watermark
         return True
-    except Error as e:
-        print(f"Database initialization error: {e}")
+    except StorageError as e:
+        log.error("Database error refreshing user filter", extra={'fields': {'error': str(e)}})
         return False
     finally:
-        cursor.close()
-        conn.close()
+        _filter_lock.release()
+
+def _rescan_user_filter():
+    """Add rows created since shortly before the last rescan; on its own thread"""
+    global _rescan_watermark
+    try:
+        store = get_storage()
+        watermark, _ = store.user_watermark(Config.USER_FILTER_REFRESH_OVERLAP)
+        for user_id, email in store.users_since(_rescan_watermark):
+            _user_filter.add(f"email:{email}")
+            _user_filter.add(f"id:{user_id}")
+        _rescan_watermark = watermark
+    except StorageError as e:
+        log.error("Database error rescanning user filter", extra={'fields': {'error': str(e)}})
+    finally:
+        _rescan_lock.release()
+
+def _start_rescan():
+    """Start a rescan once USER_FILTER_RESCAN_INTERVAL has passed, unless one is running"""
+    global _rescanned_at
+    if time.monotonic() - _rescanned_at < Config.USER_FILTER_RESCAN_INTERVAL:
+        return
+    if not _rescan_lock.acquire(blocking=False):
+        return
+    _rescanned_at = time.monotonic()
+    # Rescanning the overlap reads minutes of rows; not on a request thread
+    threading.Thread(target=_rescan_user_filter, name='user-filter-rescan', daemon=True).start()
+
+def _user_may_exist(email=None, user_id=None):
+    """False only if no user with this email / id exists"""
+    if _user_filter is None:
+        return True
+    _start_rescan()
+    key = f"id:{user_id}" if user_id else f"email:{email}"
+    if key in _user_filter:
+        return True
+    # A miss may just mean the user was registered elsewhere since the last
+    # sync. If it can't sync now, only the database can tell
+    if not _refresh_user_filter():
+        return True
+    return key in _user_filter
+
+def _user_filter_add(user_id, email):
+    if _user_filter is not None:
+        _user_filter.add(f"email:{email}")
+        _user_filter.add(f"id:{user_id}")
+
+def user_filter_stats():
+    if _user_filter is None:
+        return None
+    return _user_filter.stats()
+
+def initialize_db():
+    """Create or upgrade the schema of the configured storage backend"""
+    try:
+        return get_storage().initialize()
+    except (StorageError, RuntimeError) as e:
+        log.error("Database initialization error", extra={'fields': {'error': str(e)}})
+        return False
+
+def _hash_algorithm(password_hash):
+    return identify_hasher(password_hash).algorithm
+
+# A clash means two hosts share an ID_NODE, or a row was copied in by
+# hand (ids.py). Each attempt draws new ids
+ID_ATTEMPTS = 3
+
+def _insert_users(store, users):
+    """store.insert_users, giving each user a fresh id until none is taken"""
+    for attempt in range(1, ID_ATTEMPTS + 1):
+        for user in users:
+            user['id'] = generate_user_id(user['email'])
+        try:
+            return store.insert_users(users)
+        except DuplicateId as e:
+            if attempt == ID_ATTEMPTS:
+                raise
+            log.warning("User id taken, retrying", extra={'fields': {'attempt': attempt, 'error': str(e)}})
 
 def register_user(name, email, password, age=None, dob=None):
-    print(f"Attempting to register user: {email}")
-    
-    conn = create_connection()
-    if not conn:
-        return {"error": "Database connection failed"}
+    log.debug("Attempting to register user", extra={'fields': {'email': email}})
     
+    store = get_storage()
     try:
-        cursor = conn.cursor(dictionary=True)
-        
         # Normalize email
         email = normalize_email(email)
-        print(f"Normalized email: {email}")
         
-        # Check if email already exists
-        cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-        existing_user = cursor.fetchone()
-        
-        if existing_user:
-            print(f"Email already exists: {email}")
+        # Check if email already exists; the UNIQUE key still catches races
+        if _user_may_exist(email=email) and store.existing_emails([email]):
+            log.info("Email already exists", extra={'fields': {'email': email}})
             return {"error": "Email already registered"}
         
         # Generate user data
-        user_id = generate_user_id()
         hashed_password = hash_password(password)
-        print(f"Generated user ID: {user_id}")
+        user = {
+            "name": name, "email": email,
+            "password_hash": hashed_password,
+            "hash_algorithm": _hash_algorithm(hashed_password),
+            "age": age, "dob": dob
+        }
         
         # Insert user
-        cursor.execute("""
-            INSERT INTO users (id, name, email, password_hash, age, dob)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (user_id, name, email, hashed_password, age, dob))
+        _insert_users(store, [user])
+        user_id = user['id']
         
-        conn.commit()
-        print(f"User registered successfully: {user_id}")
+        user_cache.invalidate(email=email)
+        _user_filter_add(user_id, email)
+        log.info("User registered", extra={'fields': {'user_id': user_id}})
         
         return {
             "message": "Registration successful",
@@ -107,87 +262,243 @@ def register_user(name, email, password, age=None, dob=None):
             "email": email
         }
         
-    except Error as e:
-        print(f"Database error during registration: {e}")
-        return {"error": f"Database error: {str(e)}"}
-    finally:
-        cursor.close()
-        conn.close()
+    except HashQueueFull as e:
+        log.warning("Hashing unavailable", extra={'fields': {'error': str(e)}})
+        return {"error": "Server busy, try again later"}
+    except DuplicateEmail:
+        # Registered concurrently since the check above
+        log.info("Email already exists", extra={'fields': {'email': email}})
+        return {"error": "Email already registered"}
+    except StorageError as e:
+        return _storage_error(e, "Database error during registration")
 
-def login_user(email=None, password=None, user_id=None):
-    """Login user via email or user_id and password"""
-    print(f"Attempting login - Email: {email}, User ID: {user_id}")
+def register_users(users):
+    """Register a batch of (name, email, password, age, dob) tuples.
+
+    One duplicate check, one multi-row INSERT and one commit for the whole
+    batch. Returns one result per user, shaped like register_user's.
+    """
+    log.debug("Attempting batch registration", extra={'fields': {'count': len(users)}})
     
-    conn = create_connection()
-    if not conn:
-        return {"error": "Database connection failed"}
+    results = [None] * len(users)
+    pending = {}  # normalized email -> index of its first occurrence
+    for i, (name, email, password, age, dob) in enumerate(users):
+        email = normalize_email(email)
+        if email in pending:
+            results[i] = {"error": "Email already registered"}
+        else:
+            pending[email] = i
     
+    store = get_storage()
     try:
-        cursor = conn.cursor(dictionary=True)
+        # Retry once if a concurrent registration wins the race for an email
+        for attempt in range(2):
+            emails = [e for e in pending if _user_may_exist(email=e)]
+            for email in store.existing_emails(emails):
+                results[pending.pop(email)] = {"error": "Email already registered"}
+            
+            if not pending:
+                break
+            
+            new_users = []
+            hashed_passwords = hash_passwords([users[i][2] for i in pending.values()])
+            for (email, i), hashed_password in zip(pending.items(), hashed_passwords):
+                name, _, _, age, dob = users[i]
+                new_users.append((i, {
+                    "name": name, "email": email,
+                    "password_hash": hashed_password,
+                    "hash_algorithm": _hash_algorithm(hashed_password),
+                    "age": age, "dob": dob
+                }))
+            
+            try:
+                _insert_users(store, [user for _, user in new_users])
+            except DuplicateEmail:
+                if attempt:
+                    raise
+                continue
+            
+            for i, user in new_users:
+                user_cache.invalidate(email=user['email'])
+                _user_filter_add(user['id'], user['email'])
+                results[i] = {
+                    "message": "Registration successful",
+                    "user_id": user['id'],
+                    "name": user['name'],
+                    "email": user['email']
+                }
+            log.info("Users registered", extra={'fields': {'count': len(new_users)}})
+            break
+        
+        return results
+        
+    except HashQueueFull as e:
+        log.warning("Hashing unavailable", extra={'fields': {'error': str(e)}})
+        error = {"error": "Server busy, try again later"}
+    except StorageError as e:
+        error = _storage_error(e, "Database error during batch registration")
+    return [r or error for r in results]
 
-        if user_id:
-            cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-            user = cursor.fetchone()
-        else:
-            email = normalize_email(email)
-            cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-            user = cursor.fetchone()
-        
-        if not user:
+def login_user(email=None, password=None, user_id=None):
+    """Login user via email or user_id and password"""
+    log.debug("Attempting login", extra={'fields': {'email': email, 'user_id': user_id}})
+    
+    if user_id:
+        user = user_cache.get(user_id=user_id)
+    else:
+        email = normalize_email(email)
+        user = user_cache.get(email=email)
+    
+    if user is None:
+        if not _user_may_exist(email=email, user_id=user_id):
             return {"error": "User not found"}
         
-        print(f"User found: {user['id']} - {user['name']}")
+        version = user_cache.version(user_id=user_id, email=email)
+        try:
+            user = get_storage().find_user(user_id=user_id, email=email)
+        except StorageError as e:
+            return _storage_error(e, "Database error during login")
         
+        if not user:
+            return {"error": "User not found"}
+        user_cache.put(user, version)
+    
+    log.debug("User found", extra={'fields': {'user_id': user['id']}})
+    
+    try:
         if verify_password(user["password_hash"], password):
-            print("Password verified successfully")
+            
+            # Upgrade legacy or under-cost hashes while we have the plaintext
+            if password_needs_rehash(user["password_hash"]):
+                _upgrade_password_hash(user, password)
+            
+            tokens = create_session(user)
+            if "error" in tokens:
+                return tokens
+            
             return {
                 "user_id": user["id"],
                 "name": user["name"],
-                "email": user["email"]
+                "email": user["email"],
+                **tokens
             }
         else:
-            print("Invalid password")
+            log.info("Invalid password", extra={'fields': {'user_id': user['id']}})
             return {"error": "Invalid password"}
             
-    except Error as e:
-        print(f"Database error during login: {e}")
-        return {"error": f"Database error: {str(e)}"}
-    finally:
-        cursor.close()
-        conn.close()
+    except HashQueueFull as e:
+        log.warning("Hashing unavailable", extra={'fields': {'error': str(e)}})
+        return {"error": "Server busy, try again later"}
+
+def _upgrade_password_hash(user, password):
+    """Re-hash with the current hasher; failures are retried on the next login"""
+    try:
+        hashed_password = hash_password(password)
+    except HashQueueFull:
+        return
+    
+    try:
+        get_storage().update_password_hash(user["id"], hashed_password, _hash_algorithm(hashed_password))
+        user_cache.invalidate(user_id=user["id"], email=user["email"])
+        log.info("Password hash upgraded", extra={'fields': {'user_id': user["id"]}})
+    except StorageError as e:
+        log.error("Database error during hash upgrade", extra={'fields': {'error': str(e)}})
+
+def create_session(user):
+    """Start a session for `user`; returns the access/refresh token response"""
+    session_id = sessions.new_id()
+    refresh_id = sessions.new_id()
+    expires_at = datetime.now() + timedelta(seconds=Config.SESSION_REFRESH_TTL)
+    try:
+        get_storage().add_session(session_id, user["id"], refresh_id, expires_at)
+    except StorageError as e:
+        return _storage_error(e, "Database error creating session")
+    log.info("Session created", extra={'fields': {'user_id': user['id'], 'session_id': session_id}})
+    return sessions.issue(session_id, refresh_id, user)
+
+def refresh_session(refresh_token):
+    """Swap a refresh token for a new access/refresh pair.
+
+    The old refresh token stops working. Presenting one that has already
+    been used means it was copied, so the whole session is revoked.
+    """
+    try:
+        claims = sessions.decode_refresh(refresh_token)
+    except sessions.InvalidToken as e:
+        return {"error": f"Invalid refresh token: {e}"}
+    
+    session_id = claims["s"]
+    refresh_id = sessions.new_id()
+    expires_at = datetime.now() + timedelta(seconds=Config.SESSION_REFRESH_TTL)
+    try:
+        store = get_storage()
+        if not store.rotate_session(session_id, claims["j"], refresh_id, expires_at, user_id=claims["u"]):
+            store.delete_session(session_id, user_id=claims["u"])
+            sessions.revoke(session_id)
+            log.warning("Refresh token reused or session ended", extra={'fields': {
+                'user_id': claims['u'], 'session_id': session_id
+            }})
+            return {"error": "Invalid refresh token: session ended"}
+    except StorageError as e:
+        return _storage_error(e, "Database error refreshing session")
+    
+    user = {"id": claims["u"], "email": claims["m"], "name": claims["n"]}
+    return sessions.issue(session_id, refresh_id, user)
+
+def end_session(session_id, user_id=None):
+    """Revoke a session: no more refreshes here, no more access tokens in this process"""
+    sessions.revoke(session_id)
+    try:
+        get_storage().delete_session(session_id, user_id=user_id)
+    except StorageError as e:
+        return _storage_error(e, "Database error ending session")
+    log.info("Session ended", extra={'fields': {'session_id': session_id}})
+    return {"message": "Logged out"}
+
+def _end_user_sessions(user_id):
+    """Log the user out everywhere, e.g. after a password reset, so a stolen
+    refresh token stops working along with the old password"""
+    try:
+        session_ids = get_storage().delete_user_sessions(user_id)
+    except StorageError as e:
+        log.error("Database error ending sessions after password reset", extra={'fields': {
+            'user_id': user_id, 'error': str(e)
+        }})
+        return
+    for session_id in session_ids:
+        sessions.revoke(session_id)
+    if session_ids:
+        log.info("Sessions ended", extra={'fields': {'user_id': user_id, 'sessions': len(session_ids)}})
 
 def forgot_password(email):
     """Generate reset token for user"""
-    print(f"🔐 Forgot password request for: {email}")
+    log.debug("Forgot password request", extra={'fields': {'email': email}})
     
-    conn = create_connection()
-    if not conn:
-        return {"error": "Database connection failed"}
+    email = normalize_email(email)
+    if not _user_may_exist(email=email):
+        return {"error": "User not found"}
     
+    store = get_storage()
     try:
-        cursor = conn.cursor(dictionary=True)
-        
         # Check if user exists
-        email = normalize_email(email)
-        cursor.execute("SELECT id, name, email FROM users WHERE email = %s", (email,))
-        user = cursor.fetchone()
+        user = store.find_user(email=email)
         
         if not user:
             return {"error": "User not found"}
         
-        # Generate reset token
-        reset_token = generate_reset_token()
-        expires_at = datetime.now() + timedelta(hours=1)  # 1 hour expiry
-        
-        # Store token in database
-        cursor.execute("""
-            INSERT INTO password_reset_tokens (id, user_id, token, expires_at)
-            VALUES (%s, %s, %s, %s)
-        """, (str(uuid.uuid4()), user['id'], reset_token, expires_at))
-        
-        conn.commit()
+        if Config.RESET_TOKEN_MODE == 'signed':
+            # Self-contained; nothing to store
+            reset_token = reset_tokens.issue(user)
+        else:
+            # Generate reset token
+            reset_token = generate_reset_token()
+            expires_at = datetime.now() + timedelta(seconds=Config.RESET_TOKEN_TTL)
+            
+            # Store token, keeping at most RESET_TOKEN_MAX_PER_USER per user
+            store.add_reset_token(str(uuid.uuid4()), user['id'], reset_token, expires_at,
+                                  Config.RESET_TOKEN_MAX_PER_USER)
         
-        print(f"Reset token generated for: {email}")
+        log.info("Reset token generated", extra={'fields': {'user_id': user['id']}})
         
         return {
             "success": True,
@@ -197,33 +508,20 @@ def forgot_password(email):
             "email": user['email']
         }
         
-    except Error as e:
-        print(f"Database error: {e}")
-        return {"error": f"Database error: {str(e)}"}
-    finally:
-        cursor.close()
-        conn.close()
+    except StorageError as e:
+        return _storage_error(e, "Database error")
 
 def reset_password(token, new_password):
     """Reset password using valid token"""
-    print(f"Resetting password with token...")
+    log.debug("Resetting password with token")
     
-    conn = create_connection()
-    if not conn:
-        return {"error": "Database connection failed"}
+    if reset_tokens.is_signed(token):
+        return _reset_password_signed(token, new_password)
     
+    store = get_storage()
     try:
-        cursor = conn.cursor(dictionary=True)
-        
         # Check if token is valid and not expired
-        cursor.execute("""
-            SELECT prt.*, u.id as user_id 
-            FROM password_reset_tokens prt 
-            JOIN users u ON prt.user_id = u.id 
-            WHERE prt.token = %s AND prt.expires_at > NOW()
-        """, (token,))
-        
-        token_data = cursor.fetchone()
+        token_data = store.find_reset_tokens([token]).get(token)
         
         if not token_data:
             return {"error": "Invalid or expired reset token"}
@@ -236,62 +534,135 @@ def reset_password(token, new_password):
         # Hash new password
         hashed_password = hash_password(new_password)
         
-        # Update user password
-        cursor.execute("UPDATE users SET password_hash = %s WHERE id = %s", 
-                      (hashed_password, token_data['user_id']))
-        
-        # Delete used token
-        cursor.execute("DELETE FROM password_reset_tokens WHERE token = %s", (token,))
-        
-        conn.commit()
+        # Delete the used token and update the password together
+        if not store.use_reset_token(token, token_data['user_id'], hashed_password,
+                                     _hash_algorithm(hashed_password)):
+            return {"error": "Invalid or expired reset token"}
+        user_cache.invalidate(user_id=token_data['user_id'], email=token_data['email'])
+        _end_user_sessions(token_data['user_id'])
         
-        print(f"Password reset successfully for user: {token_data['user_id']}")
+        log.info("Password reset", extra={'fields': {'user_id': token_data['user_id']}})
         
         return {
             "success": True,
             "message": "Password reset successfully"
         }
         
-    except Error as e:
-        print(f"Database error: {e}")
-        return {"error": f"Database error: {str(e)}"}
-    finally:
-        cursor.close()
-        conn.close()
+    except HashQueueFull as e:
+        log.warning("Hashing unavailable", extra={'fields': {'error': str(e)}})
+        return {"error": "Server busy, try again later"}
+    except StorageError as e:
+        return _storage_error(e, "Database error")
+
+def _reset_password_signed(token, new_password):
+    """Reset with a signed token: one UPDATE, guarded by the hash fingerprint"""
+    try:
+        payload = reset_tokens.decode(token)
+    except reset_tokens.InvalidToken:
+        return {"error": "Invalid or expired reset token"}
+    
+    is_strong, password_error = validate_password_strength(new_password)
+    if not is_strong:
+        return {"error": password_error}
+    
+    try:
+        hashed_password = hash_password(new_password)
+    except HashQueueFull as e:
+        log.warning("Hashing unavailable", extra={'fields': {'error': str(e)}})
+        return {"error": "Server busy, try again later"}
+    
+    try:
+        # Only matches while the password is the one the token was issued
+        # against, so each token resets at most once
+        updated = get_storage().update_password_hash(
+            payload['u'], hashed_password, _hash_algorithm(hashed_password), fingerprint=payload['f'])
+    except StorageError as e:
+        return _storage_error(e, "Database error")
+    
+    if not updated:
+        return {"error": "Invalid or expired reset token"}
+    user_cache.invalidate(user_id=payload['u'], email=payload['m'])
+    _end_user_sessions(payload['u'])
+    
+    log.info("Password reset", extra={'fields': {'user_id': payload['u']}})
+    
+    return {
+        "success": True,
+        "message": "Password reset successfully"
+    }
+
+def _verify_signed_token(token):
+    """Signature and expiry only; a token already used still verifies until reset rejects it"""
+    try:
+        payload = reset_tokens.decode(token)
+    except reset_tokens.InvalidToken:
+        return {"error": "Invalid or expired token"}
+    return {
+        "valid": True,
+        "email": payload['m'],
+        "name": payload['n']
+    }
 
 def verify_reset_token(token):
     """Check if reset token is valid"""
-    conn = create_connection()
-    if not conn:
-        return {"error": "Database connection failed"}
+    return verify_reset_tokens([token])[0]
+
+def verify_reset_tokens(tokens):
+    """Check a batch of reset tokens with one query; one result per token"""
+    # Signed tokens need no query; look up the rest together
+    stored = [token for token in tokens if not reset_tokens.is_signed(token)]
+    found = {}
+    if stored:
+        try:
+            found = get_storage().find_reset_tokens(stored)
+        except StorageError as e:
+            error = _storage_error(e, "Database error")
+            return [_verify_signed_token(t) if reset_tokens.is_signed(t) else error for t in tokens]
     
-    try:
-        cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("""
-            SELECT u.email, u.name 
-            FROM password_reset_tokens prt 
-            JOIN users u ON prt.user_id = u.id 
-            WHERE prt.token = %s AND prt.expires_at > NOW()
-        """, (token,))
-        
-        token_data = cursor.fetchone()
-        
+    results = []
+    for token in tokens:
+        if reset_tokens.is_signed(token):
+            results.append(_verify_signed_token(token))
+            continue
+        token_data = found.get(token)
         if not token_data:
-            return {"error": "Invalid or expired token"}
-        
-        return {
-            "valid": True,
-            "email": token_data['email'],
-            "name": token_data['name']
-        }
-        
-    except Error as e:
-        return {"error": f"Database error: {str(e)}"}
-    finally:
-        cursor.close()
-        conn.close()
+            results.append({"error": "Invalid or expired token"})
+        else:
+            results.append({
+                "valid": True,
+                "email": token_data['email'],
+                "name": token_data['name']
+            })
+    return results
+
+def delete_expired_reset_tokens(limit):
+    """Delete up to `limit` expired reset tokens; returns the count, or None on error"""
+    try:
+        return get_storage().delete_expired_reset_tokens(limit)
+    except StorageError as e:
+        log.error("Database error during token sweep", extra={'fields': {'error': str(e)}})
+        return None
+
+def delete_expired_sessions(limit):
+    """Delete up to `limit` expired sessions; returns the count, or None on error"""
+    try:
+        return get_storage().delete_expired_sessions(limit)
+    except StorageError as e:
+        log.error("Database error during session sweep", extra={'fields': {'error': str(e)}})
+        return None
 
 def init_db():
     """Initialize database"""
-    return initialize_db()
+    if not initialize_db():
+        return False
+    load_user_filter()
+    return True
+
+def _reset_after_fork():
+    # A sync or rescan running in the parent isn't copied, but its lock may be
+    global _filter_lock, _rescan_lock
+    _filter_lock = threading.Lock()
+    _rescan_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,238 @@
+"""Run password hashing off the request thread.
+
+scrypt/PBKDF2 hold the GIL for the whole hash, so on the request threads
+they serialize every login. HashExecutor sends them to a process pool
+instead. Its queue is bounded: when it stays full for queue_wait
+seconds, submit() raises HashQueueFull so the API can answer 503 rather
+than queueing without limit.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from config import Config
+import hashers
+import logs
+import metrics
+
+log = logs.get_logger('hash_executor')
+
+
+class HashQueueFull(Exception):
+    """Raised when the hashing queue is full or a job timed out"""
+
+
+def _timed_many(fn, args_list):
+    # Runs in the worker process
+    start = time.perf_counter()
+    results = [fn(*args) for args in args_list]
+    return results, time.perf_counter() - start
+
+
+def _split(items, parts):
+    size = -(-len(items) // parts)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class HashExecutor:
+    """Bounded process pool for hashing jobs, with per-job timing.
+
+    With workers=0 jobs run inline on the calling thread; the queue bound
+    and metrics still apply.
+    """
+
+    def __init__(self, workers=None, max_queue=None, timeout=30, queue_wait=0):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_queue = max(max_queue or (self.workers or os.cpu_count() or 1) * 4, 1)
+        self.timeout = timeout
+        self.queue_wait = queue_wait
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._lock = threading.Lock()
+        self._executor = self._new_pool() if self.workers > 0 else None
+
+        # Counters, keyed by job name for timings
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._timings = {}
+
+    def submit(self, name, fn, *args):
+        """Run fn(*args) in the pool and return its result.
+
+        `name` labels the job in stats(); fn must be a picklable top-level function.
+        """
+        return self.map(name, fn, [args])[0]
+
+    def map(self, name, fn, args_list):
+        """Run fn(*args) for each tuple in args_list; results come back in order.
+
+        Calls are split into at most one chunk per worker and each chunk
+        takes one queue slot, so a batch is admitted or rejected as a whole.
+        """
+        if not args_list:
+            return []
+        chunks = _split(list(args_list), max(min(self.workers, len(args_list)), 1))
+
+        # A queue that is full under normal load frees up within a few hash
+        # times; only one that stays full is overload
+        deadline = time.monotonic() + self.queue_wait
+        acquired = 0
+        while acquired < len(chunks) and self._slots.acquire(
+                timeout=max(deadline - time.monotonic(), 0)):
+            acquired += 1
+        if acquired < len(chunks):
+            for _ in range(acquired):
+                self._slots.release()
+            with self._lock:
+                self.rejected += 1
+            raise HashQueueFull("Hashing queue is full")
+
+        submitted = time.perf_counter()
+        with self._lock:
+            self.queued += len(chunks)
+        try:
+            pool = self._executor
+            if pool is None:
+                done = [_timed_many(fn, chunk) for chunk in chunks]
+            else:
+                futures = [pool.submit(_timed_many, fn, chunk) for chunk in chunks]
+                deadline = submitted + self.timeout
+                try:
+                    done = [f.result(timeout=max(deadline - time.perf_counter(), 0))
+                            for f in futures]
+                except FutureTimeout:
+                    for f in futures:
+                        f.cancel()
+                    with self._lock:
+                        self.timeouts += 1
+                    raise HashQueueFull("Hashing job timed out")
+                except BrokenProcessPool:
+                    # A worker died; replace the pool for the next job
+                    self._restart(pool)
+                    raise HashQueueFull("Hashing worker crashed")
+        finally:
+            with self._lock:
+                self.queued -= len(chunks)
+            for _ in chunks:
+                self._slots.release()
+
+        total = time.perf_counter() - submitted
+        metrics.observe_stage(name, total)
+        results = []
+        for chunk_results, run_time in done:
+            self._record(name, total - run_time, run_time / len(chunk_results),
+                         len(chunk_results))
+            results.extend(chunk_results)
+        return results
+
+    def stats(self):
+        with self._lock:
+            jobs = {}
+            for name, t in self._timings.items():
+                jobs[name] = {
+                    "count": t["count"],
+                    "avg_run_ms": t["run"] / t["count"] * 1000,
+                    "max_run_ms": t["max_run"] * 1000,
+                    "avg_wait_ms": t["wait"] / t["count"] * 1000,
+                    "max_wait_ms": t["max_wait"] * 1000,
+                }
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queue_wait_s": self.queue_wait,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "jobs": jobs,
+            }
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _new_pool(self):
+        # spawn: forking a process that already runs threads is unsafe
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+    def _restart(self, broken):
+        with self._lock:
+            if self._executor is not broken:
+                # Another thread already replaced it
+                return
+            self._executor = self._new_pool()
+        log.error("Hashing process pool crashed, restarting")
+        broken.shutdown(wait=False)
+
+    def _record(self, name, wait, run, count=1):
+        with self._lock:
+            t = self._timings.setdefault(name, {
+                "count": 0, "run": 0.0, "max_run": 0.0, "wait": 0.0, "max_wait": 0.0
+            })
+            t["count"] += count
+            t["run"] += run * count
+            t["wait"] += wait * count
+            t["max_run"] = max(t["max_run"], run)
+            t["max_wait"] = max(t["max_wait"], wait)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_processes = 1  # server processes on this host sharing HASH_WORKERS
+
+def share_host(processes):
+    """Called in each of `processes` pre-forked workers, before the first
+    hash: each gets its share of HASH_WORKERS instead of a full pool"""
+    global _processes
+    _processes = max(processes, 1)
+
+def get_executor():
+    """Process-wide hashing executor, created on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = Config.HASH_WORKERS
+                if workers > 0:
+                    workers = max(workers // _processes, 1)
+                _executor = HashExecutor(
+                    workers=workers,
+                    max_queue=Config.HASH_MAX_QUEUE,
+                    timeout=Config.HASH_TIMEOUT,
+                    queue_wait=Config.HASH_QUEUE_WAIT
+                )
+    return _executor
+
+def hash_password(password):
+    return get_executor().submit('hash', hashers.make_password, password)
+
+def hash_passwords(passwords):
+    """Hash several passwords as one job spread across the workers"""
+    return get_executor().map('hash', hashers.make_password, [(p,) for p in passwords])
+
+def verify_password(stored_hash, password):
+    return get_executor().submit('verify', hashers.check_password, stored_hash, password)
+
+def stats():
+    return get_executor().stats()
+
+def shutdown():
+    """Stop the worker processes, e.g. once the server has drained"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor:
+        executor.shutdown()
+
+def _reset_after_fork():
+    # The parent's worker processes and their pipes belong to the parent
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,197 @@
+"""Password hashers.
+
+Stored hashes carry a self-describing prefix so the algorithm and its cost
+can change without invalidating existing passwords:
+
+    scrypt$<n>$<r>$<p>$<salt>$<hash>
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+    <salt>$<hash>                        legacy salted SHA-256, verify only
+
+Run `python hashers.py calibrate --target-ms 250` on the deployment host to
+pick cost parameters for a target time per hash.
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import time
+from config import Config
+
+
+class BaseHasher:
+    algorithm = None
+
+    def encode(self, password, salt=None):
+        raise NotImplementedError
+
+    def verify(self, password, encoded):
+        raise NotImplementedError
+
+    def must_update(self, encoded):
+        """True if `encoded` was made with weaker parameters than configured"""
+        return False
+
+
+class ScryptHasher(BaseHasher):
+    algorithm = 'scrypt'
+
+    def __init__(self, n=None, r=None, p=None):
+        self.n = n or Config.SCRYPT_N
+        self.r = r or Config.SCRYPT_R
+        self.p = p or Config.SCRYPT_P
+
+    def encode(self, password, salt=None):
+        salt = salt or os.urandom(16).hex()
+        hashed = self._derive(password, salt, self.n, self.r, self.p)
+        return f"{self.algorithm}${self.n}${self.r}${self.p}${salt}${hashed}"
+
+    def verify(self, password, encoded):
+        _, n, r, p, salt, original_hash = encoded.split('$', 5)
+        new_hash = self._derive(password, salt, int(n), int(r), int(p))
+        return hmac.compare_digest(new_hash, original_hash)
+
+    def must_update(self, encoded):
+        _, n, r, p, _ = encoded.split('$', 4)
+        return (int(n), int(r), int(p)) < (self.n, self.r, self.p)
+
+    @staticmethod
+    def _derive(password, salt, n, r, p):
+        # hashlib's default maxmem (32 MiB) is too small for n >= 2**15
+        maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+        return hashlib.scrypt(password.encode(), salt=salt.encode(),
+                              n=n, r=r, p=p, maxmem=maxmem, dklen=32).hex()
+
+
+class PBKDF2Hasher(BaseHasher):
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=None):
+        self.iterations = iterations or Config.PBKDF2_ITERATIONS
+
+    def encode(self, password, salt=None):
+        salt = salt or os.urandom(16).hex()
+        hashed = self._derive(password, salt, self.iterations)
+        return f"{self.algorithm}${self.iterations}${salt}${hashed}"
+
+    def verify(self, password, encoded):
+        _, iterations, salt, original_hash = encoded.split('$', 3)
+        new_hash = self._derive(password, salt, int(iterations))
+        return hmac.compare_digest(new_hash, original_hash)
+
+    def must_update(self, encoded):
+        iterations = int(encoded.split('$', 2)[1])
+        return iterations < self.iterations
+
+    @staticmethod
+    def _derive(password, salt, iterations):
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(),
+                                   iterations).hex()
+
+
+class LegacySHA256Hasher(BaseHasher):
+    """The original salt$sha256 format; existing hashes are upgraded on login"""
+    algorithm = 'sha256_legacy'
+
+    def encode(self, password, salt=None):
+        raise ValueError("Legacy SHA-256 hashes can be verified but not created")
+
+    def verify(self, password, encoded):
+        salt, original_hash = encoded.split('$', 1)
+        new_hash = hashlib.sha256((password + salt).encode()).hexdigest()
+        return hmac.compare_digest(new_hash, original_hash)
+
+
+HASHERS = {}
+
+def register_hasher(hasher):
+    HASHERS[hasher.algorithm] = hasher
+
+register_hasher(ScryptHasher())
+register_hasher(PBKDF2Hasher())
+register_hasher(LegacySHA256Hasher())
+
+def get_hasher(algorithm=None):
+    """Hasher for `algorithm`, or the configured default for new hashes"""
+    return HASHERS[algorithm or Config.PASSWORD_HASHER]
+
+def identify_hasher(encoded):
+    prefix = encoded.split('$', 1)[0]
+    if prefix in HASHERS:
+        return HASHERS[prefix]
+    # Legacy hashes have no prefix, only salt$hash
+    return HASHERS[LegacySHA256Hasher.algorithm]
+
+def make_password(password):
+    return get_hasher().encode(password)
+
+def check_password(encoded, password):
+    try:
+        return identify_hasher(encoded).verify(password, encoded)
+    except Exception:
+        return False
+
+def needs_rehash(encoded):
+    """True if `encoded` should be replaced with a fresh default hash"""
+    try:
+        hasher = identify_hasher(encoded)
+        default = get_hasher()
+        if hasher.algorithm != default.algorithm:
+            return True
+        return default.must_update(encoded)
+    except Exception:
+        return False
+
+
+def _time_hash(hasher, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.encode('calibration-password')
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def calibrate(algorithm, target_ms):
+    """Smallest cost that takes at least `target_ms` per hash on this host.
+
+    Returns (settings, measured_ms) where settings maps Config names to values.
+    """
+    if algorithm == ScryptHasher.algorithm:
+        r, p = Config.SCRYPT_R, Config.SCRYPT_P
+        n = 2 ** 12
+        elapsed = _time_hash(ScryptHasher(n, r, p))
+        while elapsed < target_ms and n < 2 ** 22:
+            n *= 2
+            elapsed = _time_hash(ScryptHasher(n, r, p))
+        return {'SCRYPT_N': n, 'SCRYPT_R': r, 'SCRYPT_P': p}, elapsed
+
+    if algorithm == PBKDF2Hasher.algorithm:
+        iterations = 10000
+        elapsed = _time_hash(PBKDF2Hasher(iterations))
+        # PBKDF2 cost is linear in iterations, so scale then re-measure
+        while elapsed < target_ms:
+            iterations = int(iterations * max(target_ms / max(elapsed, 0.01), 1.1))
+            elapsed = _time_hash(PBKDF2Hasher(iterations))
+        return {'PBKDF2_ITERATIONS': iterations}, elapsed
+
+    raise ValueError(f"Cannot calibrate {algorithm}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Password hashing tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    cal = commands.add_parser('calibrate', help="Pick cost parameters for a target time per hash")
+    cal.add_argument('--algorithm', default=Config.PASSWORD_HASHER,
+                     choices=[ScryptHasher.algorithm, PBKDF2Hasher.algorithm])
+    cal.add_argument('--target-ms', type=float, default=Config.PASSWORD_HASH_TARGET_MS)
+    args = parser.parse_args(argv)
+
+    settings, elapsed = calibrate(args.algorithm, args.target_ms)
+    print(f"{args.algorithm}: {elapsed:.1f} ms per hash (target {args.target_ms:g} ms)")
+    print(f"PASSWORD_HASHER={args.algorithm}")
+    for name, value in settings.items():
+        print(f"{name}={value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Time-ordered, collision-free ids (Snowflake style) for new users.
+
+An id is 80 bits, written as 20 hex digits so that string order is time
+order:
+
+    48 bits  milliseconds since the Unix epoch
+    16 bits  node: ID_NODE (0-255, one per host) and the worker number
+    16 bits  sequence within the millisecond
+
+Within a host the worker number tells processes apart: a single-process
+server is 0, pre-forked workers are 1 to MAX_SERVER_WORKER, and
+bulk_users.py is TOOL_WORKER. Ids can still repeat when two hosts share
+an ID_NODE or two imports run on one host at once, so every insert of new
+ids retries with fresh ones on a duplicate key. New rows land at the
+right-hand end of the users primary key instead of at random pages of it.
+"""
+import os
+import threading
+import time
+from config import Config
+
+NODE_BITS = 16
+WORKER_BITS = 8
+SEQUENCE_BITS = 16
+MAX_HOST_NODE = (1 << (NODE_BITS - WORKER_BITS)) - 1
+MAX_WORKER = (1 << WORKER_BITS) - 1
+TOOL_WORKER = MAX_WORKER
+MAX_SERVER_WORKER = TOOL_WORKER - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class IdGenerator:
+    def __init__(self, host_node=0, worker=0):
+        if not 0 <= host_node <= MAX_HOST_NODE:
+            raise ValueError(f"ID_NODE must be 0-{MAX_HOST_NODE}, not {host_node}")
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError(f"At most {MAX_WORKER} workers can issue ids; got worker {worker}")
+        self.node = (host_node << WORKER_BITS) | worker
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next(self):
+        """The next id as an int; strictly increasing within this process"""
+        with self._lock:
+            now = time.time_ns() // 1_000_000
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+            elif self._sequence < MAX_SEQUENCE:
+                # Same millisecond, or the clock stepped back: keep counting
+                self._sequence += 1
+            else:
+                # 65536 ids in one millisecond: borrow the next one
+                self._last_ms += 1
+                self._sequence = 0
+            return (self._last_ms << (NODE_BITS + SEQUENCE_BITS)) | (self.node << SEQUENCE_BITS) | self._sequence
+
+
+_generator = IdGenerator(Config.ID_NODE)
+
+def next_id():
+    return _generator.next()
+
+def set_worker(worker):
+    """Called in each pre-forked worker with its number, and by tools with TOOL_WORKER"""
+    global _generator
+    _generator = IdGenerator(Config.ID_NODE, worker)
+
+def _reset_after_fork():
+    # The parent's lock may have been held mid-fork
+    _generator._lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
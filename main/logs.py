@@ -0,0 +1,168 @@
+"""Structured JSON logging off the request path.
+
+Request threads only put the LogRecord on a bounded queue; a background
+listener thread formats it as one JSON line and writes it to stdout. When
+the queue is full records are dropped and counted rather than blocking
+the request.
+
+    log = logs.get_logger('database')
+    log.info("User registered", extra={'fields': {'user_id': user_id, 'email': email}})
+
+Sensitive fields (passwords, hashes, tokens) are redacted and email
+addresses are masked when the record is formatted, so callers can log
+request data as-is.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from config import Config
+
+SENSITIVE_KEYS = {'password', 'password_hash', 'token', 'tokens'}
+SENSITIVE_SUFFIXES = ('_password', '_token', '_tokens')
+EMAIL_PATTERN = re.compile(r'([A-Za-z0-9._%+-])[A-Za-z0-9._%+-]*(@[A-Za-z0-9.-]+\.[A-Za-z]{2,})')
+
+
+def _sensitive(key):
+    return isinstance(key, str) and (key in SENSITIVE_KEYS or key.endswith(SENSITIVE_SUFFIXES))
+
+def redact(value):
+    """Copy of `value` with sensitive keys replaced and emails masked"""
+    if isinstance(value, dict):
+        return {k: '***' if _sensitive(k) else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return EMAIL_PATTERN.sub(r'\1***\2', value)
+    return value
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(redact(fields))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The default formats the message here, on the request thread;
+        # the listener's formatter does that instead
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RouteSampler(logging.Filter):
+    """Keep a fraction of below-WARNING records per route (the `route` field)"""
+
+    def __init__(self, rates, default_rate=1.0):
+        super().__init__()
+        self.rates = rates
+        self.default_rate = default_rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        fields = getattr(record, 'fields', None)
+        route = fields.get('route') if fields else None
+        rate = self.rates.get(route, self.default_rate) if route else 1.0
+        return rate >= 1.0 or random.random() < rate
+
+
+def _parse_pairs(text):
+    """'a=1,b=2' -> {'a': '1', 'b': '2'}"""
+    pairs = {}
+    for part in (text or '').split(','):
+        key, sep, value = part.partition('=')
+        if sep:
+            pairs[key.strip()] = value.strip()
+    return pairs
+
+
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+def setup():
+    """Install the queue handler on the 'api' logger; safe to call more than once"""
+    global _handler, _listener
+    with _lock:
+        if _handler is not None:
+            return
+        root = logging.getLogger('api')
+        root.setLevel(Config.LOG_LEVEL.upper())
+        root.propagate = False
+        for name, level in _parse_pairs(Config.LOG_LEVELS).items():
+            logging.getLogger(f'api.{name}').setLevel(level.upper())
+
+        rates = {route: float(rate) for route, rate in _parse_pairs(Config.LOG_SAMPLE_RATES).items()}
+        _handler = DroppingQueueHandler(queue.Queue(Config.LOG_QUEUE_SIZE))
+        _handler.addFilter(RouteSampler(rates, Config.LOG_SAMPLE_RATE))
+        root.addHandler(_handler)
+        _start_listener()
+
+def _start_listener():
+    global _listener
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+    _listener = QueueListener(_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+def shutdown():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            try:
+                _listener.stop()
+            except queue.Full:
+                # No room for the stop sentinel; the thread is a daemon anyway
+                pass
+            _listener = None
+
+atexit.register(shutdown)
+
+def dropped():
+    return _handler.dropped if _handler else 0
+
+def get_logger(name):
+    return logging.getLogger(f'api.{name}')
+
+
+def _restart_after_fork():
+    # The listener thread does not survive fork; give the child its own
+    global _lock
+    _lock = threading.Lock()
+    if _handler is not None:
+        _handler.queue = queue.Queue(Config.LOG_QUEUE_SIZE)
+        _start_listener()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
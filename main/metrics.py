@@ -0,0 +1,178 @@
+"""Request counters, latency histograms and per-stage timings.
+
+Every thread writes to its own shard, so recording takes no lock; render()
+sums the shards when /metrics is scraped. Pre-forked workers each keep
+their own numbers.
+"""
+import threading
+import time
+
+# Upper bounds in seconds; the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    'api_requests_total': ('counter', "Requests by path and status code"),
+    'api_request_duration_seconds': ('histogram', "Request latency by path and status code"),
+    'api_stage_duration_seconds': ('histogram', "Time spent in each stage of a request"),
+    'api_requests_in_flight': ('gauge', "Requests being handled"),
+    'api_db_errors_total': ('counter', "Database errors by kind"),
+}
+
+
+class _Shard:
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = _Shard()
+        with _shards_lock:
+            _shards.append(shard)
+        return shard
+
+
+def inc(name, labels=(), value=1):
+    counters = _shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+def observe(name, labels, seconds):
+    histograms = _shard().histograms
+    key = (name, labels)
+    h = histograms.get(key)
+    if h is None:
+        h = histograms[key] = [0] * (len(BUCKETS) + 3)
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            h[i] += 1
+            break
+    else:
+        h[len(BUCKETS)] += 1
+    h[-2] += seconds
+    h[-1] += 1
+
+
+def set_route(path):
+    """Route that stage timings on this thread are attributed to
+
+    Work outside a request (startup, filter refresh) is labelled "background".
+    """
+    _local.route = path
+
+def current_route():
+    return getattr(_local, 'route', 'background')
+
+
+class stage:
+    """Time a block as one stage of the current request:
+
+        with metrics.stage('query'):
+            cursor.execute(...)
+    """
+    __slots__ = ('name', 'route', 'start')
+
+    def __init__(self, name, route=None):
+        self.name = name
+        self.route = route
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe('api_stage_duration_seconds',
+                (('route', self.route or current_route()), ('stage', self.name)),
+                time.perf_counter() - self.start)
+
+def observe_stage(name, seconds, route=None):
+    observe('api_stage_duration_seconds',
+            (('route', route or current_route()), ('stage', name)), seconds)
+
+
+def request_started(path):
+    set_route(path)
+    inc('api_requests_in_flight')
+    return time.perf_counter()
+
+def request_finished(path, status_code, started):
+    """Record a finished request; returns its duration in seconds"""
+    labels = (('path', path), ('status', str(status_code)))
+    elapsed = time.perf_counter() - started
+    inc('api_requests_in_flight', value=-1)
+    inc('api_requests_total', labels)
+    observe('api_request_duration_seconds', labels, elapsed)
+    return elapsed
+
+def db_error(kind):
+    inc('api_db_errors_total', (('kind', kind),))
+
+
+def collect():
+    """Sum every thread's shard; returns (counters, histograms)"""
+    with _shards_lock:
+        shards = list(_shards)
+    counters = {}
+    histograms = {}
+    for shard in shards:
+        # dict.copy() is atomic under the GIL, so a concurrent insert is safe
+        for key, value in shard.counters.copy().items():
+            counters[key] = counters.get(key, 0) + value
+        for key, h in shard.histograms.copy().items():
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = list(h)
+            else:
+                for i, v in enumerate(h):
+                    total[i] += v
+    return counters, histograms
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+def render(gauges=None):
+    """Prometheus text format; `gauges` adds point-in-time values by name"""
+    counters, histograms = collect()
+    lines = []
+    typed = set()
+
+    def header(name, kind=None, text=None):
+        if name in typed:
+            return
+        typed.add(name)
+        kind, text = HELP.get(name, (kind, text))
+        if text:
+            lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    for (name, labels), h in sorted(histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), h[:len(BUCKETS) + 1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {h[-2]:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {h[-1]}")
+
+    for name, value in sorted((gauges or {}).items()):
+        header(name, 'gauge')
+        lines.append(f"{name} {value}")
+
+    return '\n'.join(lines) + '\n'
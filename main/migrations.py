@@ -0,0 +1,284 @@
+"""Versioned schema migrations.
+
+Each migration runs once, in version order, and is recorded in the
+schema_version table. initialize_db() applies pending ones at startup
+(unless MIGRATE_ON_STARTUP is off); they can also be run by hand:
+
+    python migrations.py status
+    python migrations.py migrate [--to VERSION] [--shard NAME]
+
+With DB_SHARDS set, both commands run on every shard unless --shard names one.
+
+MySQL commits DDL implicitly, so a migration interrupted half-way is
+re-run from the start: write each step so it can run twice (the helpers
+on Migrator check before altering). Schema changes use online DDL and
+data changes go through Migrator.backfill(), which updates in small
+primary-key ranges with a pause between them so logins keep flowing.
+"""
+import argparse
+import sys
+import time
+from config import Config
+import hashers
+import logs
+
+log = logs.get_logger('migrations')
+
+LOCK_NAME = 'user_system_migrations'
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register the decorated function(migrator) as migration `version`"""
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+class Migrator:
+    """What a migration gets: a cursor plus idempotent DDL/backfill helpers"""
+
+    def __init__(self, conn, batch_size=None, pause=None):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.batch_size = Config.MIGRATION_BATCH_SIZE if batch_size is None else batch_size
+        self.pause = Config.MIGRATION_BATCH_PAUSE if pause is None else pause
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(sql, params)
+
+    def has_column(self, table, column):
+        self.cursor.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+            LIMIT 1
+        """, (table, column))
+        return self.cursor.fetchone() is not None
+
+    def has_index(self, table, name):
+        self.cursor.execute("""
+            SELECT 1 FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            LIMIT 1
+        """, (table, name))
+        return self.cursor.fetchone() is not None
+
+    def add_columns(self, table, columns):
+        """Add the missing ones of {name: definition} in one online ALTER"""
+        missing = [f"ADD COLUMN {name} {ddl}" for name, ddl in columns.items()
+                   if not self.has_column(table, name)]
+        if missing:
+            self.execute(f"ALTER TABLE {table} {', '.join(missing)}, ALGORITHM=INPLACE, LOCK=NONE")
+
+    def add_index(self, table, name, columns):
+        if not self.has_index(table, name):
+            self.execute(f"CREATE INDEX {name} ON {table} ({columns}) ALGORITHM=INPLACE LOCK=NONE")
+
+    def backfill(self, table, assignments, where, key='id'):
+        """UPDATE `table` SET `assignments` for rows matching `where`, in batches.
+
+        Walks the primary key `batch_size` rows at a time and commits each
+        batch, so no statement locks more than one small range. `where`
+        should stop matching once a row is done, which makes it resumable.
+        Returns the number of rows updated.
+        """
+        last = None
+        updated = 0
+        while True:
+            if last is None:
+                self.execute(f"SELECT {key} FROM {table} WHERE {where} ORDER BY {key} LIMIT %s",
+                             (self.batch_size,))
+            else:
+                self.execute(f"SELECT {key} FROM {table} WHERE {key} > %s AND ({where}) "
+                             f"ORDER BY {key} LIMIT %s", (last, self.batch_size))
+            keys = [row[0] for row in self.cursor.fetchall()]
+            if not keys:
+                break
+            placeholders = ', '.join(['%s'] * len(keys))
+            self.execute(f"UPDATE {table} SET {assignments} WHERE {key} IN ({placeholders})", keys)
+            self.conn.commit()
+            updated += self.cursor.rowcount
+            last = keys[-1]
+            log.debug("Backfill batch", extra={'fields': {'table': table, 'rows': updated}})
+            if self.pause:
+                time.sleep(self.pause)
+        return updated
+
+    def close(self):
+        self.cursor.close()
+
+
+# --- Migrations; never edit one that has shipped, add a new version ---
+
+@migration(1, "Create users and password_reset_tokens")
+def _initial_schema(m):
+    m.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id VARCHAR(50) PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            age INT,
+            dob DATE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    m.execute("""
+        CREATE TABLE IF NOT EXISTS password_reset_tokens (
+            id VARCHAR(50) PRIMARY KEY,
+            user_id VARCHAR(50) NOT NULL,
+            token VARCHAR(100) UNIQUE NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+
+@migration(2, "Index reset tokens by expiry and by user")
+def _reset_token_indexes(m):
+    # The sweeper deletes by expiry; forgot_password caps tokens per user
+    m.add_index('password_reset_tokens', 'idx_prt_expires_at', 'expires_at')
+    m.add_index('password_reset_tokens', 'idx_prt_user_expires', 'user_id, expires_at')
+
+@migration(3, "Add hash_algorithm to users")
+def _user_columns(m):
+    m.add_columns('users', {'hash_algorithm': "VARCHAR(32) NULL"})
+
+@migration(4, "Index users by created_at")
+def _user_indexes(m):
+    m.add_index('users', 'idx_users_created_at', 'created_at')
+
+@migration(5, "Backfill users.hash_algorithm")
+def _backfill_hash_algorithm(m):
+    # Same rule as hashers.identify_hasher: a known prefix, else legacy
+    cases = ' '.join(f"WHEN password_hash LIKE '{name}$%%' THEN '{name}'"
+                     for name in hashers.HASHERS if name != hashers.LegacySHA256Hasher.algorithm)
+    m.backfill('users',
+               f"hash_algorithm = CASE {cases} ELSE '{hashers.LegacySHA256Hasher.algorithm}' END",
+               "hash_algorithm IS NULL")
+
+@migration(6, "Create sessions")
+def _sessions(m):
+    m.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id VARCHAR(36) PRIMARY KEY,
+            user_id VARCHAR(50) NOT NULL,
+            refresh_id VARCHAR(36) NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL,
+            INDEX idx_sessions_expires_at (expires_at),
+            INDEX idx_sessions_user_id (user_id),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+
+
+# --- Runner ---
+
+def _ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            duration_ms INT NOT NULL
+        )
+    """)
+
+def applied_versions(conn):
+    cursor = conn.cursor()
+    try:
+        _ensure_version_table(cursor)
+        cursor.execute("SELECT version FROM schema_version")
+        return {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+def current_version(conn):
+    return max(applied_versions(conn), default=0)
+
+def migrate(conn, target=None, lock_timeout=60):
+    """Apply pending migrations up to `target`; returns the versions applied.
+
+    A MySQL named lock keeps two processes (or hosts) from migrating at once;
+    the second waits, then finds nothing left to do.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, lock_timeout))
+        row = cursor.fetchone()
+        if not row or row[0] != 1:
+            raise RuntimeError("Timed out waiting for the migration lock")
+        try:
+            done = applied_versions(conn)
+            applied = []
+            for version, description, fn in MIGRATIONS:
+                if version in done or (target is not None and version > target):
+                    continue
+                log.info("Applying migration", extra={'fields': {'version': version, 'description': description}})
+                started = time.perf_counter()
+                migrator = Migrator(conn)
+                try:
+                    fn(migrator)
+                finally:
+                    migrator.close()
+                duration_ms = int((time.perf_counter() - started) * 1000)
+                cursor.execute("""
+                    INSERT INTO schema_version (version, description, duration_ms)
+                    VALUES (%s, %s, %s)
+                """, (version, description, duration_ms))
+                conn.commit()
+                applied.append(version)
+                log.info("Migration applied", extra={'fields': {'version': version, 'duration_ms': duration_ms}})
+            return applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Schema migrations")
+    commands = parser.add_subparsers(dest='command', required=True)
+    status = commands.add_parser('status', help="Show applied and pending migrations")
+    run = commands.add_parser('migrate', help="Apply pending migrations")
+    run.add_argument('--to', type=int, default=None, help="Stop after this version")
+    run.add_argument('--batch-size', type=int, default=None, help="Rows per backfill batch")
+    run.add_argument('--pause', type=float, default=None, help="Seconds to sleep between backfill batches")
+    for command in (status, run):
+        command.add_argument('--shard', default=None, help="Only this shard (DB_SHARDS)")
+    args = parser.parse_args(argv)
+
+    logs.setup()
+    import database as db
+    if args.command == 'migrate':
+        if args.batch_size is not None:
+            Config.MIGRATION_BATCH_SIZE = args.batch_size
+        if args.pause is not None:
+            Config.MIGRATION_BATCH_PAUSE = args.pause
+    for shard in [args.shard] if args.shard else db.shard_names():
+        if shard is not None:
+            print(f"Shard {shard}:")
+        conn = db.get_connection(shard)
+        if not conn:
+            sys.exit("Database connection failed")
+        try:
+            if args.command == 'status':
+                done = applied_versions(conn)
+                for version, description, _ in MIGRATIONS:
+                    print(f"{'applied' if version in done else 'pending':8} {version:4}  {description}")
+            else:
+                applied = migrate(conn, args.to)
+                print(f"Applied {len(applied)} migration(s); schema at version {current_version(conn)}")
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import threading
+import time
+from collections import deque
+import logs
+
+log = logs.get_logger('pool')
+
+
+class PooledConnection:
+    """Connection borrowed from a ConnectionPool; close() hands it back"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of database connections.
+
+    `factory` opens a new connection (or returns None on failure), the same
+    contract as storage.create_connection().
+    """
+
+    def __init__(self, factory, min_size=1, max_size=10, idle_timeout=300,
+                 health_check=True, borrow_timeout=5):
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.borrow_timeout = borrow_timeout
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, returned_at), most recent on the right
+        self._size = 0        # open connections, idle + borrowed
+        self._closed = False  # set by close_all; released connections are closed
+
+        # Counters for sizing the pool
+        self.borrowed = 0
+        self.waiting = 0
+        self.created = 0
+        self.closed = 0
+        self.borrow_count = 0
+        self.timeouts = 0
+
+    def fill(self):
+        """Open connections until min_size are available"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            conn = self._open()
+            if conn is None:
+                return
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def get_connection(self):
+        """Borrow a connection, waiting up to borrow_timeout for a free slot"""
+        deadline = time.monotonic() + self.borrow_timeout
+        conn = None
+        self._prune_idle()
+
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    if self._idle:
+                        conn, _ = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        self.timeouts += 1
+                        log.warning("Connection pool exhausted",
+                                    extra={'fields': {'max_size': self.max_size}})
+                        return None
+            finally:
+                self.waiting -= 1
+
+        if conn is not None and self.health_check and not self._is_alive(conn):
+            self._discard(conn, reserve=True)
+            conn = None
+
+        if conn is None:
+            conn = self._open()
+            if conn is None:
+                return None
+
+        with self._cond:
+            self.borrowed += 1
+            self.borrow_count += 1
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """Return a borrowed connection to the pool"""
+        try:
+            # Drop any open transaction so the next borrower starts clean
+            conn.rollback()
+        except Exception:
+            with self._cond:
+                self.borrowed -= 1
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self.borrowed -= 1
+            closed = self._closed
+            if not closed:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+        if closed:
+            self._discard(conn)
+
+    def close_all(self):
+        """Close every idle connection; borrowed ones close when released"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "borrowed": self.borrowed,
+                "waiting": self.waiting,
+                "created": self.created,
+                "closed": self.closed,
+                "borrow_count": self.borrow_count,
+                "timeouts": self.timeouts,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            }
+
+    def _open(self):
+        """Open a connection for a slot already reserved in _size"""
+        try:
+            conn = self.factory()
+        except Exception as e:
+            log.error("Connection pool error", extra={'fields': {'error': str(e)}})
+            conn = None
+        with self._cond:
+            if conn is None:
+                self._size -= 1
+                self._cond.notify()
+            else:
+                self.created += 1
+        return conn
+
+    def _discard(self, conn, reserve=False):
+        """Close a connection; with reserve=True its slot stays taken"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self.closed += 1
+            if not reserve:
+                self._size -= 1
+                self._cond.notify()
+
+    def _prune_idle(self):
+        """Close connections idle for idle_timeout, down to min_size"""
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._cond:
+            # Oldest idle connections sit on the left
+            while self._idle and self._size > self.min_size and self._idle[0][1] < cutoff:
+                expired.append(self._idle.popleft()[0])
+                self._size -= 1
+                self.closed += 1
+            if expired:
+                self._cond.notify(len(expired))
+        # Closing can wait on the server; don't hold up other borrowers meanwhile
+        for conn in expired:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            return conn.is_connected()
+        except Exception:
+            return False
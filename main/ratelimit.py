@@ -0,0 +1,137 @@
+"""In-process rate limiting and login lockout.
+
+Both keep per-key state in a bounded LRU: when full, the least recently
+seen key is dropped. An idle key's bucket has refilled anyway, so evicting
+it loses nothing but a stale lockout. State is per process; pre-forked
+workers each enforce the limits on their own share of the traffic.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+def parse_rate(spec):
+    """'20/1' -> (capacity 20, refill 20 per second); '' or '0' disables"""
+    if not spec or spec.strip() in ('0', 'off'):
+        return None
+    count, _, period = spec.partition('/')
+    count = float(count)
+    period = float(period or 1)
+    if count <= 0 or period <= 0:
+        return None
+    return count, count / period
+
+
+class TokenBucketLimiter:
+    """Token bucket per key: `capacity` requests at once, refilled at `rate` per second"""
+
+    def __init__(self, capacity, rate, max_keys=100000):
+        self.capacity = capacity
+        self.rate = rate
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at], least recent first
+
+        self.allowed = 0
+        self.limited = 0
+        self.evictions = 0
+
+    def take(self, key, cost=1):
+        """Spend `cost` tokens; returns 0 if allowed, else seconds until it would be"""
+        # A request bigger than the bucket costs a full one rather than never fitting
+        cost = min(cost, self.capacity)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.capacity, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0
+            self.limited += 1
+            return (cost - bucket[0]) / self.rate
+
+    def stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+                "evictions": self.evictions,
+            }
+
+
+class LoginThrottle:
+    """Exponential lockout after repeated failed logins for one account.
+
+    After `threshold` consecutive failures each further failure locks the
+    key for base * 2**(failures - threshold) seconds, capped at max_lockout.
+    A success clears the key; so does a quiet spell of reset_after, which
+    should be well above max_lockout: a key at the cap that is forgotten as
+    soon as its lockout ends would get `threshold` free guesses each time.
+    """
+
+    def __init__(self, threshold=5, base=1.0, max_lockout=900, max_keys=100000, reset_after=86400):
+        self.threshold = threshold
+        self.base = base
+        self.max_lockout = max_lockout
+        self.reset_after = reset_after
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> [failures, locked_until, last_failure]
+
+        self.lockouts = 0
+        self.rejected = 0
+
+    def check(self, key):
+        """Seconds the key is still locked for, or 0"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                return 0
+            self.rejected += 1
+            return entry[1] - now
+
+    def failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[2] > self.reset_after:
+                entry = self._entries[key] = [0, 0.0, now]
+                if len(self._entries) > self.max_keys:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            entry[0] += 1
+            entry[2] = now
+            if entry[0] >= self.threshold:
+                lockout = min(self.base * 2 ** (entry[0] - self.threshold), self.max_lockout)
+                entry[1] = now + lockout
+                self.lockouts += 1
+
+    def success(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._entries),
+                "lockouts": self.lockouts,
+                "rejected": self.rejected,
+            }
+
+
+def retry_after_seconds(delay):
+    """Retry-After header value: whole seconds, at least 1"""
+    return max(1, math.ceil(delay))
@@ -0,0 +1,215 @@
+"""Read replicas for the MySQL backend.
+
+MySQLStorage sends reads that tolerate a little replication lag to a
+ReplicaSet and everything else to the primary. A background thread pings
+each replica every DB_REPLICA_CHECK_INTERVAL seconds (and, with
+DB_REPLICA_MAX_LAG set, checks how far behind it is); a replica that fails
+a check or a query is skipped until a check passes again. With no healthy
+replica, reads fall back to the primary.
+
+RecentWrites gives read-your-writes: keys (user ids, emails, tokens) this
+process wrote in the last DB_READ_YOUR_WRITES_WINDOW seconds are read from
+the primary, so a login right after register or reset sees the new row
+even if the replicas haven't caught up. The window is per process, so a
+request served by another pre-forked worker or host can still read a
+replica that is behind by up to the replication lag. A user or token the
+replica doesn't have is therefore looked up again on the primary before
+the answer is "not found"; a changed row, such as a new password hash,
+can still be read stale for up to the lag.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+import logs
+
+log = logs.get_logger('replicas')
+
+SELECTIONS = ('round_robin', 'least_outstanding')
+
+
+def parse_replicas(spec, default_port=3306):
+    """'db2,db3:3307' -> [('db2', 3306), ('db3', 3307)]"""
+    replicas = []
+    for part in (spec or '').split(','):
+        host, _, port = part.strip().partition(':')
+        if host:
+            replicas.append((host, int(port or default_port)))
+    return replicas
+
+
+class Replica:
+    def __init__(self, host, port, pool):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.pool = pool
+        self.healthy = True
+        self.outstanding = 0
+        self.reads = 0
+        self.failures = 0
+        self.lag = None
+
+
+class ReplicaSet:
+    """Healthy-replica selection plus the background health checker"""
+
+    def __init__(self, replicas, selection='round_robin', check_interval=5, max_lag=0):
+        if selection not in SELECTIONS:
+            raise ValueError(f"Unknown replica selection {selection!r}; expected one of {', '.join(SELECTIONS)}")
+        self.replicas = replicas
+        self.selection = selection
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.check_interval > 0:
+            self._thread = threading.Thread(target=self._run, name='replica-health', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        for replica in self.replicas:
+            replica.pool.close_all()
+
+    def acquire(self):
+        """Pick a healthy replica and count a read against it, or None"""
+        with self._lock:
+            healthy = [r for r in self.replicas if r.healthy]
+            if not healthy:
+                return None
+            start = next(self._next)
+            if self.selection == 'least_outstanding':
+                # Rotate first so ties don't always go to the same replica
+                offset = start % len(healthy)
+                replica = min(healthy[offset:] + healthy[:offset], key=lambda r: r.outstanding)
+            else:
+                replica = healthy[start % len(healthy)]
+            replica.outstanding += 1
+            replica.reads += 1
+            return replica
+
+    def release(self, replica):
+        with self._lock:
+            replica.outstanding -= 1
+
+    def mark_down(self, replica, error):
+        with self._lock:
+            was_healthy, replica.healthy = replica.healthy, False
+            replica.failures += 1
+        if was_healthy:
+            log.warning("Replica marked down", extra={'fields': {'replica': replica.name, 'error': str(error)}})
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            self.check()
+
+    def check(self):
+        """Ping every replica and update its health"""
+        for replica in self.replicas:
+            healthy, error = self._probe(replica)
+            with self._lock:
+                was_healthy, replica.healthy = replica.healthy, healthy
+                if not healthy:
+                    replica.failures += 1
+            if healthy and not was_healthy:
+                log.info("Replica back up", extra={'fields': {'replica': replica.name, 'lag': replica.lag}})
+            elif was_healthy and not healthy:
+                log.warning("Replica marked down", extra={'fields': {'replica': replica.name, 'error': error}})
+
+    def _probe(self, replica):
+        conn = replica.pool.get_connection()
+        if conn is None:
+            return False, "connection failed"
+        cursor = None
+        try:
+            cursor = conn.cursor(dictionary=True)
+            if not self.max_lag:
+                cursor.execute("SELECT 1 AS ok")
+                cursor.fetchall()
+                return True, None
+            replica.lag = self._lag(cursor)
+            if replica.lag is None:
+                return False, "replication not running"
+            if replica.lag > self.max_lag:
+                return False, f"{replica.lag}s behind"
+            return True, None
+        except Exception as e:
+            return False, str(e)
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+            conn.close()
+
+    @staticmethod
+    def _lag(cursor):
+        """Seconds behind the primary, or None if replication is stopped"""
+        try:
+            cursor.execute("SHOW REPLICA STATUS")
+        except Exception:
+            # Servers before MySQL 8.0.22 only know the old name
+            cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone() or {}
+        cursor.fetchall()
+        lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        return None if lag is None else int(lag)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "replicas": len(self.replicas),
+                "healthy": sum(r.healthy for r in self.replicas),
+                "outstanding": sum(r.outstanding for r in self.replicas),
+                "reads": sum(r.reads for r in self.replicas),
+                "failures": sum(r.failures for r in self.replicas),
+            }
+
+
+class RecentWrites:
+    """Keys written in the last `window` seconds, oldest first"""
+
+    def __init__(self, window, max_keys=100000):
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()  # key -> written_at
+
+    def add(self, *keys):
+        if self.window <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                if key:
+                    self._keys[key] = now
+                    self._keys.move_to_end(key)
+            self._prune(now)
+
+    def __contains__(self, key):
+        written_at = self._keys.get(key)
+        return written_at is not None and time.monotonic() - written_at < self.window
+
+    def any(self, keys):
+        return any(key in self for key in keys if key)
+
+    def _prune(self, now):
+        # Called with the lock held
+        cutoff = now - self.window
+        while self._keys:
+            key, written_at = next(iter(self._keys.items()))
+            if written_at >= cutoff and len(self._keys) <= self.max_keys:
+                break
+            self._keys.popitem(last=False)
+
+    def __len__(self):
+        return len(self._keys)
+
@@ -0,0 +1,41 @@
+"""Stateless, HMAC-signed password reset tokens.
+
+    RST1.<key id>.<payload>.<signature>
+
+The payload carries the user id, email, name, expiry and a fingerprint of
+the user's current password hash, so a token can be checked without
+touching password_reset_tokens. Resetting the password changes the hash,
+which makes every outstanding token for that user stale; the reset UPDATE
+only matches while the fingerprint still does.
+
+RESET_TOKEN_KEYS is 'id:secret,id:secret'; see signing.py for rotation.
+"""
+import hashlib
+from config import Config
+from signing import Keyring, InvalidToken
+
+PREFIX = 'RST1'
+
+_keyring = Keyring(PREFIX, Config.RESET_TOKEN_KEYS,
+                   ephemeral=Config.RESET_TOKEN_MODE == 'signed')
+
+
+def fingerprint(password_hash):
+    """Short digest of a password hash; matches LEFT(SHA2(password_hash, 256), 16)"""
+    return hashlib.sha256(password_hash.encode('utf-8')).hexdigest()[:16]
+
+def is_signed(token):
+    return _keyring.owns(token)
+
+def issue(user, ttl=None):
+    """Signed token for `user` (id, email, name, password_hash)"""
+    return _keyring.dumps({
+        "u": user['id'],
+        "m": user['email'],
+        "n": user['name'],
+        "f": fingerprint(user['password_hash']),
+    }, Config.RESET_TOKEN_TTL if ttl is None else ttl)
+
+def decode(token):
+    """Verify signature and expiry; returns the payload or raises InvalidToken"""
+    return _keyring.loads(token)
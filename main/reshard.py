@@ -0,0 +1,240 @@
+"""Move users between shards while the servers keep running.
+
+    python reshard.py plan    --to 's0=db-a,s1=db-b,s2=db-c'
+    python reshard.py copy    --to 's0=db-a,s1=db-b,s2=db-c' --batch-size 1000 --pause 0.1
+    python reshard.py cleanup --to 's0=db-a,s1=db-b,s2=db-c'
+
+The current layout is DB_SHARDS, or --from. An unsharded server is the
+one-shard layout 's0=<DB_HOST>', which is where a first split starts.
+shards.py lists the steps and deploys around these commands.
+
+copy walks each old shard's users by id, batch_size at a time, and
+upserts the ones whose bucket moves into their new shard, replacing that
+shard's copy of their reset tokens and sessions with the old shard's. It
+can be stopped and rerun at any point. cleanup deletes moved users from
+their old shard, but only those already on the new one.
+"""
+import argparse
+import sys
+import time
+from collections import Counter
+from config import Config
+from shards import HashRing, parse_shards
+from storage import create_connection
+from utils import SHARD_BUCKETS, email_bucket
+import logs
+
+log = logs.get_logger('reshard')
+
+USER_COLUMNS = ('id', 'name', 'email', 'password_hash', 'hash_algorithm', 'age', 'dob',
+                'created_at')
+TOKEN_COLUMNS = ('id', 'user_id', 'token', 'created_at', 'expires_at')
+SESSION_COLUMNS = ('id', 'user_id', 'refresh_id', 'created_at', 'expires_at')
+
+
+class Layouts:
+    """The old and new shard lists, with a connection per server"""
+
+    def __init__(self, source_spec, target_spec):
+        self.source = parse_shards(source_spec)
+        self.target = parse_shards(target_spec)
+        for name in self.source.keys() & self.target.keys():
+            if self.source[name] != self.target[name]:
+                raise ValueError(f"Shard {name!r} has a different host in the new layout")
+        self.source_ring = HashRing(self.source)
+        self.target_ring = HashRing(self.target)
+        self._connections = {}
+
+    def moves(self):
+        return self.source_ring.moves(self.target_ring)
+
+    def connection(self, name):
+        if name not in self._connections:
+            host, port = dict(self.source, **self.target)[name]
+            conn = create_connection(host, port)
+            if conn is None:
+                raise RuntimeError(f"Could not connect to shard {name} ({host}:{port})")
+            self._connections[name] = conn
+        return self._connections[name]
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+
+
+def _scan(conn, batch_size):
+    """Batches of user rows in id order"""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        last_id = ''
+        while True:
+            cursor.execute(f"SELECT {', '.join(USER_COLUMNS)} FROM users "
+                           "WHERE id > %s ORDER BY id LIMIT %s", (last_id, batch_size))
+            rows = cursor.fetchall()
+            conn.commit()  # no long-lived read snapshot on a live server
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            yield rows
+    finally:
+        cursor.close()
+
+def _moving(layouts, source, rows):
+    """{new shard: [rows]} for the rows in `rows` that leave `source`"""
+    groups = {}
+    for row in rows:
+        target = layouts.target_ring.owner(email_bucket(row['email']))
+        if target != source:
+            groups.setdefault(target, []).append(row)
+    return groups
+
+def _select(cursor, table, columns, user_ids):
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE user_id IN ({placeholders})",
+                   list(user_ids))
+    return cursor.fetchall()
+
+def _insert(cursor, table, columns, rows, upsert=False):
+    if not rows:
+        return
+    placeholders = ', '.join(['(' + ', '.join(['%s'] * len(columns)) + ')'] * len(rows))
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES {placeholders}"
+    if upsert:
+        sql += " ON DUPLICATE KEY UPDATE " + ', '.join(f"{c} = VALUES({c})" for c in columns if c != 'id')
+    cursor.execute(sql, [row[c] for row in rows for c in columns])
+
+def _copy_batch(source_conn, target_conn, users, stats):
+    """Upsert `users` into the target, with exactly the source's tokens and sessions"""
+    target = target_conn.cursor(dictionary=True)
+    source = source_conn.cursor(dictionary=True)
+    try:
+        # The same email under another id is a user registered on both
+        # shards during the deploy; leave it for a person to resolve
+        placeholders = ', '.join(['%s'] * len(users))
+        target.execute(f"SELECT id, email FROM users WHERE email IN ({placeholders})",
+                       [u['email'] for u in users])
+        taken = {row['email']: row['id'] for row in target.fetchall()}
+        conflicts = [u for u in users if taken.get(u['email'], u['id']) != u['id']]
+        for user in conflicts:
+            log.warning("Email on both shards under different ids", extra={'fields': {
+                'email': user['email'], 'user_id': user['id'], 'other_id': taken[user['email']]
+            }})
+        stats['conflicts'] += len(conflicts)
+        users = [u for u in users if taken.get(u['email'], u['id']) == u['id']]
+        if not users:
+            target_conn.commit()
+            return
+
+        user_ids = [u['id'] for u in users]
+        tokens = _select(source, 'password_reset_tokens', TOKEN_COLUMNS, user_ids)
+        user_sessions = _select(source, 'sessions', SESSION_COLUMNS, user_ids)
+        source_conn.commit()
+
+        _insert(target, 'users', USER_COLUMNS, users, upsert=True)
+        placeholders = ', '.join(['%s'] * len(user_ids))
+        for table in ('password_reset_tokens', 'sessions'):
+            target.execute(f"DELETE FROM {table} WHERE user_id IN ({placeholders})", user_ids)
+        _insert(target, 'password_reset_tokens', TOKEN_COLUMNS, tokens)
+        _insert(target, 'sessions', SESSION_COLUMNS, user_sessions)
+        target_conn.commit()
+    except Exception:
+        target_conn.rollback()
+        raise
+    finally:
+        source.close()
+        target.close()
+    stats['copied'] += len(users)
+    stats['tokens'] += len(tokens)
+    stats['sessions'] += len(user_sessions)
+
+def copy(layouts, batch_size=1000, pause=0.0):
+    """Copy every moving user to its new shard; returns counts"""
+    stats = Counter(scanned=0, copied=0, conflicts=0, tokens=0, sessions=0)
+    sources = sorted({source for source, _ in layouts.moves().values()})
+    for source in sources:
+        source_conn = layouts.connection(source)
+        for rows in _scan(source_conn, batch_size):
+            stats['scanned'] += len(rows)
+            for target, users in _moving(layouts, source, rows).items():
+                _copy_batch(source_conn, layouts.connection(target), users, stats)
+            log.info("Copy batch done", extra={'fields': dict(stats, shard=source, last_id=rows[-1]['id'])})
+            if pause:
+                time.sleep(pause)
+    return stats
+
+def cleanup(layouts, batch_size=1000, pause=0.0):
+    """Delete moved users from their old shard once the new shard has them"""
+    stats = Counter(scanned=0, deleted=0, missing=0)
+    sources = sorted({source for source, _ in layouts.moves().values()})
+    for source in sources:
+        source_conn = layouts.connection(source)
+        for rows in _scan(source_conn, batch_size):
+            stats['scanned'] += len(rows)
+            deletable = []
+            for target, users in _moving(layouts, source, rows).items():
+                cursor = layouts.connection(target).cursor()
+                try:
+                    placeholders = ', '.join(['%s'] * len(users))
+                    cursor.execute(f"SELECT id FROM users WHERE id IN ({placeholders})", [u['id'] for u in users])
+                    present = {row[0] for row in cursor.fetchall()}
+                finally:
+                    cursor.close()
+                    layouts.connection(target).commit()
+                stats['missing'] += len(users) - len(present)
+                deletable.extend(present)
+            if deletable:
+                cursor = source_conn.cursor()
+                try:
+                    # Tokens and sessions go with them (ON DELETE CASCADE)
+                    placeholders = ', '.join(['%s'] * len(deletable))
+                    cursor.execute(f"DELETE FROM users WHERE id IN ({placeholders})", deletable)
+                    source_conn.commit()
+                    stats['deleted'] += cursor.rowcount
+                finally:
+                    cursor.close()
+            log.info("Cleanup batch done", extra={'fields': dict(stats, shard=source, last_id=rows[-1]['id'])})
+            if pause:
+                time.sleep(pause)
+    return stats
+
+def plan(layouts):
+    moves = layouts.moves()
+    print(f"{len(moves)} of {SHARD_BUCKETS} buckets move")
+    for (source, target), count in sorted(Counter(moves.values()).items()):
+        print(f"  {source} -> {target}: {count} buckets")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move users between shards")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, text in (('plan', "Show which buckets move"),
+                       ('copy', "Copy moving users to their new shards (rerunnable)"),
+                       ('cleanup', "Delete moved users from their old shards")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument('--to', required=True, help="New layout, name=host[:port],...")
+        command.add_argument('--from', dest='source', default=None, help="Current layout (default DB_SHARDS)")
+        if name != 'plan':
+            command.add_argument('--batch-size', type=int, default=1000, help="Users per batch")
+            command.add_argument('--pause', type=float, default=0.0, help="Seconds to sleep between batches")
+    args = parser.parse_args(argv)
+
+    source = args.source or Config.DB_SHARDS
+    if not source:
+        sys.exit(f"Set DB_SHARDS or --from; a single server is --from 's0={Config.DB_HOST}'")
+    logs.setup()
+    layouts = Layouts(source, args.to)
+    try:
+        if args.command == 'plan':
+            plan(layouts)
+        else:
+            started = time.perf_counter()
+            run = copy if args.command == 'copy' else cleanup
+            stats = run(layouts, args.batch_size, args.pause)
+            summary = ', '.join(f"{key} {value}" for key, value in stats.items())
+            print(f"{args.command.capitalize()} finished in {time.perf_counter() - started:.1f}s: {summary}")
+    finally:
+        layouts.close()
+
+
+if __name__ == '__main__':
+    main()
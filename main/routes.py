@@ -0,0 +1,511 @@
+"""Route logic shared by the threaded (API.py) and asyncio (async_server.py) servers.
+
+Each handler takes the decoded request data and returns (status_code, payload).
+"""
+from config import Config
+from codec import parse_body
+from utils import is_valid_email, normalize_email, validate_password_strength, PASSWORD_ERRORS
+from utils import breached_password_stats
+from ratelimit import TokenBucketLimiter, LoginThrottle, parse_rate, retry_after_seconds
+import database as db
+import sessions
+import hash_executor
+import sweeper
+import logs
+import metrics
+
+log = logs.get_logger('routes')
+
+def _bad_request(message):
+    return 400, {"error": message}
+
+# Ready-made responses for the common validation failures; shared, so never
+# modify one (batch results copy them)
+NAME_EMAIL_PASSWORD_REQUIRED = _bad_request("Name, email and password are required")
+INVALID_EMAIL = _bad_request("Invalid email format")
+PASSWORD_REQUIRED = _bad_request("Password is required")
+EMAIL_AND_USER_ID = _bad_request("Provide either email or user_id, not both")
+EMAIL_OR_USER_ID_REQUIRED = _bad_request("Email or user_id is required")
+EMAIL_REQUIRED = _bad_request("Email is required")
+TOKEN_REQUIRED = _bad_request("Token is required")
+TOKEN_AND_PASSWORD_REQUIRED = _bad_request("Token and new password are required")
+EXPECTED_OBJECT = _bad_request("Expected a JSON object")
+EXPECTED_ARRAY = _bad_request("Expected a JSON array")
+EXPECTED_TOKEN = _bad_request("Expected a token")
+BATCH_EMPTY = _bad_request("Batch is empty")
+WEAK_PASSWORD = {message: _bad_request(message) for message in PASSWORD_ERRORS}
+INTERNAL_ERROR = 500, {"error": "Internal server error"}
+
+def _validate_register(data):
+    """Per-item checks for /register; returns an error response or None"""
+    name = data.get('name', '').strip()
+    email = data.get('email', '').strip()
+    password = data.get('password', '')
+    
+    # Validate required fields for registration
+    if not name or not email or not password:
+        return NAME_EMAIL_PASSWORD_REQUIRED
+    
+    # Validate email format for registration
+    if not is_valid_email(email):
+        return INVALID_EMAIL
+    
+    # Validate password strength
+    is_strong, password_error = validate_password_strength(password)
+    if not is_strong:
+        return WEAK_PASSWORD[password_error]
+    
+    return None
+
+def _register_response(result):
+    if 'error' in result:
+        error_msg = result['error']
+        log.info("Registration error", extra={'fields': {'route': '/register', 'error': error_msg}})
+        
+        if 'already registered' in error_msg.lower():
+            return 409, {"error": "Email already registered"}
+        elif 'server busy' in error_msg.lower():
+            return 503, {"error": error_msg}
+        elif 'database' in error_msg.lower():
+            return 500, {"error": error_msg}
+        else:
+            return 500, {"error": error_msg}
+    else:
+        return 201, {
+            "message": "User registered successfully",
+            "user_id": result["user_id"],
+            "name": result["name"],
+            "email": result["email"]
+        }
+
+def handle_register(data):
+    with metrics.stage('validate'):
+        error = _validate_register(data)
+    if error:
+        return error
+    
+    # Register user in database
+    result = db.register_user(data['name'].strip(), data['email'].strip(), data['password'],
+                              data.get('age'), data.get('dob'))
+    return _register_response(result)
+
+def _validate_login(data):
+    """Checks for /login; returns an error response or None"""
+    email = data.get('email', '').strip()
+    user_id = data.get('user_id', '').strip()
+    password = data.get('password', '')
+    
+    # Validate required fields for login
+    if not password:
+        return PASSWORD_REQUIRED
+    
+    # Checking if both email and user_id are provided 
+    if email and user_id:
+        return EMAIL_AND_USER_ID
+    
+    # Checking if neither email nor user_id is provided
+    if not email and not user_id:
+        return EMAIL_OR_USER_ID_REQUIRED
+    
+    # Validateing email format if email is provided
+    if email and not is_valid_email(email):
+        return INVALID_EMAIL
+    
+    return None
+
+def handle_login(data):
+    with metrics.stage('validate'):
+        error = _validate_login(data)
+    if error:
+        return error
+    
+    email = data.get('email', '').strip()
+    user_id = data.get('user_id', '').strip()
+    password = data['password']
+    
+    # Login user - pass both email and user_id to the database function
+    result = db.login_user(email=email, password=password, user_id=user_id)
+    
+    if 'error' in result:
+        error_msg = result['error']
+        log.info("Login error", extra={'fields': {'route': '/login', 'error': error_msg}})
+        
+        if 'not found' in error_msg.lower():
+            return 404, {"error": "User not found"}
+        elif 'invalid password' in error_msg.lower():
+            return 401, {"error": "Invalid password"}
+        elif 'server busy' in error_msg.lower():
+            return 503, {"error": error_msg}
+        elif 'database' in error_msg.lower():
+            return 500, {"error": error_msg}
+        else:
+            return 500, {"error": error_msg}
+    else:
+        return 200, {
+            "message": "Login successful",
+            "user_id": result["user_id"],
+            "name": result["name"],
+            "email": result["email"],
+            "access_token": result["access_token"],
+            "refresh_token": result["refresh_token"],
+            "token_type": result["token_type"],
+            "expires_in": result["expires_in"]
+        }
+
+def bearer_token(authorization):
+    """Token from an 'Authorization: Bearer <token>' header value, or None"""
+    scheme, _, token = (authorization or '').strip().partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    return token.strip()
+
+def handle_me(data, bearer=None):
+    """Who the access token belongs to; no database access"""
+    token = bearer or str(data.get('access_token') or '').strip()
+    if not token:
+        return 401, {"error": "Access token is required"}
+    try:
+        claims = sessions.authenticate(token)
+    except sessions.InvalidToken as e:
+        return 401, {"error": f"Invalid access token: {e}"}
+    return 200, {
+        "user_id": claims["u"],
+        "name": claims["n"],
+        "email": claims["m"],
+        "session_id": claims["s"],
+        "expires_at": claims["e"]
+    }
+
+def handle_refresh(data, bearer=None):
+    """Trade a refresh token for a new access/refresh pair"""
+    token = str(data.get('refresh_token') or '').strip() or bearer
+    if not token:
+        return 400, {"error": "Refresh token is required"}
+    
+    result = db.refresh_session(token)
+    
+    if 'error' in result:
+        if 'database' in result['error'].lower():
+            return 500, {"error": result['error']}
+        return 401, {"error": result['error']}
+    return 200, result
+
+def handle_logout(data, bearer=None):
+    """End the session named by an access token (or, once that has expired, a refresh token)"""
+    access_token = bearer or str(data.get('access_token') or '').strip()
+    refresh_token = str(data.get('refresh_token') or '').strip()
+    if not access_token and not refresh_token:
+        return 400, {"error": "Access or refresh token is required"}
+    try:
+        if access_token:
+            claims = sessions.authenticate(access_token)
+        else:
+            claims = sessions.decode_refresh(refresh_token)
+    except sessions.InvalidToken as e:
+        return 401, {"error": f"Invalid token: {e}"}
+    
+    result = db.end_session(claims["s"], claims["u"])
+    
+    if 'error' in result:
+        return 500, {"error": result['error']}
+    return 200, result
+
+def _validate_forgot_password(data):
+    """Checks for /forgot-password; returns an error response or None"""
+    email = data.get('email', '').strip()
+    
+    if not email:
+        return EMAIL_REQUIRED
+    
+    if not is_valid_email(email):
+        return INVALID_EMAIL
+    
+    return None
+
+def handle_forgot_password(data):
+    """Handle forgot password request"""
+    with metrics.stage('validate'):
+        error = _validate_forgot_password(data)
+    if error:
+        return error
+    
+    email = data['email'].strip()
+    
+    # Generate reset token
+    result = db.forgot_password(email)
+    
+    if 'error' in result:
+        # For security, don't reveal if email exists
+        return 200, {
+            "message": "If your email is registered, you will receive a reset token"
+        }
+    else:
+        return 200, {
+            "message": "Reset token generated successfully",
+            "reset_token": result["reset_token"],
+            "next_step": "Use this token with /reset-password endpoint to set new password"
+        }
+
+def _validate_verify_token(data):
+    """Per-item checks for /verify-token; returns an error response or None"""
+    if not data.get('token', '').strip():
+        return TOKEN_REQUIRED
+    return None
+
+def _verify_token_response(result):
+    if 'error' in result:
+        return 400, {"error": result['error']}
+    else:
+        return 200, {
+            "valid": True,
+            "message": "Token is valid",
+            "email": result['email'],
+            "name": result['name']
+        }
+
+def handle_verify_token(data):
+    """Verify if reset token is valid"""
+    with metrics.stage('validate'):
+        error = _validate_verify_token(data)
+    if error:
+        return error
+    
+    result = db.verify_reset_token(data['token'].strip())
+    return _verify_token_response(result)
+
+def _validate_reset_password(data):
+    """Checks for /reset-password; returns an error response or None"""
+    if not data.get('token', '').strip() or not data.get('new_password', ''):
+        return TOKEN_AND_PASSWORD_REQUIRED
+    return None
+
+def handle_reset_password(data):
+    """Reset password with token"""
+    with metrics.stage('validate'):
+        error = _validate_reset_password(data)
+    if error:
+        return error
+    
+    token = data['token'].strip()
+    new_password = data['new_password']
+    
+    # Reset the password
+    result = db.reset_password(token, new_password)
+    
+    if 'error' in result:
+        if 'server busy' in result['error'].lower():
+            return 503, {"error": result['error']}
+        return 400, {"error": result['error']}
+    else:
+        return 200, {
+            "message": "Password reset successfully! You can now login with your new password."
+        }
+
+def _batch_items(data):
+    """Items of a batch request, or an error response"""
+    if not isinstance(data, list):
+        return None, EXPECTED_ARRAY
+    if not data:
+        return None, BATCH_EMPTY
+    if len(data) > Config.MAX_BATCH_SIZE:
+        return None, (413, {"error": f"Batch is limited to {Config.MAX_BATCH_SIZE} items"})
+    return data, None
+
+def _batch_result(results):
+    return 200, {
+        "results": [dict(payload, status=status) for status, payload in results]
+    }
+
+def handle_register_batch(data):
+    """Register many users with one query round trip and one commit"""
+    items, error = _batch_items(data)
+    if error:
+        return error
+    
+    results = [None] * len(items)
+    valid = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = EXPECTED_OBJECT
+            continue
+        with metrics.stage('validate'):
+            results[i] = _validate_register(item)
+        if results[i] is None:
+            valid.append(i)
+    
+    if valid:
+        users = [(items[i]['name'].strip(), items[i]['email'].strip(), items[i]['password'],
+                  items[i].get('age'), items[i].get('dob')) for i in valid]
+        for i, result in zip(valid, db.register_users(users)):
+            results[i] = _register_response(result)
+    
+    return _batch_result(results)
+
+def handle_verify_token_batch(data):
+    """Verify many reset tokens with one query"""
+    items, error = _batch_items(data)
+    if error:
+        return error
+    
+    # Accept ["token", ...] as well as [{"token": "..."}, ...]
+    items = [{"token": item} if isinstance(item, str) else item for item in items]
+    results = [None] * len(items)
+    valid = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = EXPECTED_TOKEN
+            continue
+        with metrics.stage('validate'):
+            results[i] = _validate_verify_token(item)
+        if results[i] is None:
+            valid.append(i)
+    
+    if valid:
+        tokens = [items[i]['token'].strip() for i in valid]
+        for i, result in zip(valid, db.verify_reset_tokens(tokens)):
+            results[i] = _verify_token_response(result)
+    
+    return _batch_result(results)
+
+BATCH_ROUTES = {'/register/batch', '/verify-token/batch'}
+
+# Handlers that also take the bearer token from the Authorization header
+SESSION_ROUTES = {'/me', '/refresh', '/logout'}
+
+ROUTES = {
+    '/register': handle_register,
+    '/login': handle_login,
+    '/forgot-password': handle_forgot_password,
+    '/reset-password': handle_reset_password,
+    '/verify-token': handle_verify_token,
+    '/register/batch': handle_register_batch,
+    '/verify-token/batch': handle_verify_token_batch,
+    '/me': handle_me,
+    '/refresh': handle_refresh,
+    '/logout': handle_logout,
+}
+
+def route_label(path):
+    """Path as a metrics label; unknown paths share one label"""
+    return path if path in ROUTES or path == '/metrics' else 'other'
+
+def _limiter(spec):
+    rate = parse_rate(spec)
+    if rate is None:
+        return None
+    return TokenBucketLimiter(*rate, max_keys=Config.RATE_LIMIT_MAX_KEYS)
+
+_ip_limiter = _limiter(Config.RATE_LIMIT_IP)
+_account_limiters = {
+    '/login': _limiter(Config.RATE_LIMIT_LOGIN),
+    '/forgot-password': _limiter(Config.RATE_LIMIT_FORGOT),
+}
+_login_throttle = LoginThrottle(
+    Config.LOGIN_LOCKOUT_THRESHOLD, Config.LOGIN_LOCKOUT_BASE,
+    Config.LOGIN_LOCKOUT_MAX, Config.RATE_LIMIT_MAX_KEYS, Config.LOGIN_LOCKOUT_RESET
+) if Config.LOGIN_LOCKOUT_THRESHOLD > 0 else None
+
+def _account_key(path, data):
+    """The account a /login or /forgot-password request targets, or None"""
+    if path not in _account_limiters or not isinstance(data, dict):
+        return None
+    user_id = str(data.get('user_id') or '').strip()
+    if user_id and path == '/login':
+        return f"id:{user_id}"
+    email = str(data.get('email') or '').strip()
+    return f"email:{normalize_email(email)}" if email else None
+
+def _too_many_requests(delay):
+    return 429, {"error": "Too many requests, try again later",
+                 "retry_after": retry_after_seconds(delay)}
+
+def _check_limits(path, data, client, account):
+    """429 response if the client or account is over its limit, else None"""
+    if _ip_limiter and client:
+        cost = len(data) if path in BATCH_ROUTES and isinstance(data, list) else 1
+        delay = _ip_limiter.take(client, max(cost, 1))
+        if delay:
+            return _too_many_requests(delay)
+    if account is None:
+        return None
+    if path == '/login' and _login_throttle:
+        delay = _login_throttle.check(account)
+        if delay:
+            return _too_many_requests(delay)
+    limiter = _account_limiters.get(path)
+    if limiter:
+        delay = limiter.take(account)
+        if delay:
+            return _too_many_requests(delay)
+    return None
+
+def response_headers(status_code, payload):
+    """Extra headers for a dispatch() response"""
+    if status_code == 429:
+        return {'Retry-After': str(payload['retry_after'])}
+    return None
+
+def render_metrics():
+    """/metrics body: request metrics plus pool, replica, shard, cache, hashing, sweeper,
+    rate limit, session and password blocklist gauges"""
+    gauges = {}
+    for prefix, stats in (('api_db_pool', db.pool_stats()),
+                          ('api_db_replicas', db.replica_stats()),
+                          ('api_db_shards', db.shard_stats()),
+                          ('api_user_cache', db.cache_stats()),
+                          ('api_user_filter', db.user_filter_stats()),
+                          ('api_hash_queue', hash_executor.stats()),
+                          ('api_token_sweeper', sweeper.stats()),
+                          ('api_rate_limit_ip', _ip_limiter and _ip_limiter.stats()),
+                          ('api_rate_limit_login', _account_limiters['/login'] and _account_limiters['/login'].stats()),
+                          ('api_rate_limit_forgot', _account_limiters['/forgot-password'] and _account_limiters['/forgot-password'].stats()),
+                          ('api_login_throttle', _login_throttle and _login_throttle.stats()),
+                          ('api_session_denylist', sessions.stats()),
+                          ('api_password_blocklist', breached_password_stats())):
+        for key, value in (stats or {}).items():
+            if isinstance(value, (int, float)):
+                gauges[f"{prefix}_{key}"] = value
+    return metrics.render(gauges)
+
+def dispatch(path, data, client=None, authorization=None):
+    """Run the handler for `path`; returns (status_code, payload)
+
+    `client` is the peer IP for rate limiting, which happens before any
+    database or hashing work. `authorization` is the Authorization header.
+    Never raises: a bug in a handler is logged and answered with a 500, so
+    the servers always send a response and record the request as finished.
+    """
+    metrics.set_route(route_label(path))
+    try:
+        return _dispatch(path, data, client, authorization)
+    except Exception:
+        log.error("Unhandled error", exc_info=True, extra={'fields': {'route': route_label(path)}})
+        return INTERNAL_ERROR
+
+def _dispatch(path, data, client, authorization):
+    handler = ROUTES.get(path)
+    if handler is None:
+        return 404, {"error": "Endpoint not found"}
+    if path not in BATCH_ROUTES and not isinstance(data, dict):
+        return EXPECTED_OBJECT
+    
+    account = None
+    if Config.RATE_LIMIT_ENABLED:
+        account = _account_key(path, data)
+        limited = _check_limits(path, data, client, account)
+        if limited:
+            log.info("Rate limited", extra={'fields': {'route': path, 'client': client}})
+            return limited
+    
+    if path in SESSION_ROUTES:
+        status_code, payload = handler(data, bearer_token(authorization))
+    else:
+        status_code, payload = handler(data)
+    
+    if path == '/login' and account and _login_throttle:
+        # Counted in memory; a failed login costs no database write
+        if status_code == 401:
+            _login_throttle.failure(account)
+        elif status_code == 200:
+            _login_throttle.success(account)
+    return status_code, payload
@@ -0,0 +1,191 @@
+import os
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+from config import Config
+import logs
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that hands each connection to a bounded thread pool.
+
+    At most `max_inflight` connections are served at once; past that the
+    accept loop waits and new connections queue in the listen backlog. A
+    keep-alive connection holds its slot until the client closes it, it
+    idles out or it has made `max_keepalive_requests` requests.
+    """
+
+    def __init__(self, server_address, handler_class, max_threads=16,
+                 max_inflight=64, backlog=128, max_keepalive_requests=100):
+        self.request_queue_size = backlog
+        self.max_keepalive_requests = max(max_keepalive_requests, 1)
+        self.max_inflight = max(max_inflight, 1)
+        self.inflight = 0
+        self._inflight_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_inflight)
+        self._executor = ThreadPoolExecutor(max_workers=max_threads,
+                                            thread_name_prefix='api-worker')
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        with self._inflight_lock:
+            self.inflight += 1
+        try:
+            self._executor.submit(self._process_request, request, client_address)
+        except RuntimeError:
+            # Executor already shut down
+            self._done()
+            self.shutdown_request(request)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._done()
+
+    def _done(self):
+        with self._inflight_lock:
+            self.inflight -= 1
+        self._slots.release()
+
+    def drain(self, timeout):
+        """Wait up to `timeout` seconds for in-flight requests to finish"""
+        deadline = time.monotonic() + timeout
+        acquired = 0
+        for _ in range(self.max_inflight):
+            if not self._slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                break
+            acquired += 1
+        if acquired < self.max_inflight:
+            print(f"Shutdown timeout: {self.inflight} request(s) still running")
+        self._executor.shutdown(wait=False)
+        return acquired == self.max_inflight
+
+
+def make_server(handler_class):
+    """Build the HTTP server for Config.SERVER_MODE"""
+    address = (Config.SERVER_HOST, Config.SERVER_PORT)
+    if Config.SERVER_MODE == 'single':
+        server = HTTPServer(address, handler_class)
+        # One connection at a time, so a kept-alive client would lock out the rest
+        server.max_keepalive_requests = 1
+        return server
+    return PooledHTTPServer(
+        address,
+        handler_class,
+        max_threads=Config.SERVER_THREADS,
+        max_inflight=Config.SERVER_MAX_INFLIGHT,
+        backlog=Config.SERVER_BACKLOG,
+        max_keepalive_requests=Config.SERVER_MAX_KEEPALIVE_REQUESTS
+    )
+
+
+def serve(server, shutdown_timeout):
+    """Run serve_forever() until SIGINT/SIGTERM, then drain in-flight requests"""
+    stopping = threading.Event()
+
+    def _stop(signum, frame):
+        if not stopping.is_set():
+            stopping.set()
+            print(f"\n Shutting down server (pid {os.getpid()})...")
+            # shutdown() blocks until serve_forever() returns, so it cannot
+            # run on the thread that is inside serve_forever()
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    previous = _install_handlers(_stop)
+    try:
+        server.serve_forever()
+    finally:
+        if isinstance(server, PooledHTTPServer):
+            server.drain(shutdown_timeout)
+        server.server_close()
+        _install_handlers(previous)
+
+
+def serve_prefork(server, workers, shutdown_timeout, after_fork=None):
+    """Fork `workers` processes that all accept on the server's listening socket.
+
+    The parent only supervises: it restarts workers that die and forwards
+    SIGINT/SIGTERM so every worker drains before exiting. Workers are
+    numbered 1 to `workers`, a replacement taking the number of the one it
+    replaces; `after_fork(number)` runs first in each.
+    """
+    children = {}  # pid -> (started, worker number)
+    stopping = threading.Event()
+
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                if after_fork:
+                    after_fork(number)
+                serve(server, shutdown_timeout)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                # os._exit skips atexit, so flush queued log records first
+                logs.shutdown()
+                os._exit(code)
+        children[pid] = (time.monotonic(), number)
+
+    def _kill_stragglers():
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _stop(signum, frame):
+        if stopping.is_set():
+            return
+        stopping.set()
+        print(f"\n Shutting down {len(children)} worker(s)...")
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        # Give workers the drain timeout plus a little slack, then force them
+        timer = threading.Timer(shutdown_timeout + 5, _kill_stragglers)
+        timer.daemon = True
+        timer.start()
+
+    previous = _install_handlers(_stop)
+    try:
+        for number in range(1, workers + 1):
+            spawn(number)
+        print(f"Started {workers} worker processes")
+
+        while children:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            child = children.pop(pid, None)
+            if stopping.is_set() or child is None:
+                continue
+            started, number = child
+            print(f"Worker {pid} exited unexpectedly, restarting")
+            if time.monotonic() - started < 1:
+                # Avoid a tight crash loop
+                time.sleep(1)
+            spawn(number)
+    finally:
+        server.server_close()
+        _install_handlers(previous)
+
+
+def _install_handlers(handler):
+    """Install `handler` for SIGINT/SIGTERM; returns the previous handlers"""
+    if not isinstance(handler, dict):
+        handler = {signal.SIGINT: handler, signal.SIGTERM: handler}
+    return {sig: signal.signal(sig, h) for sig, h in handler.items()}
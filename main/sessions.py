@@ -0,0 +1,110 @@
+"""Login sessions: short-lived access tokens and rotating refresh tokens.
+
+    AT1.<key id>.<payload>.<signature>    access, SESSION_ACCESS_TTL
+    RT1.<key id>.<payload>.<signature>    refresh, SESSION_REFRESH_TTL
+
+An access token carries the session id, user id, email and name, so
+authenticate() is a signature and expiry check plus a dict lookup in the
+denylist; it never touches the database. A refresh token names the
+session and its current refresh id; the sessions row holds the only
+refresh id that is still good, so each one works once (see
+database.refresh_session).
+
+Logging out deletes the row and denylists the session id until its last
+access token would have expired anyway; a password reset does the same
+for every session of the user. The denylist is per process:
+pre-forked workers other than the one that served /logout keep accepting
+that session's access tokens for up to SESSION_ACCESS_TTL.
+"""
+import os
+import threading
+import time
+import uuid
+from config import Config
+from signing import Keyring, InvalidToken
+
+ACCESS_PREFIX = 'AT1'
+REFRESH_PREFIX = 'RT1'
+
+_access_keyring = Keyring(ACCESS_PREFIX, Config.SESSION_KEYS, ephemeral=True)
+_refresh_keyring = Keyring(REFRESH_PREFIX, Config.SESSION_KEYS, ephemeral=True)
+
+
+class Denylist:
+    """Revoked session ids, each kept only until its access tokens expire"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # session id -> unix time it can be forgotten
+        self._next_prune = 0.0
+
+        self.revoked = 0
+        self.rejected = 0
+
+    def add(self, session_id):
+        now = time.time()
+        with self._lock:
+            self._entries[session_id] = now + self.ttl
+            self.revoked += 1
+            if now >= self._next_prune:
+                self._entries = {sid: until for sid, until in self._entries.items() if until > now}
+                self._next_prune = now + min(self.ttl, 60)
+
+    def __contains__(self, session_id):
+        # Plain dict read; revoked ids are rare, so the common case is one miss
+        until = self._entries.get(session_id)
+        if until is None or until <= time.time():
+            return False
+        self.rejected += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "revoked": self.revoked,
+                "rejected": self.rejected,
+            }
+
+
+denylist = Denylist(Config.SESSION_ACCESS_TTL)
+
+
+def new_id():
+    return str(uuid.uuid4())
+
+def issue(session_id, refresh_id, user):
+    """Token response for `user` (id, email, name) in session `session_id`"""
+    claims = {"s": session_id, "u": user['id'], "m": user['email'], "n": user['name']}
+    return {
+        "access_token": _access_keyring.dumps(claims, Config.SESSION_ACCESS_TTL),
+        "refresh_token": _refresh_keyring.dumps(dict(claims, j=refresh_id), Config.SESSION_REFRESH_TTL),
+        "token_type": "Bearer",
+        "expires_in": Config.SESSION_ACCESS_TTL,
+    }
+
+def authenticate(access_token):
+    """Payload of a valid, unrevoked access token; raises InvalidToken"""
+    payload = _access_keyring.loads(access_token)
+    if payload.get("s") in denylist:
+        raise InvalidToken("Session revoked")
+    return payload
+
+def decode_refresh(refresh_token):
+    """Payload of a validly signed, unexpired refresh token; raises InvalidToken"""
+    return _refresh_keyring.loads(refresh_token)
+
+def revoke(session_id):
+    denylist.add(session_id)
+
+def stats():
+    return denylist.stats()
+
+
+def _reset_after_fork():
+    # Lock state isn't safe to inherit; entries are, and are worth keeping
+    denylist._lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
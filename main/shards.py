@@ -0,0 +1,298 @@
+"""Sharding the users table over several MySQL servers.
+
+Every user is in one of utils.SHARD_BUCKETS buckets, picked by hashing the
+normalized email and written into the user id, so a login by either key
+knows its bucket without asking anyone. A consistent-hash ring assigns
+buckets to the shards in DB_SHARDS: each shard sits at VNODES points on
+the ring and owns the buckets that fall just before them, so adding or
+removing a shard moves about 1/N of the buckets and leaves the rest alone.
+
+Reset tokens and sessions live on their user's shard. Lookups by reset
+token, expiry sweeps and the user filter's scans ask every shard. Ids
+issued before buckets carry none; such a user is found by asking every
+shard once, then their bucket is remembered.
+
+reshard.py moves users while the servers keep serving:
+
+ 1. reshard.py copy --to NEW copies the users whose bucket moves.
+ 2. Deploy DB_SHARDS=NEW with DB_SHARDS_PREVIOUS=OLD. Moving buckets are
+    then read from the new shard, falling back to the old one, and every
+    update goes to both copies. New users go to the new shard.
+ 3. reshard.py copy --to NEW again, for what processes still on OLD wrote
+    during the deploy.
+ 4. Deploy without DB_SHARDS_PREVIOUS, then reshard.py cleanup --to NEW
+    deletes the moved users from their old shards.
+"""
+import bisect
+import hashlib
+from config import Config
+from storage import Storage, StorageError, MySQLStorage
+from utils import SHARD_BUCKETS, email_bucket, user_id_bucket
+
+VNODES = 256
+LEGACY_CACHE_SIZE = 100000
+
+
+def parse_shards(spec):
+    """'s0=db-a,s1=db-b:3307' -> {'s0': ('db-a', 3306), 's1': ('db-b', 3307)}"""
+    shards = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, address = part.partition('=')
+        host, _, port = address.strip().partition(':')
+        name = name.strip()
+        if not sep or not name or not host:
+            raise ValueError(f"Bad shard {part!r}; expected name=host[:port]")
+        if name in shards:
+            raise ValueError(f"Shard {name!r} listed twice")
+        shards[name] = (host, int(port or 3306))
+    if not shards:
+        raise ValueError("No shards given")
+    return shards
+
+
+def _point(key):
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Bucket -> shard name by consistent hashing"""
+
+    def __init__(self, names, vnodes=VNODES):
+        self.names = sorted(names)
+        points = sorted((_point(f"{name}#{i}"), name) for name in self.names for i in range(vnodes))
+        positions = [point for point, _ in points]
+        # Precomputed: routing is a list index, not a ring walk
+        self._owners = [points[bisect.bisect(positions, _point(f"bucket#{bucket}")) % len(points)][1]
+                        for bucket in range(SHARD_BUCKETS)]
+
+    def owner(self, bucket):
+        return self._owners[bucket]
+
+    def moves(self, other):
+        """{bucket: (owner here, owner in `other`)} for buckets that change hands"""
+        return {bucket: (mine, theirs)
+                for bucket, (mine, theirs) in enumerate(zip(self._owners, other._owners))
+                if mine != theirs}
+
+
+class ShardedStorage(Storage):
+    """Routes each Storage call to the shard, or shards, holding its users"""
+
+    name = 'sharded'
+
+    def __init__(self, shards, ring, previous_ring=None):
+        self.shards = shards  # name -> Storage
+        self.ring = ring
+        self.previous_ring = previous_ring
+        self.moving = len(previous_ring.moves(ring)) if previous_ring else 0
+        self._legacy_buckets = {}  # id without a bucket -> its email's bucket
+        self.legacy_lookups = 0
+
+    def shard(self, name):
+        try:
+            return self.shards[name]
+        except KeyError:
+            raise RuntimeError(f"Unknown shard {name!r}; expected one of {', '.join(self.shards)}")
+
+    def candidate_names(self, bucket):
+        """Names of the shards that may hold `bucket`: its owner, then (while
+        resharding) its previous owner"""
+        owner = self.ring.owner(bucket)
+        if self.previous_ring is not None:
+            previous = self.previous_ring.owner(bucket)
+            if previous != owner:
+                return (owner, previous)
+        return (owner,)
+
+    def candidates(self, bucket):
+        return tuple(self.shards[name] for name in self.candidate_names(bucket))
+
+    def _user_bucket(self, user_id):
+        bucket = user_id_bucket(user_id)
+        if bucket is None:
+            bucket = self._legacy_buckets.get(user_id)
+        if bucket is None:
+            self.legacy_lookups += 1
+            for shard in self.shards.values():
+                user = shard.find_user(user_id=user_id)
+                if user:
+                    bucket = email_bucket(user['email'])
+                    if len(self._legacy_buckets) >= LEGACY_CACHE_SIZE:
+                        self._legacy_buckets.clear()
+                    self._legacy_buckets[user_id] = bucket
+                    break
+        return bucket
+
+    def _user_shards(self, user_id):
+        """Every copy of the user, or all shards when the owner isn't known"""
+        if not user_id:
+            return tuple(self.shards.values())
+        bucket = self._user_bucket(user_id)
+        return () if bucket is None else self.candidates(bucket)
+
+    def _holders(self, user_id):
+        """Shards where the user row is, for inserts that reference it"""
+        shards = self._user_shards(user_id)
+        if len(shards) > 1:
+            shards = [shard for shard in shards if shard.find_user(user_id=user_id)] or shards[:1]
+        return shards
+
+    def _by_shard(self, items, bucket_of, every_copy=False):
+        groups = {}
+        for item in items:
+            shards = self.candidates(bucket_of(item))
+            for shard in (shards if every_copy else shards[:1]):
+                groups.setdefault(shard, []).append(item)
+        return groups.items()
+
+    def initialize(self):
+        return all([shard.initialize() for shard in self.shards.values()])
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+
+    def after_fork(self):
+        for shard in self.shards.values():
+            shard.after_fork()
+
+    def stats(self):
+        # Pool counters summed over shards
+        totals = {}
+        for shard in self.shards.values():
+            for key, value in (shard.stats() or {}).items():
+                if isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def shard_stats(self):
+        return {
+            "shards": len(self.ring.names),
+            "moving_buckets": self.moving,
+            "legacy_lookups": self.legacy_lookups,
+            "legacy_cached": len(self._legacy_buckets),
+        }
+
+    def find_user(self, user_id=None, email=None):
+        if user_id:
+            bucket = self._user_bucket(user_id)
+            if bucket is None:
+                return None
+        else:
+            bucket = email_bucket(email)
+        for shard in self.candidates(bucket):
+            user = shard.find_user(user_id=user_id, email=email)
+            if user:
+                return user
+        return None
+
+    def existing_emails(self, emails):
+        found = set()
+        for shard, group in self._by_shard(emails, email_bucket, every_copy=True):
+            found |= shard.existing_emails(group)
+        return found
+
+    def insert_users(self, users):
+        inserted = []
+        try:
+            for shard, group in self._by_shard(users, lambda user: email_bucket(user['email'])):
+                shard.insert_users(group)
+                inserted.append((shard, group))
+        except StorageError:
+            # All or none, as on one server: take back what other shards committed
+            for shard, group in inserted:
+                shard.delete_users([user['id'] for user in group])
+            raise
+
+    def delete_users(self, user_ids):
+        deleted = 0
+        for user_id in user_ids:
+            for shard in self._user_shards(user_id):
+                deleted += shard.delete_users([user_id])
+        return deleted
+
+    def update_password_hash(self, user_id, password_hash, hash_algorithm, fingerprint=None):
+        updated = False
+        for shard in self._user_shards(user_id):
+            updated |= shard.update_password_hash(user_id, password_hash, hash_algorithm, fingerprint)
+        return updated
+
+    def add_reset_token(self, token_id, user_id, token, expires_at, max_per_user=0):
+        for shard in self._holders(user_id):
+            shard.add_reset_token(token_id, user_id, token, expires_at, max_per_user)
+
+    def find_reset_tokens(self, tokens):
+        found = {}
+        for shard in self.shards.values():
+            found.update(shard.find_reset_tokens(tokens))
+        return found
+
+    def use_reset_token(self, token, user_id, password_hash, hash_algorithm):
+        results = [(shard, shard.use_reset_token(token, user_id, password_hash, hash_algorithm))
+                   for shard in self._user_shards(user_id)]
+        if not any(used for _, used in results):
+            return False
+        # A copy the token wasn't on still gets the new password
+        for shard, used in results:
+            if not used:
+                shard.update_password_hash(user_id, password_hash, hash_algorithm)
+        return True
+
+    def delete_expired_reset_tokens(self, limit):
+        return sum(shard.delete_expired_reset_tokens(limit) for shard in self.shards.values())
+
+    def add_session(self, session_id, user_id, refresh_id, expires_at):
+        for shard in self._holders(user_id):
+            shard.add_session(session_id, user_id, refresh_id, expires_at)
+
+    def rotate_session(self, session_id, refresh_id, new_refresh_id, expires_at, user_id=None):
+        rotated = False
+        for shard in self._user_shards(user_id):
+            rotated |= shard.rotate_session(session_id, refresh_id, new_refresh_id, expires_at)
+        return rotated
+
+    def delete_session(self, session_id, user_id=None):
+        deleted = False
+        for shard in self._user_shards(user_id):
+            deleted |= shard.delete_session(session_id)
+        return deleted
+
+    def delete_user_sessions(self, user_id):
+        session_ids = []
+        for shard in self._user_shards(user_id):
+            session_ids.extend(shard.delete_user_sessions(user_id))
+        return list(dict.fromkeys(session_ids))
+
+    def delete_expired_sessions(self, limit):
+        return sum(shard.delete_expired_sessions(limit) for shard in self.shards.values())
+
+    def user_watermark(self, overlap=0):
+        watermark, total = {}, 0
+        for name, shard in self.shards.items():
+            watermark[name], count = shard.user_watermark(overlap)
+            total += count
+        return watermark, total
+
+    def scan_users(self, after_id, limit):
+        # Each shard's first `limit` after `after_id` includes its share of the overall first `limit`
+        rows = [tuple(row) for shard in self.shards.values() for row in shard.scan_users(after_id, limit)]
+        return sorted(set(rows))[:limit]
+
+    def users_since(self, watermark):
+        return [row for name, shard in self.shards.items() if name in watermark
+                for row in shard.users_since(watermark[name])]
+
+
+def from_config():
+    """ShardedStorage over the MySQL servers in DB_SHARDS (and DB_SHARDS_PREVIOUS)"""
+    current = parse_shards(Config.DB_SHARDS)
+    previous = parse_shards(Config.DB_SHARDS_PREVIOUS) if Config.DB_SHARDS_PREVIOUS else {}
+    servers = dict(previous, **current)
+    for name, address in previous.items():
+        if servers[name] != address:
+            raise ValueError(f"Shard {name!r} has different hosts in DB_SHARDS and DB_SHARDS_PREVIOUS")
+    shards = {name: MySQLStorage(host, port, replicas='') for name, (host, port) in servers.items()}
+    return ShardedStorage(shards, HashRing(current), HashRing(previous) if previous else None)
@@ -0,0 +1,86 @@
+"""HMAC-SHA256 signed, self-expiring tokens.
+
+    <prefix>.<key id>.<payload>.<signature>
+
+The payload is base64url JSON with an "e" (expiry, unix seconds) field. A
+Keyring is built from a 'id:secret,id:secret' spec: the first key signs new
+tokens and every key verifies, so keys rotate by putting a new one first
+and dropping the old one once the longest token lifetime has passed.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import time
+import logs
+
+log = logs.get_logger('signing')
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def parse_keys(spec):
+    keys = {}
+    for part in (spec or '').split(','):
+        kid, sep, secret = part.strip().partition(':')
+        if sep and kid and secret:
+            keys[kid] = secret.encode('utf-8')
+    return keys
+
+
+class Keyring:
+    def __init__(self, prefix, spec, ephemeral=False):
+        """With no keys in `spec` and ephemeral=True, sign with a random
+        per-process key. It is made at import, before prefork workers fork,
+        so they share it; a restart invalidates every outstanding token."""
+        self.prefix = prefix
+        self.keys = parse_keys(spec)
+        self.signing_kid = next(iter(self.keys), None)
+        if self.signing_kid is None and ephemeral:
+            self.signing_kid = 'ephemeral'
+            self.keys[self.signing_kid] = secrets.token_bytes(32)
+            log.warning("No signing keys configured; using a per-process key",
+                        extra={'fields': {'prefix': prefix}})
+
+    def owns(self, token):
+        return token.startswith(self.prefix + '.')
+
+    def _sign(self, kid, message):
+        return hmac.new(self.keys[kid], message.encode('ascii'), hashlib.sha256).digest()
+
+    def dumps(self, payload, ttl):
+        """Signed token for `payload`, expiring `ttl` seconds from now"""
+        if self.signing_kid is None:
+            raise InvalidToken("No signing key configured")
+        payload = dict(payload, e=int(time.time() + ttl))
+        body = _b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        message = f"{self.prefix}.{self.signing_kid}.{body}"
+        return f"{message}.{_b64encode(self._sign(self.signing_kid, message))}"
+
+    def loads(self, token):
+        """Verify signature and expiry; returns the payload or raises InvalidToken"""
+        try:
+            prefix, kid, body, signature = token.split('.')
+        except ValueError:
+            raise InvalidToken("Malformed token")
+        if prefix != self.prefix or kid not in self.keys:
+            raise InvalidToken("Unknown token key")
+        try:
+            expected = self._sign(kid, f"{prefix}.{kid}.{body}")
+            if not hmac.compare_digest(expected, _b64decode(signature)):
+                raise InvalidToken("Bad signature")
+            payload = json.loads(_b64decode(body))
+        except ValueError:
+            raise InvalidToken("Malformed token")
+        if payload.get("e", 0) <= time.time():
+            raise InvalidToken("Token expired")
+        return payload
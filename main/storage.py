@@ -0,0 +1,1057 @@
+"""Storage backends behind database.py.
+
+database.py keeps the request logic (validation, hashing, the user cache
+and filter); a backend only stores and finds rows. STORAGE_BACKEND picks
+one per process:
+
+    mysql   - the production backend; connection pool, versioned migrations,
+              optional read replicas (see replicas.py) or shards (shards.py)
+    sqlite  - one file at SQLITE_PATH in WAL mode, a connection per thread
+    memory  - dicts indexed by id, email and token; per process, gone on exit
+
+Every backend raises StorageError (DuplicateEmail for a taken email,
+DuplicateId for a taken primary key, ConnectionFailed when no connection could be had) rather than its
+driver's exceptions.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from config import Config
+from pool import ConnectionPool
+import logs
+import metrics
+import migrations
+import reset_tokens
+from replicas import Replica, ReplicaSet, RecentWrites, parse_replicas
+
+try:
+    import mysql.connector
+    from mysql.connector import Error as MySQLError
+except ImportError:  # only needed for STORAGE_BACKEND=mysql
+    mysql = None
+    MySQLError = None
+
+log = logs.get_logger('storage')
+
+USER_FIELDS = ('id', 'name', 'email', 'password_hash')
+
+
+class StorageError(Exception):
+    pass
+
+class ConnectionFailed(StorageError):
+    pass
+
+class DuplicateEmail(StorageError):
+    pass
+
+class DuplicateId(StorageError):
+    pass
+
+
+class Storage:
+    """Operations database.py needs; users are dicts with USER_FIELDS"""
+
+    name = None
+
+    def initialize(self):
+        """Create or upgrade the schema; returns True when ready"""
+        return True
+
+    def close(self):
+        """Release connections, e.g. before forking worker processes"""
+
+    def after_fork(self):
+        """Forget connections inherited from the parent process"""
+
+    def stats(self):
+        return None
+
+    def replica_stats(self):
+        return None
+
+    def shard_stats(self):
+        return None
+
+    def find_user(self, user_id=None, email=None):
+        raise NotImplementedError
+
+    def existing_emails(self, emails):
+        """The subset of `emails` already registered"""
+        raise NotImplementedError
+
+    def insert_users(self, users):
+        """Insert all of `users` or none; DuplicateEmail if any email is taken,
+        DuplicateId if any id is"""
+        raise NotImplementedError
+
+    def delete_users(self, user_ids):
+        """Delete users with their tokens and sessions; returns the count"""
+        raise NotImplementedError
+
+    def update_password_hash(self, user_id, password_hash, hash_algorithm, fingerprint=None):
+        """Returns False if there is no such user, or `fingerprint`
+        (reset_tokens.fingerprint of the current hash) no longer matches"""
+        raise NotImplementedError
+
+    def add_reset_token(self, token_id, user_id, token, expires_at, max_per_user=0):
+        """Store a token, first dropping the user's oldest beyond max_per_user - 1"""
+        raise NotImplementedError
+
+    def find_reset_tokens(self, tokens):
+        """{token: {user_id, email, name}} for the unexpired ones"""
+        raise NotImplementedError
+
+    def use_reset_token(self, token, user_id, password_hash, hash_algorithm):
+        """Delete the token and set the password together; False if already used"""
+        raise NotImplementedError
+
+    def delete_expired_reset_tokens(self, limit):
+        raise NotImplementedError
+
+    def add_session(self, session_id, user_id, refresh_id, expires_at):
+        raise NotImplementedError
+
+    def rotate_session(self, session_id, refresh_id, new_refresh_id, expires_at, user_id=None):
+        """Swap in a new refresh id if `refresh_id` is current and the session
+        is unexpired; False otherwise. `user_id` (here and in delete_session)
+        is the session's owner, which a sharded backend routes by"""
+        raise NotImplementedError
+
+    def delete_session(self, session_id, user_id=None):
+        raise NotImplementedError
+
+    def delete_user_sessions(self, user_id):
+        """Delete every session of the user; returns their ids"""
+        raise NotImplementedError
+
+    def delete_expired_sessions(self, limit):
+        raise NotImplementedError
+
+    def user_watermark(self, overlap=0):
+        """(watermark, user count); users_since(watermark) finds rows added
+        since, and may repeat some from before it. `overlap` steps the
+        watermark back that many seconds, for rows that commit later than
+        their created_at"""
+        raise NotImplementedError
+
+    def scan_users(self, after_id, limit):
+        """[(id, email), ...] ordered by id, starting after `after_id`"""
+        raise NotImplementedError
+
+    def users_since(self, watermark):
+        raise NotImplementedError
+
+
+# --- MySQL ---
+
+def create_connection(host=None, port=None, connect_timeout=None):
+    """Connect to the primary, or to `host`/`port` with the same credentials"""
+    options = {}
+    if port:
+        options['port'] = port
+    if connect_timeout:
+        options['connection_timeout'] = connect_timeout
+    try:
+        conn = mysql.connector.connect(
+            host=host or Config.DB_HOST,
+            user=Config.DB_USER,
+            password=Config.DB_PASSWORD,
+            database=Config.DB_NAME,
+            auth_plugin='mysql_native_password',
+            **options
+        )
+        return conn
+    except MySQLError as e:
+        log.error("Database connection error", extra={'fields': {'error': str(e)}})
+        return None
+
+
+class _TimedCursor:
+    """Cursor that records query time and errors in metrics"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args, **kwargs):
+        try:
+            with metrics.stage('query'):
+                return self._cursor.execute(*args, **kwargs)
+        except MySQLError as e:
+            metrics.db_error(type(e).__name__)
+            raise
+
+
+class _TimedConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return _TimedCursor(self._conn.cursor(*args, **kwargs))
+
+    def close(self):
+        self._conn.close()
+
+
+class MySQLStorage(Storage):
+    name = 'mysql'
+
+    def __init__(self, host=None, port=None, replicas=None):
+        """The DB_HOST server, or `host`/`port` (a shard); `replicas`
+        overrides DB_REPLICAS"""
+        if mysql is None:
+            raise RuntimeError("STORAGE_BACKEND=mysql needs mysql-connector-python")
+        self.host = host
+        self.port = port
+        self.replica_spec = Config.DB_REPLICAS if replicas is None else replicas
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._replicas = None
+        self._recent_writes = RecentWrites(Config.DB_READ_YOUR_WRITES_WINDOW)
+        # Reads that could have gone to a replica but went to the primary
+        self.primary_reads = 0
+        self.replica_fallbacks = 0
+        # Replica answers of "not found" asked again of the primary
+        self.replica_misses = 0
+
+    def get_pool(self):
+        """Process-wide connection pool, created on first use"""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    pool = ConnectionPool(
+                        lambda: create_connection(self.host, self.port),
+                        min_size=Config.DB_POOL_MIN_SIZE,
+                        max_size=Config.DB_POOL_MAX_SIZE,
+                        idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+                        health_check=Config.DB_POOL_HEALTH_CHECK,
+                        borrow_timeout=Config.DB_POOL_TIMEOUT
+                    )
+                    pool.fill()
+                    self._pool = pool
+        return self._pool
+
+    def get_connection(self):
+        """Borrow a pooled connection; close() returns it to the pool"""
+        with metrics.stage('db_borrow'):
+            conn = self.get_pool().get_connection()
+        if conn is None:
+            metrics.db_error('connect')
+            return None
+        return _TimedConnection(conn)
+
+    def get_replicas(self):
+        """Process-wide ReplicaSet for DB_REPLICAS, or None without replicas"""
+        if self._replicas is None and self.replica_spec:
+            with self._pool_lock:
+                if self._replicas is None:
+                    members = [
+                        Replica(host, port, ConnectionPool(
+                            lambda host=host, port=port: create_connection(
+                                host, port, Config.DB_REPLICA_CONNECT_TIMEOUT),
+                            min_size=0,
+                            max_size=Config.DB_POOL_MAX_SIZE,
+                            idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+                            health_check=Config.DB_POOL_HEALTH_CHECK,
+                            borrow_timeout=Config.DB_POOL_TIMEOUT
+                        ))
+                        for host, port in parse_replicas(self.replica_spec)
+                    ]
+                    replicas = ReplicaSet(members, Config.DB_REPLICA_SELECTION,
+                                          Config.DB_REPLICA_CHECK_INTERVAL, Config.DB_REPLICA_MAX_LAG)
+                    replicas.start()
+                    self._replicas = replicas
+        return self._replicas
+
+    def close(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+            replicas, self._replicas = self._replicas, None
+        if pool:
+            pool.close_all()
+        if replicas:
+            replicas.stop()
+
+    def after_fork(self):
+        # Connections inherited from the parent share its sockets; never reuse them.
+        # The health-check thread isn't copied either; the child starts its own
+        self._pool = None
+        self._replicas = None
+        self._pool_lock = threading.Lock()
+        self._recent_writes = RecentWrites(Config.DB_READ_YOUR_WRITES_WINDOW)
+
+    def stats(self):
+        return self.get_pool().stats()
+
+    def replica_stats(self):
+        replicas = self.get_replicas()
+        if replicas is None:
+            return None
+        return dict(replicas.stats(), primary_reads=self.primary_reads,
+                    fallbacks=self.replica_fallbacks, misses=self.replica_misses,
+                    recent_writes=len(self._recent_writes))
+
+    def _read(self, keys, query, dictionary=False, written=None, missing=None):
+        """Run query(cursor) on a replica and return its result.
+
+        Goes to the primary instead when one of `keys` was written within
+        the read-your-writes window, when no replica is healthy, or when the
+        replica fails (which also marks it down until a health check passes).
+        `written(result)` names more keys the result depends on, such as the
+        id of a user looked up by email; if one of those was written
+        recently the replica's answer is discarded for the primary's.
+        `missing(result)` is true when the replica found less than was asked
+        for. The row may have been written by another process or host and not
+        replicated yet, so the primary is asked too; the user filter keeps
+        lookups of rows that never existed from getting this far.
+        """
+        replicas = self.get_replicas()
+        if replicas is not None:
+            replica = None if self._recent_writes.any(keys) else replicas.acquire()
+            if replica is None:
+                self.primary_reads += 1
+            else:
+                try:
+                    result = self._replica_query(replica, query, dictionary)
+                    if missing is not None and missing(result):
+                        self.replica_misses += 1
+                    elif written is None or not self._recent_writes.any(written(result)):
+                        return result
+                    else:
+                        self.primary_reads += 1
+                except (ConnectionFailed, mysql.connector.OperationalError,
+                        mysql.connector.InterfaceError) as e:
+                    replicas.mark_down(replica, e)
+                    self.replica_fallbacks += 1
+                finally:
+                    replicas.release(replica)
+        with self._cursor(dictionary=dictionary) as (_, cursor):
+            return query(cursor)
+
+    def _replica_query(self, replica, query, dictionary):
+        with metrics.stage('db_borrow'):
+            conn = replica.pool.get_connection()
+        if conn is None:
+            metrics.db_error('connect')
+            raise ConnectionFailed(f"Replica {replica.name} connection failed")
+        conn = _TimedConnection(conn)
+        cursor = conn.cursor(dictionary=dictionary)
+        try:
+            return query(cursor)
+        except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+            raise
+        except MySQLError as e:
+            raise StorageError(str(e)) from e
+        finally:
+            cursor.close()
+            conn.close()
+
+    @contextmanager
+    def _cursor(self, dictionary=False):
+        conn = self.get_connection()
+        if not conn:
+            raise ConnectionFailed("Database connection failed")
+        cursor = conn.cursor(dictionary=dictionary)
+        try:
+            yield conn, cursor
+        except mysql.connector.IntegrityError as e:
+            if e.errno == 1062:
+                # "Duplicate entry '...' for key 'users.PRIMARY'" (or 'users.email')
+                if 'PRIMARY' in str(e):
+                    raise DuplicateId(str(e)) from e
+                raise DuplicateEmail(str(e)) from e
+            raise StorageError(str(e)) from e
+        except MySQLError as e:
+            raise StorageError(str(e)) from e
+        finally:
+            cursor.close()
+            conn.close()
+
+    def initialize(self):
+        """Apply pending migrations, or check there are none with MIGRATE_ON_STARTUP off"""
+        with self._cursor() as (conn, _):
+            try:
+                if Config.MIGRATE_ON_STARTUP:
+                    migrations.migrate(conn)
+                    log.info("Database schema up to date",
+                             extra={'fields': {'version': migrations.latest_version()}})
+                    return True
+                version = migrations.current_version(conn)
+            except RuntimeError as e:
+                raise StorageError(str(e)) from e
+            if version < migrations.latest_version():
+                log.error("Database schema is behind; run `python migrations.py migrate`",
+                          extra={'fields': {'version': version, 'required': migrations.latest_version()}})
+                return False
+            return True
+
+    def find_user(self, user_id=None, email=None):
+        def query(cursor):
+            if user_id:
+                cursor.execute("SELECT id, name, email, password_hash FROM users WHERE id = %s", (user_id,))
+            else:
+                cursor.execute("SELECT id, name, email, password_hash FROM users WHERE email = %s", (email,))
+            return cursor.fetchone()
+        return self._read((user_id, email), query, dictionary=True,
+                          written=lambda row: (row['id'],) if row else (),
+                          missing=lambda row: row is None)
+
+    def existing_emails(self, emails):
+        if not emails:
+            return set()
+        with self._cursor() as (_, cursor):
+            placeholders = ', '.join(['%s'] * len(emails))
+            cursor.execute(f"SELECT email FROM users WHERE email IN ({placeholders})", list(emails))
+            return {row[0] for row in cursor.fetchall()}
+
+    def insert_users(self, users):
+        with self._cursor() as (conn, cursor):
+            placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(users))
+            params = []
+            for u in users:
+                params.extend((u['id'], u['name'], u['email'], u['password_hash'],
+                               u['hash_algorithm'], u.get('age'), u.get('dob')))
+            # One multi-row INSERT and one commit for the whole batch
+            cursor.execute(f"""
+                INSERT INTO users (id, name, email, password_hash, hash_algorithm, age, dob)
+                VALUES {placeholders}
+            """, params)
+            conn.commit()
+        self._recent_writes.add(*(key for u in users for key in (u['id'], u['email'])))
+
+    def delete_users(self, user_ids):
+        if not user_ids:
+            return 0
+        with self._cursor() as (conn, cursor):
+            # Tokens and sessions go with them (ON DELETE CASCADE)
+            placeholders = ', '.join(['%s'] * len(user_ids))
+            cursor.execute(f"DELETE FROM users WHERE id IN ({placeholders})", list(user_ids))
+            conn.commit()
+            deleted = cursor.rowcount
+        self._recent_writes.add(*user_ids)
+        return deleted
+
+    def update_password_hash(self, user_id, password_hash, hash_algorithm, fingerprint=None):
+        with self._cursor() as (conn, cursor):
+            if fingerprint is None:
+                cursor.execute("UPDATE users SET password_hash = %s, hash_algorithm = %s WHERE id = %s",
+                               (password_hash, hash_algorithm, user_id))
+            else:
+                cursor.execute("""
+                    UPDATE users SET password_hash = %s, hash_algorithm = %s
+                    WHERE id = %s AND LEFT(SHA2(password_hash, 256), 16) = %s
+                """, (password_hash, hash_algorithm, user_id, fingerprint))
+            conn.commit()
+            updated = cursor.rowcount > 0
+        if updated:
+            self._recent_writes.add(user_id)
+        return updated
+
+    def add_reset_token(self, token_id, user_id, token, expires_at, max_per_user=0):
+        with self._cursor() as (conn, cursor):
+            if max_per_user > 0:
+                cursor.execute("""
+                    SELECT id FROM password_reset_tokens
+                    WHERE user_id = %s ORDER BY expires_at DESC
+                """, (user_id,))
+                stale = [row[0] for row in cursor.fetchall()][max_per_user - 1:]
+                if stale:
+                    placeholders = ', '.join(['%s'] * len(stale))
+                    cursor.execute(f"DELETE FROM password_reset_tokens WHERE id IN ({placeholders})", stale)
+            cursor.execute("""
+                INSERT INTO password_reset_tokens (id, user_id, token, expires_at)
+                VALUES (%s, %s, %s, %s)
+            """, (token_id, user_id, token, expires_at))
+            conn.commit()
+        self._recent_writes.add(token)
+
+    def find_reset_tokens(self, tokens):
+        unique_tokens = list(dict.fromkeys(tokens))
+        if not unique_tokens:
+            return {}
+        def query(cursor):
+            placeholders = ', '.join(['%s'] * len(unique_tokens))
+            cursor.execute(f"""
+                SELECT prt.token, u.id AS user_id, u.email, u.name
+                FROM password_reset_tokens prt
+                JOIN users u ON prt.user_id = u.id
+                WHERE prt.token IN ({placeholders}) AND prt.expires_at > NOW()
+            """, unique_tokens)
+            return {row['token']: row for row in cursor.fetchall()}
+        # A used token lingers on a lagging replica; reset_password's DELETE
+        # on the primary is what decides, so a stale "valid" here is harmless.
+        # One issued moments ago by another worker may not be there yet
+        return self._read(unique_tokens, query, dictionary=True,
+                          missing=lambda found: len(found) < len(unique_tokens))
+
+    def use_reset_token(self, token, user_id, password_hash, hash_algorithm):
+        with self._cursor() as (conn, cursor):
+            # Deleting first makes a concurrent second use of the token a no-op
+            cursor.execute("DELETE FROM password_reset_tokens WHERE token = %s", (token,))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return False
+            cursor.execute("UPDATE users SET password_hash = %s, hash_algorithm = %s WHERE id = %s",
+                           (password_hash, hash_algorithm, user_id))
+            conn.commit()
+        self._recent_writes.add(token, user_id)
+        return True
+
+    def delete_expired_reset_tokens(self, limit):
+        with self._cursor() as (conn, cursor):
+            # Small batches keep each statement's row locks short
+            cursor.execute("""
+                DELETE FROM password_reset_tokens
+                WHERE expires_at <= NOW()
+                ORDER BY expires_at
+                LIMIT %s
+            """, (limit,))
+            conn.commit()
+            return cursor.rowcount
+
+    def add_session(self, session_id, user_id, refresh_id, expires_at):
+        with self._cursor() as (conn, cursor):
+            cursor.execute("""
+                INSERT INTO sessions (id, user_id, refresh_id, expires_at)
+                VALUES (%s, %s, %s, %s)
+            """, (session_id, user_id, refresh_id, expires_at))
+            conn.commit()
+
+    def rotate_session(self, session_id, refresh_id, new_refresh_id, expires_at, user_id=None):
+        with self._cursor() as (conn, cursor):
+            cursor.execute("""
+                UPDATE sessions SET refresh_id = %s, expires_at = %s
+                WHERE id = %s AND refresh_id = %s AND expires_at > NOW()
+            """, (new_refresh_id, expires_at, session_id, refresh_id))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def delete_session(self, session_id, user_id=None):
+        with self._cursor() as (conn, cursor):
+            cursor.execute("DELETE FROM sessions WHERE id = %s", (session_id,))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def delete_user_sessions(self, user_id):
+        with self._cursor() as (conn, cursor):
+            # Locks the rows, so a concurrent login lands before or after, not between
+            cursor.execute("SELECT id FROM sessions WHERE user_id = %s FOR UPDATE", (user_id,))
+            session_ids = [row[0] for row in cursor.fetchall()]
+            if session_ids:
+                cursor.execute("DELETE FROM sessions WHERE user_id = %s", (user_id,))
+            conn.commit()
+            return session_ids
+
+    def delete_expired_sessions(self, limit):
+        with self._cursor() as (conn, cursor):
+            cursor.execute("""
+                DELETE FROM sessions
+                WHERE expires_at <= NOW()
+                ORDER BY expires_at
+                LIMIT %s
+            """, (limit,))
+            conn.commit()
+            return cursor.rowcount
+
+    def user_watermark(self, overlap=0):
+        with self._cursor(dictionary=True) as (_, cursor):
+            # created_at is when the INSERT ran, not when it committed
+            cursor.execute("SELECT NOW() - INTERVAL %s SECOND AS now, COUNT(*) AS total FROM users",
+                           (overlap,))
+            row = cursor.fetchone()
+            return row['now'], row['total']
+
+    def scan_users(self, after_id, limit):
+        with self._cursor() as (_, cursor):
+            cursor.execute("SELECT id, email FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                           (after_id, limit))
+            return cursor.fetchall()
+
+    def users_since(self, watermark):
+        with self._cursor() as (_, cursor):
+            cursor.execute("SELECT id, email FROM users WHERE created_at >= %s", (watermark,))
+            return cursor.fetchall()
+
+
+# --- SQLite ---
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    hash_algorithm TEXT,
+    age INTEGER,
+    dob TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at);
+CREATE TABLE IF NOT EXISTS password_reset_tokens (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    token TEXT UNIQUE NOT NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    expires_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_prt_expires_at ON password_reset_tokens (expires_at);
+CREATE INDEX IF NOT EXISTS idx_prt_user_expires ON password_reset_tokens (user_id, expires_at);
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    refresh_id TEXT NOT NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    expires_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);
+CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (user_id);
+"""
+
+def _sqlite_time(value):
+    # Stored as text; this format sorts and compares correctly as a string
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SQLiteStorage(Storage):
+    """One database file shared by every thread, each with its own connection.
+
+    WAL mode lets readers run alongside the single writer; writers queue on
+    busy_timeout instead of failing.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path):
+        if path == ':memory:':
+            raise RuntimeError("SQLITE_PATH=:memory: would give each thread its own "
+                               "database; use STORAGE_BACKEND=memory")
+        self.path = path
+        self._local = threading.local()
+        self._connections = 0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=Config.SQLITE_BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.create_function('fingerprint', 1, reset_tokens.fingerprint, deterministic=True)
+            self._local.conn = conn
+            self._connections += 1
+        return conn
+
+    @contextmanager
+    def _cursor(self, write=False):
+        try:
+            conn = self._connection()
+        except sqlite3.Error as e:
+            metrics.db_error('connect')
+            raise ConnectionFailed("Database connection failed") from e
+        try:
+            if write:
+                # Take the write lock up front rather than upgrading mid-transaction
+                conn.execute("BEGIN IMMEDIATE")
+            try:
+                with metrics.stage('query'):
+                    yield conn
+                if write:
+                    conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        except sqlite3.IntegrityError as e:
+            metrics.db_error(type(e).__name__)
+            if 'users.email' in str(e):
+                raise DuplicateEmail(str(e)) from e
+            if 'users.id' in str(e):
+                raise DuplicateId(str(e)) from e
+            raise StorageError(str(e)) from e
+        except sqlite3.Error as e:
+            metrics.db_error(type(e).__name__)
+            raise StorageError(str(e)) from e
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def after_fork(self):
+        self._local = threading.local()
+
+    def stats(self):
+        return {"connections": self._connections}
+
+    def initialize(self):
+        with self._cursor() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+        log.info("SQLite database ready", extra={'fields': {'path': self.path}})
+        return True
+
+    def find_user(self, user_id=None, email=None):
+        with self._cursor() as conn:
+            if user_id:
+                row = conn.execute("SELECT id, name, email, password_hash FROM users WHERE id = ?",
+                                   (user_id,)).fetchone()
+            else:
+                row = conn.execute("SELECT id, name, email, password_hash FROM users WHERE email = ?",
+                                   (email,)).fetchone()
+        return dict(row) if row else None
+
+    def existing_emails(self, emails):
+        if not emails:
+            return set()
+        with self._cursor() as conn:
+            placeholders = ', '.join(['?'] * len(emails))
+            rows = conn.execute(f"SELECT email FROM users WHERE email IN ({placeholders})",
+                                list(emails)).fetchall()
+        return {row[0] for row in rows}
+
+    def insert_users(self, users):
+        with self._cursor(write=True) as conn:
+            conn.executemany("""
+                INSERT INTO users (id, name, email, password_hash, hash_algorithm, age, dob)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [(u['id'], u['name'], u['email'], u['password_hash'], u['hash_algorithm'],
+                   u.get('age'), u.get('dob')) for u in users])
+
+    def delete_users(self, user_ids):
+        if not user_ids:
+            return 0
+        with self._cursor(write=True) as conn:
+            placeholders = ', '.join(['?'] * len(user_ids))
+            return conn.execute(f"DELETE FROM users WHERE id IN ({placeholders})",
+                                list(user_ids)).rowcount
+
+    def update_password_hash(self, user_id, password_hash, hash_algorithm, fingerprint=None):
+        with self._cursor(write=True) as conn:
+            if fingerprint is None:
+                cursor = conn.execute("UPDATE users SET password_hash = ?, hash_algorithm = ? WHERE id = ?",
+                                      (password_hash, hash_algorithm, user_id))
+            else:
+                cursor = conn.execute("""
+                    UPDATE users SET password_hash = ?, hash_algorithm = ?
+                    WHERE id = ? AND fingerprint(password_hash) = ?
+                """, (password_hash, hash_algorithm, user_id, fingerprint))
+            return cursor.rowcount > 0
+
+    def add_reset_token(self, token_id, user_id, token, expires_at, max_per_user=0):
+        with self._cursor(write=True) as conn:
+            if max_per_user > 0:
+                rows = conn.execute("""
+                    SELECT id FROM password_reset_tokens
+                    WHERE user_id = ? ORDER BY expires_at DESC
+                """, (user_id,)).fetchall()
+                stale = [row[0] for row in rows][max_per_user - 1:]
+                if stale:
+                    placeholders = ', '.join(['?'] * len(stale))
+                    conn.execute(f"DELETE FROM password_reset_tokens WHERE id IN ({placeholders})", stale)
+            conn.execute("""
+                INSERT INTO password_reset_tokens (id, user_id, token, expires_at)
+                VALUES (?, ?, ?, ?)
+            """, (token_id, user_id, token, _sqlite_time(expires_at)))
+
+    def find_reset_tokens(self, tokens):
+        unique_tokens = list(dict.fromkeys(tokens))
+        if not unique_tokens:
+            return {}
+        with self._cursor() as conn:
+            placeholders = ', '.join(['?'] * len(unique_tokens))
+            rows = conn.execute(f"""
+                SELECT prt.token, u.id AS user_id, u.email, u.name
+                FROM password_reset_tokens prt
+                JOIN users u ON prt.user_id = u.id
+                WHERE prt.token IN ({placeholders}) AND prt.expires_at > ?
+            """, unique_tokens + [_sqlite_time(datetime.now())]).fetchall()
+        return {row['token']: dict(row) for row in rows}
+
+    def use_reset_token(self, token, user_id, password_hash, hash_algorithm):
+        with self._cursor(write=True) as conn:
+            if conn.execute("DELETE FROM password_reset_tokens WHERE token = ?", (token,)).rowcount == 0:
+                return False
+            conn.execute("UPDATE users SET password_hash = ?, hash_algorithm = ? WHERE id = ?",
+                         (password_hash, hash_algorithm, user_id))
+            return True
+
+    def delete_expired_reset_tokens(self, limit):
+        with self._cursor(write=True) as conn:
+            # DELETE ... LIMIT needs a compile-time option; pick the ids instead
+            return conn.execute("""
+                DELETE FROM password_reset_tokens WHERE id IN (
+                    SELECT id FROM password_reset_tokens
+                    WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+                )
+            """, (_sqlite_time(datetime.now()), limit)).rowcount
+
+    def add_session(self, session_id, user_id, refresh_id, expires_at):
+        with self._cursor(write=True) as conn:
+            conn.execute("""
+                INSERT INTO sessions (id, user_id, refresh_id, expires_at)
+                VALUES (?, ?, ?, ?)
+            """, (session_id, user_id, refresh_id, _sqlite_time(expires_at)))
+
+    def rotate_session(self, session_id, refresh_id, new_refresh_id, expires_at, user_id=None):
+        with self._cursor(write=True) as conn:
+            return conn.execute("""
+                UPDATE sessions SET refresh_id = ?, expires_at = ?
+                WHERE id = ? AND refresh_id = ? AND expires_at > ?
+            """, (new_refresh_id, _sqlite_time(expires_at), session_id, refresh_id,
+                  _sqlite_time(datetime.now()))).rowcount > 0
+
+    def delete_session(self, session_id, user_id=None):
+        with self._cursor(write=True) as conn:
+            return conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0
+
+    def delete_user_sessions(self, user_id):
+        with self._cursor(write=True) as conn:
+            rows = conn.execute("SELECT id FROM sessions WHERE user_id = ?", (user_id,)).fetchall()
+            conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        return [row[0] for row in rows]
+
+    def delete_expired_sessions(self, limit):
+        with self._cursor(write=True) as conn:
+            return conn.execute("""
+                DELETE FROM sessions WHERE id IN (
+                    SELECT id FROM sessions
+                    WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+                )
+            """, (_sqlite_time(datetime.now()), limit)).rowcount
+
+    def user_watermark(self, overlap=0):
+        with self._cursor() as conn:
+            # As for MySQL: a write transaction may commit rows stamped earlier
+            row = conn.execute("SELECT datetime('now', ?), COUNT(*) FROM users",
+                               (f"-{overlap} seconds",)).fetchone()
+        return row[0], row[1]
+
+    def scan_users(self, after_id, limit):
+        with self._cursor() as conn:
+            rows = conn.execute("SELECT id, email FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                                (after_id, limit)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def users_since(self, watermark):
+        with self._cursor() as conn:
+            rows = conn.execute("SELECT id, email FROM users WHERE created_at >= ?",
+                                (watermark,)).fetchall()
+        return [tuple(row) for row in rows]
+
+
+# --- In-memory ---
+
+class MemoryStorage(Storage):
+    """Dicts indexed by id, email and token, behind one lock.
+
+    Nothing is shared between processes, so pre-forked workers each see
+    only the users they registered themselves.
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}           # id -> user record
+        self._by_email = {}        # email -> id
+        self._order = []           # ids in insertion order; the watermark indexes it
+        self._tokens = {}          # token -> (token id, user id, expires_at)
+        self._user_tokens = {}     # user id -> [token, ...] oldest first
+        self._sessions = {}        # session id -> [user id, refresh id, expires_at]
+
+    def find_user(self, user_id=None, email=None):
+        with self._lock:
+            if not user_id:
+                user_id = self._by_email.get(email)
+            user = self._users.get(user_id)
+            return {field: user[field] for field in USER_FIELDS} if user else None
+
+    def existing_emails(self, emails):
+        with self._lock:
+            return {email for email in emails if email in self._by_email}
+
+    def insert_users(self, users):
+        with self._lock:
+            emails = [u['email'] for u in users]
+            if len(set(emails)) != len(emails) or any(e in self._by_email for e in emails):
+                raise DuplicateEmail("Email already registered")
+            if any(u['id'] in self._users for u in users):
+                raise DuplicateId("Duplicate user id")
+            for u in users:
+                self._users[u['id']] = dict(u, created_at=datetime.now())
+                self._by_email[u['email']] = u['id']
+                self._order.append(u['id'])
+
+    def delete_users(self, user_ids):
+        with self._lock:
+            deleted = 0
+            for user_id in user_ids:
+                user = self._users.pop(user_id, None)
+                if user is None:
+                    continue
+                deleted += 1
+                del self._by_email[user['email']]
+                for token in list(self._user_tokens.pop(user_id, ())):
+                    self._tokens.pop(token, None)
+                for sid in [sid for sid, session in self._sessions.items() if session[0] == user_id]:
+                    del self._sessions[sid]
+            # _order keeps deleted ids so watermarks stay valid; users_since skips them
+            return deleted
+
+    def update_password_hash(self, user_id, password_hash, hash_algorithm, fingerprint=None):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                return False
+            if fingerprint is not None and reset_tokens.fingerprint(user['password_hash']) != fingerprint:
+                return False
+            user['password_hash'] = password_hash
+            user['hash_algorithm'] = hash_algorithm
+            return True
+
+    def add_reset_token(self, token_id, user_id, token, expires_at, max_per_user=0):
+        with self._lock:
+            if user_id not in self._users:
+                raise StorageError("Unknown user")
+            owned = self._user_tokens.setdefault(user_id, [])
+            if max_per_user > 0:
+                while len(owned) >= max_per_user:
+                    self._tokens.pop(owned.pop(0), None)
+            self._tokens[token] = (token_id, user_id, expires_at)
+            owned.append(token)
+
+    def find_reset_tokens(self, tokens):
+        now = datetime.now()
+        found = {}
+        with self._lock:
+            for token in tokens:
+                entry = self._tokens.get(token)
+                if entry and entry[2] > now:
+                    user = self._users[entry[1]]
+                    found[token] = {"token": token, "user_id": user['id'],
+                                    "email": user['email'], "name": user['name']}
+        return found
+
+    def use_reset_token(self, token, user_id, password_hash, hash_algorithm):
+        with self._lock:
+            if self._drop_token(token) is None:
+                return False
+            user = self._users[user_id]
+            user['password_hash'] = password_hash
+            user['hash_algorithm'] = hash_algorithm
+            return True
+
+    def delete_expired_reset_tokens(self, limit):
+        now = datetime.now()
+        with self._lock:
+            expired = [t for t, entry in self._tokens.items() if entry[2] <= now][:limit]
+            for token in expired:
+                self._drop_token(token)
+            return len(expired)
+
+    def add_session(self, session_id, user_id, refresh_id, expires_at):
+        with self._lock:
+            if user_id not in self._users:
+                raise StorageError("Unknown user")
+            self._sessions[session_id] = [user_id, refresh_id, expires_at]
+
+    def rotate_session(self, session_id, refresh_id, new_refresh_id, expires_at, user_id=None):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session[1] != refresh_id or session[2] <= datetime.now():
+                return False
+            session[1] = new_refresh_id
+            session[2] = expires_at
+            return True
+
+    def delete_session(self, session_id, user_id=None):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def delete_user_sessions(self, user_id):
+        with self._lock:
+            session_ids = [sid for sid, session in self._sessions.items() if session[0] == user_id]
+            for sid in session_ids:
+                del self._sessions[sid]
+            return session_ids
+
+    def delete_expired_sessions(self, limit):
+        now = datetime.now()
+        with self._lock:
+            expired = [sid for sid, session in self._sessions.items() if session[2] <= now][:limit]
+            for sid in expired:
+                del self._sessions[sid]
+            return len(expired)
+
+    def _drop_token(self, token):
+        # Called with the lock held
+        entry = self._tokens.pop(token, None)
+        if entry is not None:
+            owned = self._user_tokens.get(entry[1])
+            if owned:
+                owned.remove(token)
+        return entry
+
+    def user_watermark(self, overlap=0):
+        # Inserts are indexed under the lock, so nothing commits late
+        with self._lock:
+            return len(self._order), len(self._users)
+
+    def scan_users(self, after_id, limit):
+        with self._lock:
+            ids = sorted(i for i in self._users if i > after_id)[:limit]
+            return [(i, self._users[i]['email']) for i in ids]
+
+    def users_since(self, watermark):
+        with self._lock:
+            return [(i, self._users[i]['email']) for i in self._order[watermark:] if i in self._users]
+
+
+def _mysql_storage():
+    if Config.DB_SHARDS:
+        import shards  # builds on this module
+        return shards.from_config()
+    return MySQLStorage()
+
+BACKENDS = {
+    'mysql': _mysql_storage,
+    'sqlite': lambda: SQLiteStorage(Config.SQLITE_PATH),
+    'memory': MemoryStorage,
+}
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """The process-wide backend picked by STORAGE_BACKEND"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                try:
+                    factory = BACKENDS[Config.STORAGE_BACKEND]
+                except KeyError:
+                    raise RuntimeError(f"Unknown STORAGE_BACKEND {Config.STORAGE_BACKEND!r}; "
+                                       f"expected one of {', '.join(BACKENDS)}")
+                _storage = factory()
+    return _storage
+
+def _after_fork():
+    global _storage_lock
+    _storage_lock = threading.Lock()
+    if _storage is not None:
+        _storage.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,110 @@
+"""Background deletion of expired password reset tokens and sessions.
+
+Every RESET_TOKEN_SWEEP_INTERVAL seconds the sweeper deletes expired rows
+RESET_TOKEN_SWEEP_BATCH at a time, pausing between batches so a large
+backlog never holds row locks for long or starves request queries.
+"""
+import os
+import threading
+import time
+from config import Config
+import database as db
+import logs
+
+log = logs.get_logger('sweeper')
+
+
+class TokenSweeper:
+    def __init__(self, interval, batch_size, pause):
+        self.interval = interval
+        self.batch_size = max(batch_size, 1)
+        self.pause = pause
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.runs = 0
+        self.deleted = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_run_seconds = 0.0
+        self.last_run_at = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='token-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sweep()
+            if self._stop.wait(self.interval):
+                return
+
+    def sweep(self):
+        """Delete expired tokens and sessions until none are left; returns the count"""
+        started = time.perf_counter()
+        deleted = 0
+        for delete_expired in (db.delete_expired_reset_tokens, db.delete_expired_sessions):
+            while not self._stop.is_set():
+                count = delete_expired(self.batch_size)
+                if count is None:
+                    self.errors += 1
+                    break
+                self.batches += 1
+                deleted += count
+                if count < self.batch_size or self._stop.wait(self.pause):
+                    break
+        self.runs += 1
+        self.deleted += deleted
+        self.last_run_seconds = time.perf_counter() - started
+        self.last_run_at = time.time()
+        if deleted:
+            log.info("Expired rows deleted", extra={'fields': {
+                'deleted': deleted, 'duration_ms': round(self.last_run_seconds * 1000, 3)
+            }})
+        return deleted
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "deleted": self.deleted,
+            "batches": self.batches,
+            "errors": self.errors,
+            "last_run_seconds": self.last_run_seconds,
+            "last_run_at": self.last_run_at,
+        }
+
+
+_sweeper = None
+
+def start():
+    """Start the process-wide sweeper unless disabled or already running"""
+    global _sweeper
+    if _sweeper is None and Config.RESET_TOKEN_SWEEP_INTERVAL > 0:
+        _sweeper = TokenSweeper(Config.RESET_TOKEN_SWEEP_INTERVAL,
+                                Config.RESET_TOKEN_SWEEP_BATCH,
+                                Config.RESET_TOKEN_SWEEP_PAUSE)
+        _sweeper.start()
+    return _sweeper
+
+def stop(timeout=5):
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.stop(timeout)
+        _sweeper = None
+
+def stats():
+    return _sweeper.stats() if _sweeper else None
+
+
+def _forget_after_fork():
+    # Only the process that started it sweeps; its thread isn't copied into forks
+    global _sweeper
+    _sweeper = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_after_fork)
@@ -0,0 +1,47 @@
+"""Tests run against the memory and SQLite backends; no MySQL needed.
+
+The modules import each other by bare name, as when run from main/, and
+read their settings at import, so both are set up before any test module
+is collected.
+"""
+import os
+import sys
+
+os.environ.update({
+    'STORAGE_BACKEND': 'memory',
+    'HASH_WORKERS': '0',          # hash on the calling thread
+    'SCRYPT_N': '1024',           # fast hashes; cost isn't under test
+    'SESSION_KEYS': 'test:session-test-secret',
+    'RESET_TOKEN_KEYS': 'test:reset-test-secret',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import database
+import storage
+from user_cache import UserCache
+
+PASSWORD = 'Corr3ct!Horse'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path, monkeypatch):
+    """A fresh backend installed as the process-wide storage"""
+    if request.param == 'memory':
+        backend = storage.MemoryStorage()
+    else:
+        backend = storage.SQLiteStorage(str(tmp_path / 'users.db'))
+    assert backend.initialize()
+    monkeypatch.setattr(storage, '_storage', backend)
+    monkeypatch.setattr(database, 'user_cache', UserCache())
+    monkeypatch.setattr(database, '_user_filter', None)
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def user(store):
+    """A registered user, as register_user returns it"""
+    result = database.register_user('Ada', 'Ada@Example.com', PASSWORD)
+    assert 'error' not in result, result
+    return result
@@ -0,0 +1,77 @@
+import gzip
+import http.client
+import socket
+import threading
+import pytest
+import compression
+from config import Config
+from API import APIHandler
+from server import PooledHTTPServer
+
+
+@pytest.fixture
+def server():
+    server = PooledHTTPServer(('127.0.0.1', 0), APIHandler, max_threads=2, max_keepalive_requests=3)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.drain(1)
+    server.server_close()
+
+
+def connect(server):
+    return http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+
+
+def test_keep_alive_until_request_limit(server):
+    conn = connect(server)
+    headers = []
+    for _ in range(3):
+        conn.request('GET', '/nope')
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 404
+        headers.append(response.getheader('Connection'))
+    assert headers == ['keep-alive', 'keep-alive', 'close']
+    conn.close()
+
+
+def test_pipelined_requests_answered_in_order(server):
+    with socket.create_connection(('127.0.0.1', server.server_address[1]), timeout=5) as sock:
+        request = b"GET /nope HTTP/1.1\r\nHost: test\r\n\r\n"
+        sock.sendall(request * 2 + b"GET /nope HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n")
+        received = b''
+        while chunk := sock.recv(65536):
+            received += chunk
+    assert received.count(b'HTTP/1.1 404') == 3
+
+
+def test_oversized_body_is_rejected_and_closes(server, monkeypatch):
+    monkeypatch.setattr(Config, 'SERVER_MAX_BODY_BYTES', 16)
+    conn = connect(server)
+    conn.request('POST', '/login', body=b'{"email": "ada@example.com"}',
+                 headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    assert response.status == 413
+    assert response.getheader('Connection') == 'close'
+    response.read()
+    conn.close()
+
+
+def test_gzip_negotiation(monkeypatch):
+    monkeypatch.setattr(Config, 'GZIP_MIN_BYTES', 100)
+    body = b'{"results": []}' * 20
+    compressed, headers = compression.encode(body, 'br, gzip;q=0.5')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed) == body
+    assert compression.encode(body, 'gzip;q=0') == (body, {'Vary': 'Accept-Encoding'})
+    assert compression.encode(b'{}', 'gzip') == (b'{}', {})
+
+
+@pytest.mark.parametrize('header, allowed', [
+    ('gzip', True), ('GZIP;q=1.0', True), ('*', True), ('*, gzip;q=0', False),
+    ('identity', False), ('', False), (None, False), ('gzip;q=junk', False),
+])
+def test_accepts_gzip(header, allowed):
+    assert compression.accepts_gzip(header) is allowed
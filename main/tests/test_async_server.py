@@ -0,0 +1,54 @@
+import asyncio
+import time
+from async_server import AsyncAPIServer
+
+
+async def started_server(**options):
+    server = AsyncAPIServer('127.0.0.1', 0, db_threads=2, **options)
+    await server.start()
+    return server, server._server.sockets[0].getsockname()[1]
+
+
+async def get(reader, writer, path, headers=''):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: test\r\n{headers}\r\n".encode('latin-1'))
+    await writer.drain()
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+    length = int(next(line.split(':')[1] for line in head.split('\r\n')
+                      if line.lower().startswith('content-length')))
+    return head, await reader.readexactly(length)
+
+
+def test_keep_alive_serves_several_requests():
+    async def run():
+        server, port = await started_server()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for _ in range(3):
+            head, body = await get(reader, writer, '/nope')
+            assert head.startswith('HTTP/1.1 404') and 'Connection: keep-alive' in head
+        writer.close()
+        await server.stop(1)
+    asyncio.run(run())
+
+
+def test_stop_closes_idle_keep_alive_connections():
+    async def run():
+        server, port = await started_server()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        await get(reader, writer, '/nope')
+        started = time.monotonic()
+        await asyncio.wait_for(server.stop(5), 10)
+        assert time.monotonic() - started < 2
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+        assert server.connections == 0
+    asyncio.run(run())
+
+
+def test_last_keep_alive_request_closes():
+    async def run():
+        server, port = await started_server(max_keepalive_requests=2)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        assert 'Connection: keep-alive' in (await get(reader, writer, '/nope'))[0]
+        assert 'Connection: close' in (await get(reader, writer, '/nope'))[0]
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+        await server.stop(1)
+    asyncio.run(run())
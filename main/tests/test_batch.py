@@ -0,0 +1,51 @@
+import pytest
+import database
+from config import Config
+from conftest import PASSWORD
+from routes import dispatch
+
+
+def register_batch(items):
+    status, payload = dispatch('/register/batch', items)
+    assert status == 200, payload
+    return payload['results']
+
+
+def test_register_batch_reports_each_item(store):
+    results = register_batch([
+        {'name': 'Ada', 'email': 'ada@example.com', 'password': PASSWORD},
+        {'name': 'Ada again', 'email': 'ADA@example.com', 'password': PASSWORD},
+        {'name': 'Bob', 'email': 'not-an-email', 'password': PASSWORD},
+        {'name': 'Cy', 'email': 'cy@example.com', 'password': 'weak'},
+        'not an object',
+        {'name': 'Di', 'email': 'di@example.com', 'password': PASSWORD},
+    ])
+    assert [r['status'] for r in results] == [201, 409, 400, 400, 400, 201]
+    assert results[2]['error'] == "Invalid email format"
+    assert store.existing_emails(['ada@example.com', 'di@example.com', 'cy@example.com']) == \
+        {'ada@example.com', 'di@example.com'}
+
+
+def test_register_batch_skips_registered_emails(store):
+    database.register_user('Ada', 'ada@example.com', PASSWORD)
+    results = register_batch([{'name': 'Ada', 'email': 'ada@example.com', 'password': PASSWORD},
+                              {'name': 'Bob', 'email': 'bob@example.com', 'password': PASSWORD}])
+    assert [r['status'] for r in results] == [409, 201]
+
+
+@pytest.mark.parametrize('path', ['/register/batch', '/verify-token/batch'])
+def test_batch_shape_errors(store, monkeypatch, path):
+    monkeypatch.setattr(Config, 'MAX_BATCH_SIZE', 2)
+    assert dispatch(path, {'token': 'x'}) == (400, {"error": "Expected a JSON array"})
+    assert dispatch(path, []) == (400, {"error": "Batch is empty"})
+    assert dispatch(path, ['a', 'b', 'c'])[0] == 413
+
+
+def test_verify_token_batch(user, monkeypatch):
+    monkeypatch.setattr(Config, 'RESET_TOKEN_MODE', 'table')
+    token = database.forgot_password('ada@example.com')['reset_token']
+    status, payload = dispatch('/verify-token/batch', [token, {'token': token}, 'RESET-NOSUCHTOKEN', 5])
+    assert status == 200
+    results = payload['results']
+    assert [r['status'] for r in results] == [200, 200, 400, 400]
+    assert results[0]['email'] == 'ada@example.com'
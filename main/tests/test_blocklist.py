@@ -0,0 +1,68 @@
+import hashlib
+import random
+import pytest
+import blocklist
+import utils
+from blocklist import Blocklist, BlocklistError
+
+
+@pytest.fixture
+def compiled(tmp_path):
+    passwords = tmp_path / 'passwords.txt'
+    passwords.write_text("Summer2024!\nhunter2\n\nhunter2\n", encoding='utf-8')
+    pwned = tmp_path / 'pwned.txt'
+    sha1 = hashlib.sha1(b'Tr0ub4dor&3').hexdigest().upper()
+    pwned.write_text(f"{sha1}:42\n")
+    output = str(tmp_path / 'breached.bin')
+    # A tiny chunk size forces several runs through the merge
+    assert blocklist.build([str(passwords), str(pwned)], output, chunk_size=1) == 3
+    return Blocklist(output)
+
+
+def test_lookups(compiled):
+    assert len(compiled) == 3
+    assert 'hunter2' in compiled
+    assert 'Tr0ub4dor&3' in compiled
+    assert 'Summer2024!' in compiled
+    assert 'summer2024!' not in compiled
+    assert compiled.stats()['hits'] == 3
+    assert compiled.stats()['lookups'] == 4
+
+
+def test_search_finds_every_entry_of_a_large_list(tmp_path):
+    rng = random.Random(1)
+    words = [f"pw-{rng.getrandbits(48):012x}" for _ in range(5000)]
+    source = tmp_path / 'words.txt'
+    source.write_text('\n'.join(words))
+    output = str(tmp_path / 'big.bin')
+    blocklist.build([str(source)], output, chunk_size=1000)
+    big = Blocklist(output)
+    assert all(word in big for word in words)
+    assert not any(f"other-{i}" in big for i in range(1000))
+
+
+def test_empty_list(tmp_path):
+    source = tmp_path / 'empty.txt'
+    source.write_text('')
+    output = str(tmp_path / 'empty.bin')
+    assert blocklist.build([str(source)], output) == 0
+    assert 'anything' not in Blocklist(output)
+
+
+def test_rejects_a_damaged_file(compiled, tmp_path):
+    with open(compiled.path, 'rb') as f:
+        data = f.read()
+    truncated = tmp_path / 'truncated.bin'
+    truncated.write_bytes(data[:-3])
+    with pytest.raises(BlocklistError):
+        Blocklist(str(truncated))
+    wrong = tmp_path / 'wrong.bin'
+    wrong.write_bytes(b'XXXX' + data[4:])
+    with pytest.raises(BlocklistError):
+        Blocklist(str(wrong))
+
+
+def test_validation_rejects_breached_passwords(compiled, monkeypatch):
+    monkeypatch.setattr(utils, 'BREACHED_PASSWORDS', compiled)
+    assert utils.validate_password_strength('Summer2024!') == (False, utils.PASSWORD_BREACHED)
+    assert utils.validate_password_strength('Corr3ct!Horse')[0]
@@ -0,0 +1,71 @@
+import threading
+import time
+import pytest
+import hash_executor
+from hash_executor import HashExecutor, HashQueueFull
+
+release = threading.Event()
+
+
+def blocking(value):
+    release.wait(5)
+    return value
+
+
+def double(value):
+    return value * 2
+
+
+def hold_slot(executor):
+    """Start a job that keeps its queue slot until `release` is set"""
+    release.clear()
+    thread = threading.Thread(target=executor.submit, args=('block', blocking, 1))
+    thread.start()
+    while executor.stats()['queued'] == 0:
+        time.sleep(0.001)
+    return thread
+
+
+def test_map_keeps_order_and_counts():
+    executor = HashExecutor(workers=0)
+    assert executor.map('double', double, [(n,) for n in range(5)]) == [0, 2, 4, 6, 8]
+    assert executor.map('double', double, []) == []
+    assert executor.stats()['jobs']['double']['count'] == 5
+
+
+def test_full_queue_rejects_after_waiting():
+    executor = HashExecutor(workers=0, max_queue=1, queue_wait=0.1)
+    thread = hold_slot(executor)
+    started = time.monotonic()
+    with pytest.raises(HashQueueFull):
+        executor.submit('double', double, 1)
+    assert time.monotonic() - started >= 0.1
+    release.set()
+    thread.join()
+    assert executor.stats()['rejected'] == 1
+    assert executor.submit('double', double, 1) == 2
+
+
+def test_waiting_job_gets_the_freed_slot():
+    executor = HashExecutor(workers=0, max_queue=1, queue_wait=5)
+    thread = hold_slot(executor)
+    threading.Timer(0.05, release.set).start()
+    assert executor.submit('double', double, 21) == 42
+    thread.join()
+    assert executor.stats()['rejected'] == 0
+
+
+def test_prefork_workers_share_the_host(monkeypatch):
+    monkeypatch.setattr(hash_executor, '_executor', None)
+    monkeypatch.setattr(hash_executor.Config, 'HASH_WORKERS', 8)
+    monkeypatch.setattr(hash_executor, '_processes', 1)
+    hash_executor.share_host(3)
+    try:
+        assert hash_executor.get_executor().workers == 2
+    finally:
+        hash_executor.shutdown()
+    hash_executor.share_host(16)
+    try:
+        assert hash_executor.get_executor().workers == 1
+    finally:
+        hash_executor.shutdown()
@@ -0,0 +1,63 @@
+import hashlib
+import pytest
+import database
+import hashers
+from hashers import PBKDF2Hasher, ScryptHasher, LegacySHA256Hasher
+
+
+def legacy_hash(password, salt='abc123'):
+    return f"{salt}${hashlib.sha256((password + salt).encode()).hexdigest()}"
+
+
+@pytest.mark.parametrize('hasher', [ScryptHasher(n=1024), PBKDF2Hasher(iterations=1000)])
+def test_round_trip(hasher):
+    encoded = hasher.encode('s3cret!')
+    assert encoded.startswith(hasher.algorithm + '$')
+    assert hashers.identify_hasher(encoded) is hashers.HASHERS[hasher.algorithm]
+    assert hashers.check_password(encoded, 's3cret!')
+    assert not hashers.check_password(encoded, 's3cret?')
+    assert hasher.encode('s3cret!') != encoded  # fresh salt each time
+
+
+def test_legacy_hashes_verify_but_are_never_made():
+    encoded = legacy_hash('s3cret!')
+    assert hashers.identify_hasher(encoded).algorithm == LegacySHA256Hasher.algorithm
+    assert hashers.check_password(encoded, 's3cret!')
+    with pytest.raises(ValueError):
+        LegacySHA256Hasher().encode('s3cret!')
+
+
+@pytest.mark.parametrize('encoded', ['', 'garbage', 'scrypt$notanumber', 'pbkdf2_sha256$1'])
+def test_malformed_hash_never_verifies(encoded):
+    assert not hashers.check_password(encoded, 's3cret!')
+
+
+def test_needs_rehash(monkeypatch):
+    monkeypatch.setitem(hashers.HASHERS, 'scrypt', ScryptHasher(n=2048))
+    monkeypatch.setattr(hashers.Config, 'PASSWORD_HASHER', 'scrypt')
+    assert hashers.needs_rehash(ScryptHasher(n=1024).encode('pw'))
+    assert not hashers.needs_rehash(ScryptHasher(n=2048).encode('pw'))
+    assert not hashers.needs_rehash(ScryptHasher(n=4096).encode('pw'))
+    assert hashers.needs_rehash(PBKDF2Hasher(iterations=1000).encode('pw'))
+    assert hashers.needs_rehash(legacy_hash('pw'))
+
+
+def test_login_upgrades_legacy_hash(store):
+    store.insert_users([{'id': 'USR-LEGACY', 'name': 'Old', 'email': 'old@example.com',
+                         'password_hash': legacy_hash('0ld!Password'), 'hash_algorithm': 'sha256_legacy',
+                         'age': None, 'dob': None}])
+    assert 'access_token' in database.login_user(email='old@example.com', password='0ld!Password')
+    upgraded = store.find_user(user_id='USR-LEGACY')['password_hash']
+    assert upgraded.startswith('scrypt$')
+    # The cache was invalidated: the next login verifies against the new hash
+    assert 'access_token' in database.login_user(email='old@example.com', password='0ld!Password')
+    assert database.login_user(email='old@example.com', password='wrong') == {"error": "Invalid password"}
+
+
+def test_failed_login_keeps_legacy_hash(store):
+    stored = legacy_hash('0ld!Password')
+    store.insert_users([{'id': 'USR-LEGACY', 'name': 'Old', 'email': 'old@example.com',
+                         'password_hash': stored, 'hash_algorithm': 'sha256_legacy',
+                         'age': None, 'dob': None}])
+    database.login_user(email='old@example.com', password='wrong')
+    assert store.find_user(user_id='USR-LEGACY')['password_hash'] == stored
@@ -0,0 +1,91 @@
+import re
+import threading
+import pytest
+import ids
+from ids import IdGenerator, NODE_BITS, SEQUENCE_BITS
+from utils import SHARD_BUCKETS, email_bucket, generate_user_id, user_id_bucket
+
+
+def fields(value):
+    return (value >> (NODE_BITS + SEQUENCE_BITS),
+            (value >> SEQUENCE_BITS) & ((1 << NODE_BITS) - 1),
+            value & ((1 << SEQUENCE_BITS) - 1))
+
+
+def test_layout():
+    generator = IdGenerator(host_node=3, worker=7)
+    ms, node, _ = fields(generator.next())
+    assert node == (3 << ids.WORKER_BITS) | 7
+    assert abs(ms - ids.time.time_ns() // 1_000_000) < 1000
+
+
+def test_strictly_increasing_across_threads():
+    generator = IdGenerator()
+    issued = []
+
+    def draw():
+        issued.extend(generator.next() for _ in range(5000))
+
+    threads = [threading.Thread(target=draw) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(issued)) == len(issued)
+
+
+def test_same_millisecond_counts_up(monkeypatch):
+    generator = IdGenerator()
+    monkeypatch.setattr(ids.time, 'time_ns', lambda: 5_000_000_000)
+    values = [generator.next() for _ in range(3)]
+    assert [fields(v) for v in values] == [(5000, 0, 0), (5000, 0, 1), (5000, 0, 2)]
+
+
+def test_clock_stepping_back_keeps_order(monkeypatch):
+    generator = IdGenerator()
+    now = [5_000_000_000]
+    monkeypatch.setattr(ids.time, 'time_ns', lambda: now[0])
+    first = generator.next()
+    now[0] -= 2_000_000
+    assert generator.next() > first
+
+
+def test_sequence_overflow_borrows_next_millisecond(monkeypatch):
+    generator = IdGenerator()
+    monkeypatch.setattr(ids.time, 'time_ns', lambda: 5_000_000_000)
+    values = [generator.next() for _ in range(ids.MAX_SEQUENCE + 2)]
+    assert fields(values[-2]) == (5000, 0, ids.MAX_SEQUENCE)
+    assert fields(values[-1]) == (5001, 0, 0)
+
+
+@pytest.mark.parametrize('host_node, worker', [(-1, 0), (ids.MAX_HOST_NODE + 1, 0), (0, ids.MAX_WORKER + 1)])
+def test_out_of_range_node(host_node, worker):
+    with pytest.raises(ValueError):
+        IdGenerator(host_node, worker)
+
+
+def test_tool_worker_is_not_a_server_worker():
+    assert ids.TOOL_WORKER > ids.MAX_SERVER_WORKER
+    IdGenerator(ids.MAX_HOST_NODE, ids.TOOL_WORKER)
+
+
+def test_user_id_format():
+    user_id = generate_user_id('ada@example.com')
+    assert re.fullmatch(r'USR-[0-9A-F]{20}-[0-9A-F]{3}', user_id)
+    assert user_id_bucket(user_id) == email_bucket('ada@example.com')
+    # Zero-padded hex: string order is creation order
+    later = generate_user_id('bob@example.com')
+    assert later[:24] > user_id[:24]
+
+
+def test_email_bucket_range_and_spread():
+    buckets = [email_bucket(f'user{i}@example.com') for i in range(20000)]
+    assert all(0 <= b < SHARD_BUCKETS for b in buckets)
+    assert len(set(buckets)) > SHARD_BUCKETS * 0.95
+    assert email_bucket('ada@example.com') == email_bucket('ada@example.com')
+
+
+@pytest.mark.parametrize('user_id', ['USR-1A2B3C4D', 'USR-1A2B-3C4D-5E6F-001', 'USR-01A14B210E3C00400000-XYZ',
+                                     'USR-01A14B210E3C00400000-0001'])
+def test_ids_without_a_bucket(user_id):
+    assert user_id_bucket(user_id) is None
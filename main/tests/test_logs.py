@@ -0,0 +1,53 @@
+import json
+import logging
+import queue
+import logs
+
+
+def make_record(msg, fields=None, level=logging.INFO):
+    record = logging.LogRecord('api.test', level, __file__, 1, msg, None, None)
+    if fields is not None:
+        record.fields = fields
+    return record
+
+
+def test_redact_hides_sensitive_keys_at_any_depth():
+    data = {'password': 'Corr3ct!Horse', 'new_password': 'x', 'reset_token': 'RESET-1',
+            'items': [{'token': 't', 'name': 'Ada'}], 'count': 3}
+    assert logs.redact(data) == {'password': '***', 'new_password': '***', 'reset_token': '***',
+                                 'items': [{'token': '***', 'name': 'Ada'}], 'count': 3}
+
+
+def test_redact_masks_emails_inside_strings():
+    assert logs.redact("sent to ada.lovelace@example.com") == "sent to a***@example.com"
+    assert logs.redact({'email': 'Bob@Example.org'}) == {'email': 'B***@Example.org'}
+
+
+def test_formatter_redacts_message_and_fields():
+    record = make_record("Login for ada@example.com", {'email': 'ada@example.com', 'password': 'secret'})
+    entry = json.loads(logs.JSONFormatter().format(record))
+    assert entry['msg'] == "Login for a***@example.com"
+    assert entry['email'] == 'a***@example.com'
+    assert entry['password'] == '***'
+    assert entry['level'] == 'INFO' and entry['logger'] == 'api.test'
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = logs.DroppingQueueHandler(queue.Queue(1))
+    handler.handle(make_record("one"))
+    handler.handle(make_record("two"))
+    assert handler.queue.qsize() == 1
+    assert handler.dropped == 1
+
+
+def test_sampler_keeps_warnings_and_unsampled_routes():
+    sampler = logs.RouteSampler({'/login': 0.0}, default_rate=1.0)
+    assert not sampler.filter(make_record("ok", {'route': '/login'}))
+    assert sampler.filter(make_record("slow", {'route': '/login'}, logging.WARNING))
+    assert sampler.filter(make_record("ok", {'route': '/register'}))
+    assert sampler.filter(make_record("no route"))
+
+
+def test_parse_pairs():
+    assert logs._parse_pairs("database=DEBUG, api = WARNING,junk") == {'database': 'DEBUG', 'api': 'WARNING'}
+    assert logs._parse_pairs(None) == {}
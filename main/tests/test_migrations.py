@@ -0,0 +1,114 @@
+import pytest
+import migrations
+
+
+class FakeCursor:
+    """Answers the queries migrations.py makes, from the state on FakeConnection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        sql = ' '.join(sql.split())
+        conn = self.conn
+        conn.executed.append(sql)
+        self.rows = []
+        if sql.startswith('SELECT GET_LOCK'):
+            self.rows = [(conn.lock_result,)]
+        elif sql.startswith('SELECT RELEASE_LOCK'):
+            self.rows = [(1,)]
+        elif sql.startswith('SELECT version FROM schema_version'):
+            self.rows = [(v,) for v in conn.versions]
+        elif sql.startswith('INSERT INTO schema_version'):
+            conn.versions.add(params[0])
+        elif 'information_schema.columns' in sql:
+            self.rows = [(1,)] if params[1] in conn.columns else []
+        elif 'information_schema.statistics' in sql:
+            self.rows = [(1,)] if params[1] in conn.indexes else []
+        elif sql.startswith('SELECT id FROM users'):
+            last, limit = params if len(params) == 2 else (None, params[0])
+            self.rows = [(i,) for i in conn.pending if last is None or i > last][:limit]
+        elif sql.startswith('UPDATE users'):
+            conn.updates.append(list(params))
+            conn.pending = [i for i in conn.pending if i not in params]
+            self.rowcount = len(params)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executed = []
+        self.versions = set()
+        self.columns = set()
+        self.indexes = set()
+        self.pending = []
+        self.updates = []
+        self.commits = 0
+        self.lock_result = 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def conn():
+    return FakeConnection()
+
+
+def test_versions_are_unique_and_ordered():
+    versions = [version for version, _, _ in migrations.MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert migrations.latest_version() == versions[-1]
+
+
+def test_migrate_applies_pending_once(conn):
+    applied = migrations.migrate(conn)
+    assert applied == [version for version, _, _ in migrations.MIGRATIONS]
+    assert migrations.current_version(conn) == migrations.latest_version()
+    assert migrations.migrate(conn) == []
+    assert conn.executed[-1].startswith('SELECT RELEASE_LOCK')
+
+
+def test_migrate_stops_at_target(conn):
+    assert migrations.migrate(conn, target=2) == [1, 2]
+    assert migrations.migrate(conn) == [v for v, _, _ in migrations.MIGRATIONS if v > 2]
+
+
+def test_migrate_refuses_without_the_lock(conn):
+    conn.lock_result = 0
+    with pytest.raises(RuntimeError):
+        migrations.migrate(conn)
+    assert conn.versions == set()
+
+
+def test_schema_helpers_skip_what_exists(conn):
+    conn.columns = {'hash_algorithm'}
+    conn.indexes = {'idx_users_created_at'}
+    m = migrations.Migrator(conn)
+    m.add_columns('users', {'hash_algorithm': "VARCHAR(32) NULL"})
+    m.add_index('users', 'idx_users_created_at', 'created_at')
+    assert not [sql for sql in conn.executed if sql.startswith(('ALTER', 'CREATE INDEX'))]
+
+    m.add_columns('users', {'hash_algorithm': "VARCHAR(32) NULL", 'nickname': "VARCHAR(50) NULL"})
+    assert conn.executed[-1] == "ALTER TABLE users ADD COLUMN nickname VARCHAR(50) NULL, ALGORITHM=INPLACE, LOCK=NONE"
+
+
+def test_backfill_walks_the_key_in_batches(conn):
+    conn.pending = list(range(1, 6))
+    m = migrations.Migrator(conn, batch_size=2, pause=0)
+    assert m.backfill('users', "hash_algorithm = 'x'", "hash_algorithm IS NULL") == 5
+    assert conn.updates == [[1, 2], [3, 4], [5]]
+    assert conn.commits == 3
@@ -0,0 +1,115 @@
+import threading
+import time
+import pytest
+from pool import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rolled_back = 0
+
+    def close(self):
+        self.closed = True
+
+    def rollback(self):
+        if self.closed:
+            raise RuntimeError("closed")
+        self.rolled_back += 1
+
+    def is_connected(self):
+        return not self.closed
+
+
+class Factory:
+    def __init__(self):
+        self.made = []
+        self.failing = False
+
+    def __call__(self):
+        if self.failing:
+            return None
+        conn = FakeConnection()
+        self.made.append(conn)
+        return conn
+
+
+@pytest.fixture
+def factory():
+    return Factory()
+
+
+def test_released_connection_is_reused(factory):
+    pool = ConnectionPool(factory, min_size=0, max_size=2)
+    conn = pool.get_connection()
+    conn.close()
+    conn.close()  # a second close is a no-op
+    pool.get_connection()
+    assert len(factory.made) == 1
+    assert factory.made[0].rolled_back == 1
+    assert pool.stats()['borrowed'] == 1
+
+
+def test_fill_opens_min_size(factory):
+    pool = ConnectionPool(factory, min_size=3, max_size=5)
+    pool.fill()
+    assert pool.stats()['idle'] == 3
+
+
+def test_exhausted_pool_times_out(factory):
+    pool = ConnectionPool(factory, min_size=0, max_size=1, borrow_timeout=0.05)
+    pool.get_connection()
+    assert pool.get_connection() is None
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_waiter_gets_released_connection(factory):
+    pool = ConnectionPool(factory, min_size=0, max_size=1, borrow_timeout=5)
+    held = pool.get_connection()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.get_connection()))
+    waiter.start()
+    time.sleep(0.05)
+    held.close()
+    waiter.join(5)
+    assert got and got[0] is not None
+    assert len(factory.made) == 1
+
+
+def test_dead_connection_replaced(factory):
+    pool = ConnectionPool(factory, min_size=0, max_size=1)
+    pool.get_connection().close()
+    factory.made[0].closed = True  # the server hung up while it sat idle
+    pool.get_connection()
+    assert len(factory.made) == 2
+    assert pool.stats()['size'] == 1
+
+
+def test_failed_open_frees_its_slot(factory):
+    pool = ConnectionPool(factory, min_size=0, max_size=1, borrow_timeout=0.05)
+    factory.failing = True
+    assert pool.get_connection() is None
+    factory.failing = False
+    assert pool.get_connection() is not None
+
+
+def test_idle_connections_pruned_to_min_size(factory):
+    pool = ConnectionPool(factory, min_size=1, max_size=3, idle_timeout=0.05)
+    borrowed = [pool.get_connection() for _ in range(3)]
+    for conn in borrowed:
+        conn.close()
+    time.sleep(0.1)
+    pool.get_connection()
+    assert [conn.closed for conn in factory.made].count(True) == 2
+    assert pool.stats()['size'] == 1
+
+
+def test_close_all_closes_borrowed_ones_on_release(factory):
+    pool = ConnectionPool(factory, min_size=0, max_size=2)
+    idle, borrowed = pool.get_connection(), pool.get_connection()
+    idle.close()
+    pool.close_all()
+    assert factory.made[0].closed and not factory.made[1].closed
+    borrowed.close()
+    assert factory.made[1].closed
+    assert pool.stats()['size'] == 0
@@ -0,0 +1,117 @@
+import pytest
+import ratelimit
+from ratelimit import TokenBucketLimiter, LoginThrottle, parse_rate
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.mark.parametrize('spec, expected', [
+    ('20/1', (20.0, 20.0)),
+    ('10/60', (10.0, 10 / 60)),
+    ('5', (5.0, 5.0)),
+    ('', None),
+    ('0', None),
+    ('off', None),
+    ('0/10', None),
+])
+def test_parse_rate(spec, expected):
+    assert parse_rate(spec) == expected
+
+
+def test_bucket_allows_burst_then_limits(clock):
+    limiter = TokenBucketLimiter(capacity=3, rate=1)
+    assert [limiter.take('ip') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('ip') == pytest.approx(1.0)
+    assert limiter.take('other') == 0
+    assert limiter.stats() == {"keys": 2, "allowed": 4, "limited": 1, "evictions": 0}
+
+
+def test_bucket_refills(clock):
+    limiter = TokenBucketLimiter(capacity=2, rate=0.5)
+    limiter.take('ip', cost=2)
+    clock.now += 1
+    assert limiter.take('ip') == pytest.approx(1.0)
+    clock.now += 1
+    assert limiter.take('ip') == 0
+    # Never more than a full bucket, however long the key was idle
+    clock.now += 3600
+    assert limiter.take('ip', cost=2) == 0
+    assert limiter.take('ip') > 0
+
+
+def test_oversized_request_costs_a_full_bucket(clock):
+    limiter = TokenBucketLimiter(capacity=5, rate=1)
+    assert limiter.take('ip', cost=50) == 0
+    assert limiter.take('ip') > 0
+
+
+def test_bucket_evicts_least_recent_key(clock):
+    limiter = TokenBucketLimiter(capacity=1, rate=0.001, max_keys=2)
+    limiter.take('a')
+    limiter.take('b')
+    limiter.take('a')  # 'a' is now the most recent
+    limiter.take('c')
+    assert limiter.stats()['evictions'] == 1
+    assert limiter.take('b') == 0    # forgotten, so a full bucket again
+    assert limiter.take('a') == 0    # and 'a' was pushed out by 'b'
+
+
+def test_lockout_doubles_up_to_cap(clock):
+    throttle = LoginThrottle(threshold=3, base=1, max_lockout=8)
+    for _ in range(2):
+        throttle.failure('ada')
+    assert throttle.check('ada') == 0
+    lockouts = []
+    for _ in range(6):
+        throttle.failure('ada')
+        lockouts.append(throttle.check('ada'))
+    assert lockouts == [1, 2, 4, 8, 8, 8]
+    clock.now += 8
+    assert throttle.check('ada') == 0
+
+
+def test_success_clears_failures(clock):
+    throttle = LoginThrottle(threshold=2, base=1, max_lockout=60)
+    throttle.failure('ada')
+    throttle.success('ada')
+    throttle.failure('ada')
+    assert throttle.check('ada') == 0
+
+
+def test_quiet_spell_clears_failures(clock):
+    throttle = LoginThrottle(threshold=2, base=1, max_lockout=60, reset_after=600)
+    throttle.failure('ada')
+    clock.now += 601
+    throttle.failure('ada')
+    assert throttle.check('ada') == 0
+    assert throttle.stats()['lockouts'] == 0
+
+
+def test_failures_outlive_a_capped_lockout(clock):
+    throttle = LoginThrottle(threshold=3, base=1, max_lockout=8, reset_after=80)
+    for _ in range(7):
+        throttle.failure('ada')
+    assert throttle.check('ada') == 8
+    # Waiting out the longest lockout does not buy fresh free guesses
+    clock.now += 9
+    assert throttle.check('ada') == 0
+    throttle.failure('ada')
+    assert throttle.check('ada') == 8
+
+
+@pytest.mark.parametrize('delay, header', [(0.01, 1), (1.0, 1), (1.2, 2), (30, 30)])
+def test_retry_after_seconds(delay, header):
+    assert ratelimit.retry_after_seconds(delay) == header
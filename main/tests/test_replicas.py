@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+import pytest
+import replicas
+from replicas import Replica, ReplicaSet, RecentWrites, parse_replicas
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeCursor:
+    def __init__(self, source):
+        self.source = source
+
+    def execute(self, sql, params=()):
+        pass
+
+    def fetchall(self):
+        return [{'ok': 1}]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, dictionary=False):
+        if self.pool.error is not None:
+            raise self.pool.error
+        return FakeCursor(self.pool.name)
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, name):
+        self.name = name
+        self.down = False
+        self.error = None
+
+    def get_connection(self):
+        return None if self.down else FakeConnection(self)
+
+    def close_all(self):
+        pass
+
+
+def make_set(count=2, selection='round_robin'):
+    return ReplicaSet([Replica(f'db{i}', 3306, FakePool(f'db{i}')) for i in range(count)],
+                      selection, check_interval=0)
+
+
+def test_parse_replicas():
+    assert parse_replicas('db2, db3:3307,,') == [('db2', 3306), ('db3', 3307)]
+    assert parse_replicas('') == []
+
+
+def test_round_robin_skips_unhealthy_replicas():
+    replica_set = make_set(3)
+    assert [replica_set.acquire().host for _ in range(3)] == ['db0', 'db1', 'db2']
+    replica_set.mark_down(replica_set.replicas[1], "gone")
+    assert {replica_set.acquire().host for _ in range(4)} == {'db0', 'db2'}
+    for replica in replica_set.replicas:
+        replica.healthy = False
+    assert replica_set.acquire() is None
+
+
+def test_least_outstanding_prefers_the_idle_replica():
+    replica_set = make_set(2, 'least_outstanding')
+    busy = replica_set.acquire()
+    assert replica_set.acquire() is not busy
+    replica_set.release(busy)
+    assert replica_set.stats()['outstanding'] == 1
+
+
+def test_health_check_marks_replicas_down_and_up():
+    replica_set = make_set(2)
+    replica_set.replicas[0].pool.down = True
+    replica_set.check()
+    assert [r.healthy for r in replica_set.replicas] == [False, True]
+    replica_set.replicas[0].pool.down = False
+    replica_set.check()
+    assert replica_set.stats()['healthy'] == 2
+
+
+def test_unknown_selection():
+    with pytest.raises(ValueError):
+        ReplicaSet([], 'random')
+
+
+def test_recent_writes_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(replicas.time, 'monotonic', clock)
+    recent = RecentWrites(window=2)
+    recent.add('USR-1', 'ada@example.com', None)
+    assert 'USR-1' in recent and recent.any([None, 'ada@example.com'])
+    clock.now += 3
+    assert not recent.any(['USR-1', 'ada@example.com'])
+    recent.add('USR-2')
+    assert len(recent) == 1
+
+
+def test_recent_writes_disabled_and_bounded():
+    disabled = RecentWrites(window=0)
+    disabled.add('x')
+    assert len(disabled) == 0
+    recent = RecentWrites(window=60, max_keys=2)
+    recent.add('a', 'b', 'c')
+    assert 'a' not in recent and 'c' in recent
+
+
+# --- MySQLStorage._read routing; needs the MySQL driver for its error types ---
+
+@pytest.fixture
+def mysql_store(monkeypatch):
+    pytest.importorskip('mysql.connector')
+    import storage
+    store = storage.MySQLStorage(replicas='db0')
+    store._replicas = make_set(1)
+    monkeypatch.setattr(storage, '_TimedConnection', lambda conn: conn)
+
+    @contextmanager
+    def primary_cursor(dictionary=False):
+        yield None, FakeCursor('primary')
+    monkeypatch.setattr(store, '_cursor', primary_cursor)
+    return store
+
+
+def read(store, keys=('USR-1',), **options):
+    return store._read(keys, lambda cursor: cursor.source, **options)
+
+
+def test_reads_go_to_a_replica(mysql_store):
+    assert read(mysql_store) == 'db0'
+    assert mysql_store._replicas.stats()['outstanding'] == 0
+
+
+def test_recent_write_reads_the_primary(mysql_store):
+    mysql_store._recent_writes.add('USR-1')
+    assert read(mysql_store) == 'primary'
+    assert read(mysql_store, keys=('USR-2',)) == 'db0'
+    assert read(mysql_store, keys=('ada@example.com',), written=lambda result: ['USR-1']) == 'primary'
+    assert mysql_store.primary_reads == 2
+
+
+def test_replica_miss_asks_the_primary(mysql_store):
+    assert read(mysql_store, missing=lambda result: result == 'db0') == 'primary'
+    assert mysql_store.replica_misses == 1
+
+
+def test_failed_replica_falls_back_and_is_marked_down(mysql_store):
+    import mysql.connector
+    mysql_store._replicas.replicas[0].pool.error = mysql.connector.OperationalError("lost")
+    assert read(mysql_store) == 'primary'
+    assert mysql_store.replica_fallbacks == 1
+    assert read(mysql_store) == 'primary'
+    assert mysql_store._replicas.stats()['healthy'] == 0
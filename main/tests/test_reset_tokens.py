@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+import pytest
+import database
+import reset_tokens
+from config import Config
+from conftest import PASSWORD
+
+NEW_PASSWORD = 'N3w!Password'
+
+
+@pytest.fixture(params=['table', 'signed'])
+def mode(request, monkeypatch):
+    monkeypatch.setattr(Config, 'RESET_TOKEN_MODE', request.param)
+    return request.param
+
+
+def test_reset_changes_password(mode, user):
+    reset = database.forgot_password('ada@example.com')
+    assert reset['user_id'] == user['user_id']
+    assert reset_tokens.is_signed(reset['reset_token']) == (mode == 'signed')
+    assert database.verify_reset_token(reset['reset_token'])['email'] == 'ada@example.com'
+
+    assert database.reset_password(reset['reset_token'], NEW_PASSWORD)['success']
+    assert database.login_user(email='ada@example.com', password=PASSWORD) == {"error": "Invalid password"}
+    assert 'access_token' in database.login_user(email='ada@example.com', password=NEW_PASSWORD)
+
+
+def test_token_works_once(mode, user):
+    token = database.forgot_password('ada@example.com')['reset_token']
+    assert database.reset_password(token, NEW_PASSWORD)['success']
+    assert database.reset_password(token, 'An0ther!Password') == {"error": "Invalid or expired reset token"}
+
+
+def test_weak_password_keeps_token(mode, user):
+    token = database.forgot_password('ada@example.com')['reset_token']
+    assert 'error' in database.reset_password(token, 'short')
+    assert database.reset_password(token, NEW_PASSWORD)['success']
+
+
+def test_unknown_email(mode, store):
+    assert database.forgot_password('nobody@example.com') == {"error": "User not found"}
+
+
+def test_altered_token_rejected(mode, user):
+    token = database.forgot_password('ada@example.com')['reset_token']
+    altered = token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB')
+    assert database.verify_reset_token(altered) == {"error": "Invalid or expired token"}
+    assert database.reset_password(altered, NEW_PASSWORD) == {"error": "Invalid or expired reset token"}
+
+
+def test_verify_batch_keeps_order(store, user, monkeypatch):
+    monkeypatch.setattr(Config, 'RESET_TOKEN_MODE', 'table')
+    stored = database.forgot_password('ada@example.com')['reset_token']
+    monkeypatch.setattr(Config, 'RESET_TOKEN_MODE', 'signed')
+    signed = database.forgot_password('ada@example.com')['reset_token']
+    results = database.verify_reset_tokens([signed, 'RESET-NOSUCHTOKEN', stored])
+    assert [r.get('valid', False) for r in results] == [True, False, True]
+
+
+def test_stored_tokens_capped_per_user(store, user, monkeypatch):
+    monkeypatch.setattr(Config, 'RESET_TOKEN_MODE', 'table')
+    monkeypatch.setattr(Config, 'RESET_TOKEN_MAX_PER_USER', 2)
+    tokens = [database.forgot_password('ada@example.com')['reset_token'] for _ in range(3)]
+    assert [bool(store.find_reset_tokens([t])) for t in tokens] == [False, True, True]
+
+
+def test_expired_tokens(store, user):
+    store.add_reset_token('t1', user['user_id'], 'RESET-EXPIRED', datetime.now() - timedelta(seconds=1))
+    assert database.verify_reset_token('RESET-EXPIRED') == {"error": "Invalid or expired token"}
+    assert database.delete_expired_reset_tokens(100) == 1
+
+
+def test_signed_token_expires(user):
+    token = reset_tokens.issue(database.get_storage().find_user(email='ada@example.com'), ttl=-1)
+    with pytest.raises(reset_tokens.InvalidToken):
+        reset_tokens.decode(token)
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+import pytest
+import database
+import sessions
+from conftest import PASSWORD
+
+
+def login(email='ada@example.com', password=PASSWORD):
+    return database.login_user(email=email, password=password)
+
+
+def test_login_issues_tokens(user):
+    result = login()
+    assert result['user_id'] == user['user_id']
+    assert result['token_type'] == 'Bearer'
+    claims = sessions.authenticate(result['access_token'])
+    assert claims['u'] == user['user_id']
+    assert claims['m'] == 'ada@example.com'
+
+
+def test_login_rejects_wrong_password(user):
+    assert login(password='Wr0ng!Password') == {"error": "Invalid password"}
+
+
+def test_refresh_rotates(user):
+    first = login()
+    second = database.refresh_session(first['refresh_token'])
+    assert 'error' not in second
+    third = database.refresh_session(second['refresh_token'])
+    assert 'error' not in third
+    assert sessions.authenticate(third['access_token'])['u'] == user['user_id']
+
+
+def test_reused_refresh_token_ends_session(user):
+    first = login()
+    second = database.refresh_session(first['refresh_token'])
+    # The old token again: it was copied, so neither copy may go on
+    assert 'error' in database.refresh_session(first['refresh_token'])
+    assert 'error' in database.refresh_session(second['refresh_token'])
+    with pytest.raises(sessions.InvalidToken):
+        sessions.authenticate(second['access_token'])
+
+
+def test_logout(user):
+    tokens = login()
+    session_id = sessions.authenticate(tokens['access_token'])['s']
+    assert database.end_session(session_id, user_id=user['user_id']) == {"message": "Logged out"}
+    with pytest.raises(sessions.InvalidToken):
+        sessions.authenticate(tokens['access_token'])
+    assert 'error' in database.refresh_session(tokens['refresh_token'])
+
+
+def test_tampered_token_rejected(user):
+    token = login()['access_token']
+    with pytest.raises(sessions.InvalidToken):
+        sessions.authenticate(token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB'))
+    with pytest.raises(sessions.InvalidToken):
+        sessions.decode_refresh(token)
+
+
+def test_password_reset_ends_every_session(user):
+    phone, laptop = login(), login()
+    reset = database.forgot_password('ada@example.com')
+    assert database.reset_password(reset['reset_token'], 'N3w!Password')['success']
+    for tokens in (phone, laptop):
+        with pytest.raises(sessions.InvalidToken):
+            sessions.authenticate(tokens['access_token'])
+        assert 'error' in database.refresh_session(tokens['refresh_token'])
+    assert 'access_token' in login(password='N3w!Password')
+
+
+def test_expired_sessions_swept(store, user):
+    login()
+    store.add_session('old', user['user_id'], 'refresh', datetime.now() - timedelta(seconds=1))
+    assert database.delete_expired_sessions(100) == 1
+    assert database.delete_expired_sessions(100) == 0
+
+
+def test_denylist_forgets_after_ttl(monkeypatch):
+    denylist = sessions.Denylist(ttl=10)
+    now = [1000.0]
+    monkeypatch.setattr(sessions.time, 'time', lambda: now[0])
+    denylist.add('s1')
+    assert 's1' in denylist
+    now[0] += 11
+    assert 's1' not in denylist
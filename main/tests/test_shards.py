@@ -0,0 +1,86 @@
+import pytest
+import database
+import storage
+from conftest import PASSWORD
+from shards import HashRing, ShardedStorage, parse_shards
+from user_cache import UserCache
+from utils import SHARD_BUCKETS, email_bucket
+
+
+def test_parse_shards():
+    assert parse_shards(' s0=db-a, s1=db-b:3307 ') == {'s0': ('db-a', 3306), 's1': ('db-b', 3307)}
+
+
+@pytest.mark.parametrize('spec', ['', 's0', 's0=', '=db-a', 's0=db-a,s0=db-b'])
+def test_parse_shards_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_shards(spec)
+
+
+def test_ring_is_stable_and_balanced():
+    ring, same = HashRing(['s0', 's1', 's2']), HashRing(['s2', 's0', 's1'])
+    assert all(ring.owner(b) == same.owner(b) for b in range(SHARD_BUCKETS))
+    counts = {name: 0 for name in ring.names}
+    for bucket in range(SHARD_BUCKETS):
+        counts[ring.owner(bucket)] += 1
+    assert all(SHARD_BUCKETS / 3 * 0.8 < count < SHARD_BUCKETS / 3 * 1.2 for count in counts.values())
+
+
+def test_adding_a_shard_moves_only_its_share():
+    old, new = HashRing(['s0', 's1', 's2']), HashRing(['s0', 's1', 's2', 's3'])
+    moves = old.moves(new)
+    assert {target for _, target in moves.values()} == {'s3'}
+    assert SHARD_BUCKETS / 4 * 0.8 < len(moves) < SHARD_BUCKETS / 4 * 1.2
+    assert new.moves(new) == {}
+
+
+@pytest.fixture
+def sharded(monkeypatch):
+    shards = {name: storage.MemoryStorage() for name in ('s0', 's1', 's2')}
+    backend = ShardedStorage(shards, HashRing(shards))
+    monkeypatch.setattr(storage, '_storage', backend)
+    monkeypatch.setattr(database, 'user_cache', UserCache())
+    monkeypatch.setattr(database, '_user_filter', None)
+    return backend
+
+
+def holders(backend, email):
+    return [name for name, shard in backend.shards.items() if shard.find_user(email=email)]
+
+
+def test_users_go_to_their_buckets_shard(sharded):
+    emails = [f'user{i}@example.com' for i in range(30)]
+    results = database.register_users([('User', email, PASSWORD, None, None) for email in emails])
+    assert all('user_id' in r for r in results)
+    for email, result in zip(emails, results):
+        assert holders(sharded, email) == [sharded.ring.owner(email_bucket(email))]
+        assert sharded.find_user(user_id=result['user_id'])['email'] == email
+    assert database.shard_names() == ['s0', 's1', 's2']
+
+
+def test_sessions_and_tokens_follow_the_user(sharded):
+    user_id = database.register_user('Ada', 'ada@example.com', PASSWORD)['user_id']
+    owner = sharded.shards[sharded.ring.owner(email_bucket('ada@example.com'))]
+    tokens = database.login_user(email='ada@example.com', password=PASSWORD)
+    assert 'error' not in database.refresh_session(tokens['refresh_token'])
+    reset = database.forgot_password('ada@example.com')['reset_token']
+    assert owner.find_reset_tokens([reset])
+    assert database.reset_password(reset, 'N3w!Password')['success']
+    assert owner.delete_user_sessions(user_id) == []
+
+
+def test_reads_fall_back_to_previous_owner_while_resharding(monkeypatch):
+    shards = {name: storage.MemoryStorage() for name in ('s0', 's1', 's2', 's3')}
+    old, new = HashRing(['s0', 's1', 's2']), HashRing(shards)
+    backend = ShardedStorage(shards, new, previous_ring=old)
+    bucket, (source, target) = next(iter(old.moves(new).items()))
+    email = next(f'user{i}@example.com' for i in range(100000) if email_bucket(f'user{i}@example.com') == bucket)
+    user = {'id': f'USR-00000000000000000000-{bucket:03X}', 'name': 'Moving', 'email': email,
+            'password_hash': 'salt$hash', 'hash_algorithm': 'sha256_legacy', 'age': None, 'dob': None}
+    shards[source].insert_users([user])  # not copied yet
+
+    assert backend.candidate_names(bucket) == (target, source)
+    assert backend.find_user(email=email)['id'] == user['id']
+    assert backend.existing_emails([email]) == {email}
+    assert backend.update_password_hash(user['id'], 'salt$new', 'sha256_legacy')
+    assert shards[source].find_user(email=email)['password_hash'] == 'salt$new'
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+import pytest
+import reset_tokens
+import storage
+from storage import DuplicateEmail, DuplicateId, StorageError
+
+LATER = datetime.now() + timedelta(hours=1)
+EARLIER = datetime.now() - timedelta(seconds=1)
+
+
+def make_user(n, **fields):
+    return dict({'id': f'USR-{n:020X}-000', 'name': f'User {n}', 'email': f'user{n}@example.com',
+                 'password_hash': f'salt$hash{n}', 'hash_algorithm': 'sha256_legacy',
+                 'age': None, 'dob': None}, **fields)
+
+
+@pytest.fixture
+def users(store):
+    batch = [make_user(n) for n in range(1, 4)]
+    store.insert_users(batch)
+    return batch
+
+
+def test_find_user_by_id_or_email(store, users):
+    assert store.find_user(user_id=users[0]['id']) == {field: users[0][field] for field in storage.USER_FIELDS}
+    assert store.find_user(email='user2@example.com')['id'] == users[1]['id']
+    assert store.find_user(email='nobody@example.com') is None
+    assert store.existing_emails(['user1@example.com', 'nobody@example.com']) == {'user1@example.com'}
+    assert store.existing_emails([]) == set()
+
+
+def test_insert_is_all_or_none(store, users):
+    with pytest.raises(DuplicateEmail):
+        store.insert_users([make_user(10), make_user(11, email='user1@example.com')])
+    with pytest.raises(DuplicateId):
+        store.insert_users([make_user(12), make_user(13, id=users[0]['id'])])
+    assert store.existing_emails(['user10@example.com', 'user12@example.com']) == set()
+
+
+def test_delete_takes_tokens_and_sessions(store, users):
+    user_id = users[0]['id']
+    store.add_reset_token('t1', user_id, 'RESET-1', LATER)
+    store.add_session('s1', user_id, 'r1', LATER)
+    assert store.delete_users([user_id, 'USR-NOSUCHUSER']) == 1
+    assert store.find_reset_tokens(['RESET-1']) == {}
+    assert not store.rotate_session('s1', 'r1', 'r2', LATER)
+
+
+def test_update_password_hash_checks_fingerprint(store, users):
+    user_id = users[0]['id']
+    stale = reset_tokens.fingerprint('salt$other')
+    assert not store.update_password_hash(user_id, 'salt$new', 'sha256_legacy', fingerprint=stale)
+    current = reset_tokens.fingerprint(users[0]['password_hash'])
+    assert store.update_password_hash(user_id, 'salt$new', 'sha256_legacy', fingerprint=current)
+    assert store.find_user(user_id=user_id)['password_hash'] == 'salt$new'
+    assert not store.update_password_hash('USR-NOSUCHUSER', 'salt$new', 'sha256_legacy')
+
+
+def test_reset_token_used_once(store, users):
+    user_id = users[0]['id']
+    store.add_reset_token('t1', user_id, 'RESET-1', LATER)
+    assert store.find_reset_tokens(['RESET-1', 'RESET-1', 'RESET-2']) == {
+        'RESET-1': {'token': 'RESET-1', 'user_id': user_id, 'email': 'user1@example.com', 'name': 'User 1'}}
+    assert store.use_reset_token('RESET-1', user_id, 'salt$new', 'sha256_legacy')
+    assert not store.use_reset_token('RESET-1', user_id, 'salt$newer', 'sha256_legacy')
+    assert store.find_user(user_id=user_id)['password_hash'] == 'salt$new'
+
+
+def test_expired_reset_tokens_swept_in_batches(store, users):
+    for n in range(3):
+        store.add_reset_token(f't{n}', users[0]['id'], f'RESET-{n}', EARLIER)
+    store.add_reset_token('live', users[0]['id'], 'RESET-LIVE', LATER)
+    assert store.find_reset_tokens(['RESET-0']) == {}
+    assert store.delete_expired_reset_tokens(2) == 2
+    assert store.delete_expired_reset_tokens(2) == 1
+    assert store.delete_expired_reset_tokens(2) == 0
+    assert store.find_reset_tokens(['RESET-LIVE'])
+
+
+def test_sessions(store, users):
+    user_id = users[0]['id']
+    with pytest.raises(StorageError):
+        store.add_session('orphan', 'USR-NOSUCHUSER', 'r', LATER)
+    store.add_session('s1', user_id, 'r1', LATER)
+    store.add_session('s2', user_id, 'r1', LATER)
+    store.add_session('old', user_id, 'r1', EARLIER)
+    assert store.rotate_session('s1', 'r1', 'r2', LATER)
+    assert not store.rotate_session('s1', 'r1', 'r3', LATER)
+    assert not store.rotate_session('old', 'r1', 'r2', LATER)
+    assert store.delete_session('s2')
+    assert not store.delete_session('s2')
+    assert sorted(store.delete_user_sessions(user_id)) == ['old', 's1']
+    assert store.delete_user_sessions(user_id) == []
+
+
+def test_scan_and_watermark(store, users):
+    assert store.scan_users('', 2) == [(u['id'], u['email']) for u in users[:2]]
+    assert store.scan_users(users[1]['id'], 10) == [(users[2]['id'], users[2]['email'])]
+    watermark, total = store.user_watermark()
+    assert total == 3
+    store.insert_users([make_user(4)])
+    since = store.users_since(watermark)
+    # May repeat rows from before the watermark, never misses a newer one
+    assert (make_user(4)['id'], 'user4@example.com') in since
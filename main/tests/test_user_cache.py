@@ -0,0 +1,101 @@
+import os
+import pytest
+import user_cache
+from user_cache import UserCache
+
+
+def make_user(n):
+    return {'id': f'USR-{n}', 'name': f'User {n}', 'email': f'user{n}@example.com',
+            'password_hash': f'salt$hash{n}', 'age': 30}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(user_cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_get_by_id_or_email():
+    cache = UserCache()
+    cache.put(make_user(1))
+    assert cache.get(user_id='USR-1')['email'] == 'user1@example.com'
+    assert cache.get(email='user1@example.com')['id'] == 'USR-1'
+    assert 'age' not in cache.get(user_id='USR-1')  # only the login fields
+    assert cache.get(email='user2@example.com') is None
+    assert cache.stats()['hits'] == 3 and cache.stats()['misses'] == 1
+
+
+def test_returns_copies():
+    cache = UserCache()
+    cache.put(make_user(1))
+    cache.get(user_id='USR-1')['password_hash'] = 'changed'
+    assert cache.get(user_id='USR-1')['password_hash'] == 'salt$hash1'
+
+
+def test_entries_expire(clock):
+    cache = UserCache(ttl=60)
+    cache.put(make_user(1))
+    clock[0] += 61
+    assert cache.get(user_id='USR-1') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_least_recently_used_evicted():
+    cache = UserCache(max_entries=2)
+    cache.put(make_user(1))
+    cache.put(make_user(2))
+    cache.get(user_id='USR-1')
+    cache.put(make_user(3))
+    assert cache.get(user_id='USR-2') is None
+    assert cache.get(email='user2@example.com') is None
+    assert cache.get(user_id='USR-1') and cache.get(user_id='USR-3')
+
+
+@pytest.mark.parametrize('key', [{'user_id': 'USR-1'}, {'email': 'user1@example.com'}])
+def test_invalidate_by_either_key(key):
+    cache = UserCache()
+    cache.put(make_user(1))
+    cache.invalidate(**key)
+    assert cache.get(user_id='USR-1') is None
+    assert cache.get(email='user1@example.com') is None
+
+
+def test_change_during_load_is_not_cached():
+    cache = UserCache()
+    version = cache.version(email='user1@example.com')
+    loaded = make_user(1)                    # read from the database...
+    cache.invalidate(email='user1@example.com')   # ...then changed elsewhere
+    cache.put(loaded, version)
+    assert cache.get(email='user1@example.com') is None
+
+
+def test_disabled_cache():
+    cache = UserCache(max_entries=0)
+    cache.put(make_user(1))
+    cache.invalidate(user_id='USR-1')
+    assert cache.get(user_id='USR-1') is None
+    assert cache.version(user_id='USR-1') is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_invalidation_reaches_forked_workers():
+    cache = UserCache()
+    cache.put(make_user(1))
+    pid = os.fork()
+    if pid == 0:
+        # A sibling worker changes the user
+        cache.invalidate(user_id='USR-1', email='user1@example.com')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert cache.get(user_id='USR-1') is None
+    assert cache.stats()['stale'] == 1
+
+
+def test_stamps_differ_per_bump():
+    stamps = user_cache.SharedStamps(slots=8)
+    assert stamps.read('id:USR-1') == 0
+    stamps.bump('id:USR-1')
+    first = stamps.read('id:USR-1')
+    stamps.bump('id:USR-1')
+    assert stamps.read('id:USR-1') not in (0, first)
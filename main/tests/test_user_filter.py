@@ -0,0 +1,84 @@
+import pytest
+import database
+from bloom import BloomFilter
+from config import Config
+from conftest import PASSWORD
+
+
+def test_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter(10000, 0.01)
+    for n in range(10000):
+        bloom.add(f"email:user{n}@example.com")
+    assert all(f"email:user{n}@example.com" in bloom for n in range(10000))
+    false_positives = sum(f"email:other{n}@example.com" in bloom for n in range(10000))
+    assert false_positives < 10000 * 0.02
+    assert bloom.stats()['count'] == 10000
+
+
+def register_elsewhere(store, n):
+    """A user inserted by another worker or host: in the table, not in our filter"""
+    user = {'id': f'USR-ELSEWHERE-{n}', 'name': 'Elsewhere', 'email': f'elsewhere{n}@example.com',
+            'password_hash': database.hash_password(PASSWORD), 'hash_algorithm': 'scrypt',
+            'age': None, 'dob': None}
+    store.insert_users([user])
+    return user
+
+
+@pytest.fixture
+def loaded(store, monkeypatch):
+    for name in ('_filter_watermark', '_filter_refreshed_at', '_rescan_watermark', '_rescanned_at'):
+        monkeypatch.setattr(database, name, getattr(database, name))
+    monkeypatch.setattr(Config, 'USER_FILTER_RESCAN_INTERVAL', 3600)
+    assert database.load_user_filter()
+    return store
+
+
+def test_own_registrations_are_in_the_filter(loaded):
+    user_id = database.register_user('Ada', 'ada@example.com', PASSWORD)['user_id']
+    assert database._user_may_exist(email='ada@example.com')
+    assert database._user_may_exist(user_id=user_id)
+
+
+def test_miss_asks_the_database_when_it_cannot_sync(loaded, monkeypatch):
+    monkeypatch.setattr(Config, 'USER_FILTER_REFRESH_INTERVAL', 3600)
+    user = register_elsewhere(loaded, 1)
+    # Just synced at load, so no sync now: the database must decide
+    assert database._user_may_exist(email=user['email'])
+    assert 'access_token' in database.login_user(email=user['email'], password=PASSWORD)
+    assert database.forgot_password(user['email'])['success']
+
+
+def test_miss_asks_the_database_while_another_sync_runs(loaded, monkeypatch):
+    monkeypatch.setattr(Config, 'USER_FILTER_REFRESH_INTERVAL', 0)
+    user = register_elsewhere(loaded, 1)
+    with database._filter_lock:
+        assert database._user_may_exist(email=user['email'])
+
+
+def test_miss_syncs_new_rows(loaded, monkeypatch):
+    monkeypatch.setattr(Config, 'USER_FILTER_REFRESH_INTERVAL', 0)
+    user = register_elsewhere(loaded, 1)
+    assert database._user_may_exist(user_id=user['id'])
+    assert not database._user_may_exist(email='nobody@example.com')
+    assert database.login_user(email='nobody@example.com', password=PASSWORD) == {"error": "User not found"}
+
+
+def test_rescan_finds_rows_that_committed_late(tmp_path, monkeypatch):
+    import storage
+    store = storage.SQLiteStorage(str(tmp_path / 'users.db'))
+    store.initialize()
+    monkeypatch.setattr(storage, '_storage', store)
+    monkeypatch.setattr(database, '_user_filter', None)
+    monkeypatch.setattr(Config, 'USER_FILTER_REFRESH_INTERVAL', 0)
+    monkeypatch.setattr(Config, 'USER_FILTER_RESCAN_INTERVAL', 3600)
+    database.load_user_filter()
+    user = register_elsewhere(store, 1)
+    # Inserted a minute before the last sync, committed after it
+    with store._cursor(write=True) as conn:
+        conn.execute("UPDATE users SET created_at = datetime('now', '-60 seconds')")
+    database._refresh_user_filter()
+    assert f"email:{user['email']}" not in database._user_filter
+    assert database._rescan_lock.acquire(blocking=False)
+    database._rescan_user_filter()
+    assert f"email:{user['email']}" in database._user_filter
+    store.close()
@@ -0,0 +1,68 @@
+import pytest
+import codec
+import routes
+import utils
+
+
+@pytest.mark.parametrize('raw, expected', [
+    (b'{"email": "ada@example.com"}', {'email': 'ada@example.com'}),
+    (b'  [1, 2]', [1, 2]),
+    (b'email=ada%40example.com&name=Ada', {'email': 'ada@example.com', 'name': 'Ada'}),
+    (b'{not json', {}),
+    (b'', {}),
+])
+def test_parse_body(raw, expected):
+    assert codec.parse_body(raw) == expected
+
+
+def test_dumps_returns_compact_utf8_bytes():
+    encoded = codec.dumps({"name": "Zoë", "n": [1, None]})
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == {"name": "Zoë", "n": [1, None]}
+
+
+def test_bad_json_raises_decode_error():
+    with pytest.raises(codec.DecodeError):
+        codec.loads(b'{"a":')
+
+
+@pytest.mark.parametrize('email, valid', [
+    ('ada@example.com', True), ('a.b+tag@sub.example.co', True),
+    ('ada@example', False), ('@example.com', False), ('ada example@x.com', False),
+])
+def test_is_valid_email(email, valid):
+    assert utils.is_valid_email(email) is valid
+
+
+@pytest.mark.parametrize('password, error', [
+    ('', utils.PASSWORD_EMPTY),
+    ('Ab1!', utils.PASSWORD_TOO_SHORT),
+    ('corr3ct!horse', utils.PASSWORD_NO_UPPER),
+    ('CORR3CT!HORSE', utils.PASSWORD_NO_LOWER),
+    ('Correct!Horse', utils.PASSWORD_NO_DIGIT),
+    ('Corr3ctHorse', utils.PASSWORD_NO_SPECIAL),
+])
+def test_password_strength_errors(password, error):
+    assert utils.validate_password_strength(password) == (False, error)
+
+
+def test_common_password_is_rejected(monkeypatch):
+    monkeypatch.setattr(utils, 'COMMON_PASSWORDS', frozenset({'corr3ct!horse'}))
+    assert utils.validate_password_strength('Corr3ct!Horse') == (False, utils.PASSWORD_COMMON)
+
+
+def test_common_passwords_file_is_lowercased(tmp_path):
+    path = tmp_path / 'common.txt'
+    path.write_text("Summer2024!\n\n  Winter!1  \n")
+    common = utils._load_common_passwords(str(path))
+    assert {'summer2024!', 'winter!1', 'password'} <= common
+
+
+def test_strong_password_and_nonascii_digit():
+    assert utils.validate_password_strength('Corr3ct!Horse')[0]
+    assert utils.validate_password_strength('Correct!Horse٣')[0]
+
+
+def test_every_password_error_has_a_ready_response():
+    for message in utils.PASSWORD_ERRORS:
+        assert routes.WEAK_PASSWORD[message] == (400, {"error": message})
@@ -0,0 +1,179 @@
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+STAMP_SLOTS = 1 << 16
+_STAMP = struct.Struct('Q')
+
+
+class SharedStamps:
+    """A table of stamps in memory shared with forked children.
+
+    Keys hash to slots; bump() writes a value no process has written before,
+    so a record cached while a slot held one stamp is known to be stale once
+    the slot holds another, whichever pre-forked worker changed it. Two keys
+    may share a slot, which only costs an extra miss.
+    """
+
+    def __init__(self, slots=STAMP_SLOTS):
+        self.slots = slots
+        # Anonymous and MAP_SHARED: the same pages in every forked worker
+        self._map = mmap.mmap(-1, slots * _STAMP.size)
+        self._counter = itertools.count(1)
+
+    def _offset(self, key):
+        return (zlib.crc32(key.encode('utf-8')) % self.slots) * _STAMP.size
+
+    def read(self, key):
+        return _STAMP.unpack_from(self._map, self._offset(key))[0]
+
+    def bump(self, key):
+        # Unique per process (pid) and within it (counter)
+        value = (os.getpid() << 40) | (next(self._counter) & 0xFFFFFFFFFF)
+        _STAMP.pack_into(self._map, self._offset(key), value)
+
+
+def _id_key(user_id):
+    return f"id:{user_id}"
+
+def _email_key(email):
+    return f"email:{email}"
+
+
+class UserCache:
+    """Bounded LRU + TTL cache of user records for the login path.
+
+    Records are looked up by user id or normalized email. Each process has
+    its own entries, so anything that changes a user must call invalidate(),
+    naming the user's id and email when it knows them. That also bumps their
+    SharedStamps slots, and every process (pre-forked workers included)
+    drops its copy on the next get().
+    """
+
+    FIELDS = ('id', 'name', 'email', 'password_hash')
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user id -> (record, expires_at, stamps), LRU first
+        self._by_email = {}            # normalized email -> user id
+        # Created here, at import, so workers forked later share it
+        self._stamps = SharedStamps() if max_entries > 0 else None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, user_id=None, email=None):
+        """Cached record for user_id or email, or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if user_id is None:
+                user_id = self._by_email.get(email)
+            entry = self._entries.get(user_id) if user_id is not None else None
+            if entry is None:
+                self.misses += 1
+                return None
+            record, expires_at, stamps = entry
+            if expires_at < time.monotonic():
+                self._remove(user_id)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if stamps != self._current(record['id'], record['email']):
+                # Changed, possibly by another worker, since it was loaded
+                self._remove(user_id)
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(record)
+
+    def version(self, user_id=None, email=None):
+        """Read before loading a user by id or email; pass the result to put().
+
+        A change that lands between the load and put() then still counts.
+        """
+        if not self.enabled:
+            return None
+        if user_id is not None:
+            return ('id', self._stamps.read(_id_key(user_id)))
+        return ('email', self._stamps.read(_email_key(email)))
+
+    def put(self, user, version=None):
+        if not self.enabled:
+            return
+        record = {field: user[field] for field in self.FIELDS}
+        stamps = self._current(record['id'], record['email'])
+        if version is not None:
+            # The key the record was loaded by keeps its stamp from before the load
+            stamps = (version[1], stamps[1]) if version[0] == 'id' else (stamps[0], version[1])
+        with self._lock:
+            self._remove(record['id'])
+            self._entries[record['id']] = (record, time.monotonic() + self.ttl, stamps)
+            self._by_email[record['email']] = record['id']
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, user_id=None, email=None):
+        """Drop the record for user_id and/or email, here and in other processes"""
+        if not self.enabled:
+            return
+        if user_id is not None:
+            self._stamps.bump(_id_key(user_id))
+        if email is not None:
+            self._stamps.bump(_email_key(email))
+        with self._lock:
+            if user_id is None:
+                user_id = self._by_email.pop(email, None)
+            if user_id is not None and self._remove(user_id):
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_email.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "stale": self.stale,
+            }
+
+    def _current(self, user_id, email):
+        return (self._stamps.read(_id_key(user_id)), self._stamps.read(_email_key(email)))
+
+    def _remove(self, user_id):
+        # Called with the lock held
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        email = entry[0]['email']
+        if self._by_email.get(email) == user_id:
+            del self._by_email[email]
+        return True
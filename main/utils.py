@@ -1,32 +1,54 @@
-import re
 import hashlib
-import os
+import re
+import string
 import uuid
 from datetime import datetime
+from config import Config
+from blocklist import Blocklist
+import ids
+from hashers import make_password, check_password, needs_rehash
+
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
 
 def is_valid_email(email):
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
+    return EMAIL_PATTERN.match(email) is not None
 
 def normalize_email(email):
     return email.strip().lower()
 
 def hash_password(password):
-    salt = os.urandom(16).hex()
-    hashed = hashlib.sha256((password + salt).encode()).hexdigest()
-    return f"{salt}${hashed}"
+    return make_password(password)
 
 def verify_password(stored_hash, password):
+    return check_password(stored_hash, password)
+
+def password_needs_rehash(stored_hash):
+    return needs_rehash(stored_hash)
+
+# Every user belongs to one of SHARD_BUCKETS buckets, picked by email hash
+# and written into the user id; shards.py maps buckets to database shards.
+# Changing the count would move every user, so it is fixed, not configured
+SHARD_BUCKETS = 4096
+
+def email_bucket(email):
+    """Shard bucket for a normalized email"""
+    digest = hashlib.sha1(email.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') % SHARD_BUCKETS
+
+def user_id_bucket(user_id):
+    """Bucket written into a user id, or None for ids from before buckets"""
+    prefix, sep, suffix = user_id.rpartition('-')
+    if not sep or len(suffix) != 3 or prefix.count('-') != 1:
+        return None
     try:
-        salt, original_hash = stored_hash.split("$", 1)
-        new_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-        return new_hash == original_hash
-    except:
-        return False
+        return int(suffix, 16)
+    except ValueError:
+        return None
 
-"""unique user ID Generation like USR-ED36243C"""
-def generate_user_id():
-    return "USR-" + str(uuid.uuid4())[:8].upper()
+"""unique, time-ordered user ID Generation like USR-0199F2C4A1B30041000C-1F4
+(see ids.py), the last part being the email's bucket"""
+def generate_user_id(email):
+    return f"USR-{ids.next_id():020X}-{email_bucket(email):03X}"
 
 def generate_reset_token():
     return "RESET-" + str(uuid.uuid4())[:12].upper()
@@ -34,33 +56,62 @@ def generate_reset_token():
 def get_current_time():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+PASSWORD_EMPTY = "Password cannot be empty"
+PASSWORD_TOO_SHORT = "Password must be at least 8 characters long"
+PASSWORD_NO_UPPER = "Password must contain at least one uppercase letter"
+PASSWORD_NO_LOWER = "Password must contain at least one lowercase letter"
+PASSWORD_NO_DIGIT = "Password must contain at least one digit"
+PASSWORD_NO_SPECIAL = "Password must contain at least one special character (!@#$%^&* etc.)"
+PASSWORD_COMMON = "Password is too common and easily guessable"
+PASSWORD_BREACHED = "Password has appeared in a data breach; choose a different one"
+PASSWORD_ERRORS = (PASSWORD_EMPTY, PASSWORD_TOO_SHORT, PASSWORD_NO_UPPER, PASSWORD_NO_LOWER,
+                   PASSWORD_NO_DIGIT, PASSWORD_NO_SPECIAL, PASSWORD_COMMON, PASSWORD_BREACHED)
+
+_UPPER = frozenset(string.ascii_uppercase)
+_LOWER = frozenset(string.ascii_lowercase)
+_DIGITS = frozenset(string.digits)
+_SPECIAL = frozenset('!@#$%^&*(),.?":{}|<>')
+
+def _load_common_passwords(path):
+    """Built-in weak passwords plus one per line from `path`, lowercased"""
+    common = {'password', '12345678', 'qwerty', 'admin', 'letmein'}
+    if path:
+        with open(path, encoding='utf-8', errors='ignore') as f:
+            common.update(line.strip().lower() for line in f if line.strip())
+    return frozenset(common)
+
+COMMON_PASSWORDS = _load_common_passwords(Config.COMMON_PASSWORDS_FILE)
+
+# Mapped at import, before prefork workers fork, so they share one mapping
+BREACHED_PASSWORDS = Blocklist(Config.BREACHED_PASSWORDS_FILE) if Config.BREACHED_PASSWORDS_FILE else None
+
+def breached_password_stats():
+    return BREACHED_PASSWORDS.stats() if BREACHED_PASSWORDS else None
+
 def validate_password_strength(password):
     if not password:
-        return False, "Password cannot be empty"
+        return False, PASSWORD_EMPTY
     
     # Check minimum length
     if len(password) < 8:
-        return False, "Password must be at least 8 characters long"
-    
-    # Check for uppercase letters
-    if not re.search(r'[A-Z]', password):
-        return False, "Password must contain at least one uppercase letter"
-    
-    # Check for lowercase letters
-    if not re.search(r'[a-z]', password):
-        return False, "Password must contain at least one lowercase letter"
+        return False, PASSWORD_TOO_SHORT
     
-    # Check for digits
-    if not re.search(r'\d', password):
-        return False, "Password must contain at least one digit"
+    # One pass over the password; each class check is then a set intersection
+    chars = set(password)
+    if chars.isdisjoint(_UPPER):
+        return False, PASSWORD_NO_UPPER
+    if chars.isdisjoint(_LOWER):
+        return False, PASSWORD_NO_LOWER
+    # Non-ASCII decimal digits count too, as they did for the old \d check
+    if chars.isdisjoint(_DIGITS) and not any(c.isdecimal() for c in chars):
+        return False, PASSWORD_NO_DIGIT
+    if chars.isdisjoint(_SPECIAL):
+        return False, PASSWORD_NO_SPECIAL
     
-    # Check for special characters
-    if not re.search(r'[!@#$%^&*(),.?":{}|<>]', password):
-        return False, "Password must contain at least one special character (!@#$%^&* etc.)"
+    if password.lower() in COMMON_PASSWORDS:
+        return False, PASSWORD_COMMON
     
-    # Check for common weak passwords (basic check)
-    weak_passwords = ['password', '12345678', 'qwerty', 'admin', 'letmein']
-    if password.lower() in weak_passwords:
-        return False, "Password is too common and easily guessable"
+    if BREACHED_PASSWORDS is not None and password in BREACHED_PASSWORDS:
+        return False, PASSWORD_BREACHED
     
     return True, "Password is strong"